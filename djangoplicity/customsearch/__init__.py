@@ -33,3 +33,5 @@
 """
 Djangoplicity Custom Search documentation
 """
+
+default_app_config = 'djangoplicity.customsearch.apps.CustomSearchConfig'
@@ -29,20 +29,41 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE
 
+from django.conf import settings
 from django.conf.urls import url
 from django.contrib import admin
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
-from django.http import HttpResponse
-from django.shortcuts import get_object_or_404, render_to_response
+from django.core.paginator import Page, Paginator, InvalidPage, EmptyPage
+from django.core import signing
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render, render_to_response
 from django.template.defaultfilters import slugify
+from django.utils.cache import patch_cache_control
 from django.utils.safestring import mark_safe
+from django.views.decorators.http import condition
 from djangoplicity.admincomments.admin import AdminCommentInline, \
     AdminCommentMixin
+from djangoplicity.customsearch.artifacts import get_export_storage, load_export_token
+from djangoplicity.customsearch.exporter import CsvExporter, iter_csv
+from djangoplicity.customsearch.fragments import fragment_key, get_fragment, render_rows, set_fragment
+from djangoplicity.customsearch.jsonapi import ResultsJSONEncoder, search_results
 from djangoplicity.customsearch.models import CustomSearch, \
     CustomSearchCondition, CustomSearchField, CustomSearchModel, CustomSearchGroup, \
     CustomSearchLayout, CustomSearchLayoutField, CustomSearchOrdering
-from djangoplicity.customsearch.tasks import export_search
+from djangoplicity.customsearch.pagination import CountedPaginator, KeysetPaginator, UncountedPaginator, count_results, \
+    elided_page_range, estimate_cost
+from djangoplicity.customsearch.progress import get_progress
+from djangoplicity.customsearch.query import get_time_bucket
+from djangoplicity.customsearch.resultcache import ResultCacheMiss, get_cached_result_pks, get_computing_error, get_objects, \
+    get_result_cache, get_result_pks, iter_results, start_computing
+from djangoplicity.customsearch.tasks import cancel_export, compute_results, request_export
+from djangoplicity.customsearch.versions import get_data_watermark, get_search_version
 from django.db import DatabaseError
+from functools import wraps
+import hashlib
+import json
+import mimetypes
+import os
+import time
 
 try:
     from djangoplicity.contacts.models import Label
@@ -105,7 +126,7 @@ class CustomSearchAdmin( AdminCommentMixin, admin.ModelAdmin ):
     search_fields = ['name', 'model__name' ]
     fieldsets = (
         ( None, {
-            'fields': ( 'name', 'model', 'layout', 'group', )
+            'fields': ( 'name', 'model', 'layout', 'group', 'async_results', )
         } ),
         ( 'Description', {
             'fields': ( 'human_readable_text', )
@@ -133,12 +154,78 @@ class CustomSearchAdmin( AdminCommentMixin, admin.ModelAdmin ):
         urls = super( CustomSearchAdmin, self ).get_urls()
         info = self.model._meta.app_label, self.model._meta.model_name
         extra_urls = [
-            url(r'^(?P<pk>[0-9]+)/search/$', self.admin_site.admin_view(self.search_view), name='%s_%s_search' % info),
+            url(r'^(?P<pk>[0-9]+)/search/$', self._conditional_view(self.search_view), name='%s_%s_search' % info),
+            url(r'^(?P<pk>[0-9]+)/search/json/$', self._conditional_view(self.json_view), name='%s_%s_search_json' % info),
             url(r'^(?P<pk>[0-9]+)/export/$', self.admin_site.admin_view(self.export_view), name='%s_%s_export' % info),
+            url(r'^(?P<pk>[0-9]+)/export/(?P<export_id>[-0-9a-f]+)/$', self.admin_site.admin_view(self.export_progress_view), name='%s_%s_export_progress' % info),
+            url(r'^(?P<pk>[0-9]+)/export/csv/$', self.admin_site.admin_view(self.csv_export_view), name='%s_%s_export_csv' % info),
+            url(r'^export/(?P<token>[-\w:]+)/$', self.admin_site.admin_view(self.export_download_view), name='%s_%s_export_download' % info),
             url(r'^(?P<pk>[0-9]+)/labels/$', self.admin_site.admin_view(self.labels_view), name='%s_%s_labels' % info),
         ]
         return extra_urls + urls
 
+    def _conditional_view( self, view ):
+        '''
+        Wrap a results view so conditional GET requests are answered with
+        304 Not Modified, without running the search, if the search
+        definition and the searched data did not change (see _results_etag).
+        '''
+        view = condition( etag_func=self._results_etag )( view )
+
+        @wraps( view )
+        def wrapper( request, *args, **kwargs ):
+            response = view( request, *args, **kwargs )
+            # Browsers may keep the page, but must revalidate it
+            patch_cache_control( response, private=True, no_cache=True )
+            return response
+        return self.admin_site.admin_view( wrapper, cacheable=True )
+
+    def _results_etag( self, request, pk=None ):
+        '''
+        Compute the ETag of a results page from the definition version of
+        the search, the data watermarks of the searched models, the time
+        bucket of searches relative to the current time (see query.py), the
+        request parameters and the user. With the result cache enabled, pages
+        are only validated once their results are cached, so pages computed
+        in the background are not validated before they are ready.
+
+        As data changes made without signals do not change the watermarks
+        (see versions.py), ETags also change every CUSTOMSEARCH_ETAG_MAX_AGE
+        seconds (default 300, None for never).
+        '''
+        try:
+            search = CustomSearch.objects.select_related( 'model__model' ).get( pk=pk )
+        except CustomSearch.DoesNotExist:
+            return None
+
+        if get_result_cache() is not None:
+            s, o, ot = self._get_search_params_from_request( request )
+            ( search, _qs, searchval, _error, _header, o, ot ) = search.get_results_queryset( searchval=s, ordering=o, ordering_direction=ot, evaluate=False, table=self._get_layout_table( request, search ) )
+            if get_cached_result_pks( search, searchval, o, ot ) is None:
+                return None
+
+        max_age = getattr( settings, 'CUSTOMSEARCH_ETAG_MAX_AGE', 300 )
+        data = repr( (
+            get_search_version( search.pk ),
+            [get_data_watermark( m ) for m in search.model.data_models()],
+            get_time_bucket( search ),
+            int( time.time() // max_age ) if max_age else None,
+            sorted( request.GET.lists() ),
+            request.user.pk,
+        ) )
+        return hashlib.md5( data.encode( 'utf8' ) ).hexdigest()
+
+    def _get_layout_table( self, request, search ):
+        '''
+        Get the layout of a search bound to a table (see
+        CustomSearchLayout.bind()) once per request, so the ETag, the header
+        and the rows share the related objects of expanded columns.
+        '''
+        tables = request.__dict__.setdefault( '_customsearch_tables', {} )
+        if search.layout_id not in tables:
+            tables[search.layout_id] = search.layout.bind()
+        return tables[search.layout_id]
+
     def _get_search_params_from_request( self, request ):
         '''
         Return the search string and ordering from request if any
@@ -148,14 +235,132 @@ class CustomSearchAdmin( AdminCommentMixin, admin.ModelAdmin ):
         ordering_direction = request.GET.get( "ot", None )
         return (searchval, ordering, ordering_direction)
 
+    def _count_results( self, qs ):
+        '''
+        Count the search results. If CUSTOMSEARCH_ESTIMATED_COUNT_THRESHOLD
+        is set, the planner's estimate is used for larger results.
+        '''
+        return count_results( qs, estimate_threshold=getattr( settings, 'CUSTOMSEARCH_ESTIMATED_COUNT_THRESHOLD', None ) )
+
+    def _is_expensive( self, search, qs ):
+        '''
+        Check if the results of a search should be computed in the
+        background: if the search is flagged so, or if
+        CUSTOMSEARCH_ASYNC_COST_THRESHOLD is set and the planner's estimated
+        cost of the query is higher.
+        '''
+        if search.async_results:
+            return True
+        threshold = getattr( settings, 'CUSTOMSEARCH_ASYNC_COST_THRESHOLD', None )
+        if threshold is None:
+            return False
+        try:
+            cost = estimate_cost( qs )
+        except DatabaseError:
+            return False
+        return cost is not None and cost > threshold
+
+    def _get_page( self, paginator, page ):
+        '''
+        Get a page from the paginator, or the last page if out of range
+        '''
+        try:
+            return paginator.page( page )
+        except ( EmptyPage, InvalidPage ):
+            return paginator.page( paginator.num_pages )
+
     def export_view( self, request, pk=None ):
         search = get_object_or_404( CustomSearch, pk=pk )
         s, o, ot = self._get_search_params_from_request( request )
-        ( search, _qs, _searchval, _error, _header, o, ot ) = search.get_results_queryset( searchval=s, ordering=o, ordering_direction=ot )
+        ( search, _qs, _searchval, _error, _header, o, ot ) = search.get_results_queryset( searchval=s, ordering=o, ordering_direction=ot, evaluate=False, table=self._get_layout_table( request, search ) )
+
+        export_id = request_export( search, request.user.email, s, o, ot, base_url=request.build_absolute_uri( '/' ) )
+
+        return render( request, 'admin/customsearch/export.html', {
+            'search': search,
+            'email': request.user.email,
+            'export_id': export_id,
+            'progress': get_progress( export_id ) if export_id else None,
+        })
+
+    def export_progress_view( self, request, pk=None, export_id=None ):
+        """
+        Show the progress of an export, and cancel it on POST.
+        """
+        search = get_object_or_404( CustomSearch, pk=pk )
+        progress = get_progress( export_id )
+        if progress is None or progress['search'] != search.pk:
+            raise Http404
+
+        if request.method == 'POST' and 'cancel' in request.POST:
+            cancel_export( export_id )
+            progress = get_progress( export_id )
+
+        return render( request, 'admin/customsearch/export.html', {
+            'search': search,
+            'email': request.user.email,
+            'export_id': export_id,
+            'progress': progress,
+        })
+
+    def csv_export_view( self, request, pk=None ):
+        """
+        Stream the search results as a CSV file. Rows are fetched in chunks
+        while the response is sent.
+        """
+        search = get_object_or_404( CustomSearch, pk=pk )
+        s, o, ot = self._get_search_params_from_request( request )
+        ( search, qs, searchval, _error, header, o, ot ) = search.get_results_queryset( searchval=s, ordering=o, ordering_direction=ot, evaluate=False, table=self._get_layout_table( request, search ) )
+
+        rows = ( values for _pk, values in iter_results( search, qs, searchval, o, ot, table=self._get_layout_table( request, search ) ) )
+        fields = search.layout.get_plan().value_fields( header )
+        response = StreamingHttpResponse( iter_csv( [x[1] for x in header], rows, fields=fields ), content_type=CsvExporter.mimetype )
+        response['Content-Disposition'] = 'attachment; filename="%s.csv"' % slugify( search.name )
+        return response
 
-        export_search.delay(pk, request.user.email, s, o, ot)
+    def json_view( self, request, pk=None ):
+        """
+        Get a page of search results as JSON (see jsonapi.py). Besides the
+        search and ordering parameters, takes a cursor (c), a page size (n,
+        at most CUSTOMSEARCH_API_MAX_PAGE_SIZE) and a comma-separated list of
+        fields.
+        """
+        search = get_object_or_404( CustomSearch, pk=pk )
+        s, o, ot = self._get_search_params_from_request( request )
+        fields = [f for f in request.GET.get( 'fields', '' ).split( ',' ) if f]
+        try:
+            per_page = min( int( request.GET.get( 'n', 100 ) ), getattr( settings, 'CUSTOMSEARCH_API_MAX_PAGE_SIZE', 1000 ) )
+            if per_page <= 0:
+                raise ValueError
+        except ValueError:
+            return self._json_response( { 'error': 'Invalid page size' }, status=400 )
+
+        try:
+            data = search_results( search, s, o, ot, cursor=request.GET.get( 'c', None ), per_page=per_page, fields=fields )
+        except KeyError, e:
+            return self._json_response( { 'error': 'Unknown field: %s' % e.args[0] }, status=400 )
+        except ValueError, e:
+            return self._json_response( { 'error': 'Error in query: %s' % e }, status=400 )
+        return self._json_response( data )
+
+    def _json_response( self, data, status=200 ):
+        return HttpResponse( json.dumps( data, cls=ResultsJSONEncoder ), content_type='application/json', status=status )
+
+    def export_download_view( self, request, token=None ):
+        """
+        Download a stored export file from a signed link (see artifacts.py).
+        """
+        storage = get_export_storage()
+        try:
+            name = load_export_token( token )
+        except signing.BadSignature:
+            raise Http404
+        if storage is None or not storage.exists( name ):
+            raise Http404
 
-        return render_to_response('admin/customsearch/export.html', {'search': search, 'email': request.user.email})
+        response = FileResponse( storage.open( name, 'rb' ), content_type=mimetypes.guess_type( name )[0] or 'application/octet-stream' )
+        response['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename( name )
+        return response
 
     def labels_view( self, request, pk=None ):
         """
@@ -167,7 +372,19 @@ class CustomSearchAdmin( AdminCommentMixin, admin.ModelAdmin ):
         # Get queryset
         search = get_object_or_404( CustomSearch, pk=pk )
         s, o, ot = self._get_search_params_from_request( request )
-        ( search, qs, searchval, error, _header, o, ot ) = search.get_results_queryset( searchval=s, ordering=o, ordering_direction=ot )
+        ( search, qs, searchval, error, _header, o, ot ) = search.get_results_queryset( searchval=s, ordering=o, ordering_direction=ot, evaluate=False, table=self._get_layout_table( request, search ) )
+
+        try:
+            pks = get_result_pks( search, qs, searchval, o, ot )
+            if pks is None:
+                object_count, estimated_count = self._count_results( qs )
+            else:
+                object_count, estimated_count = len( pks ), False
+        except Exception, e:
+            error = unicode( e )
+            qs = search.get_empty_queryset()
+            pks = None
+            object_count, estimated_count = 0, False
 
         # Get label
         try:
@@ -183,7 +400,8 @@ class CustomSearchAdmin( AdminCommentMixin, admin.ModelAdmin ):
                     'search': search,
                     'error': error,
                     'labels': labels,
-                    'object_count': qs.count(),
+                    'object_count': object_count,
+                    'estimated_count': estimated_count,
                     'messages': [],
                     'app_label': search._meta.app_label,
                     'opts': search._meta,
@@ -199,7 +417,42 @@ class CustomSearchAdmin( AdminCommentMixin, admin.ModelAdmin ):
         """
         search = get_object_or_404( CustomSearch, pk=pk )
         s, o, ot = self._get_search_params_from_request( request )
-        ( search, qs, searchval, error, header, o, ot ) = search.get_results_queryset( searchval=s, ordering=o, ordering_direction=ot )
+        ( search, qs, searchval, error, header, o, ot ) = search.get_results_queryset( searchval=s, ordering=o, ordering_direction=ot, evaluate=False, table=self._get_layout_table( request, search ) )
+
+        # Expensive searches are computed by a Celery task, which stores the
+        # results in the result cache, while a page polling for them is shown.
+        if not error and get_result_cache() is not None and get_cached_result_pks( search, searchval, o, ot ) is None \
+                and self._is_expensive( search, qs ):
+            error = get_computing_error( search, searchval, o, ot )
+            if error is None:
+                if start_computing( search, searchval, o, ot ):
+                    compute_results.delay( search.pk, searchval, o, ot )
+                return render_to_response( 'admin/customsearch/computing.html', {
+                    'search': search,
+                    'app_label': search._meta.app_label,
+                    'opts': search._meta,
+                })
+
+        # The results are counted once per request. The count validates
+        # the query and is shared by the paginator and the template. With
+        # the result cache enabled, the primary keys of the results are
+        # fetched (or read from the cache) instead. With
+        # CUSTOMSEARCH_COUNT_FREE_PAGINATION, the results are not counted.
+        try:
+            pks = get_result_pks( search, qs, searchval, o, ot )
+            if pks is not None:
+                object_count, estimated_count = len( pks ), False
+            elif getattr( settings, 'CUSTOMSEARCH_COUNT_FREE_PAGINATION', False ):
+                object_count, estimated_count = None, False
+            else:
+                object_count, estimated_count = self._count_results( qs )
+        except Exception, e:
+            error = unicode( e )
+            qs = search.get_empty_queryset()
+            pks = None
+            object_count, estimated_count = 0, False
+
+        keyset = getattr( settings, 'CUSTOMSEARCH_KEYSET_PAGINATION', False ) and pks is None
 
         # Get page num
         try:
@@ -208,18 +461,47 @@ class CustomSearchAdmin( AdminCommentMixin, admin.ModelAdmin ):
             page = 1
 
         try:
-            paginator = Paginator( qs, 100 )
-
-            # Adapt page to list
-            try:
-                objects = paginator.page( page )
-            except ( EmptyPage, InvalidPage ):
-                objects = paginator.page( paginator.num_pages )
+            if pks is not None:
+                try:
+                    objects = self._get_page( Paginator( pks, 100 ), page )
+                except ResultCacheMiss:
+                    pks = get_result_pks( search, qs, searchval, o, ot, refresh=True )
+                    if pks is not None:
+                        object_count = len( pks )
+                        objects = self._get_page( Paginator( pks, 100 ), page )
+                    else:
+                        # The results no longer fit in the result cache
+                        object_count, estimated_count = self._count_results( qs )
+                        objects = self._get_page( CountedPaginator( qs, 100, count=object_count ), page )
+            elif keyset:
+                objects = KeysetPaginator( qs, 100 ).page( request.GET.get( 'c', None ) )
+            elif object_count is None:
+                objects = UncountedPaginator( qs, 100 ).page( page )
+            else:
+                objects = self._get_page( CountedPaginator( qs, 100, count=object_count ), page )
         except Exception, e:
             error = unicode( e )
             qs = search.get_empty_queryset()
-            paginator = Paginator( qs, 100 )
+            paginator = CountedPaginator( qs, 100, count=0 )
             objects = paginator.page( 1 )
+            object_count, estimated_count = 0, False
+            pks = None
+            keyset = False
+
+        # The rows are rendered without template loops, and cached for
+        # repeated views of the same page (see fragments.py).
+        reverse_name = "admin:%s_%s_change" % ( qs.model._meta.app_label, qs.model._meta.model_name )
+        key = fragment_key( search, searchval, o, ot, keyset, request.GET.get( 'c', None ) if keyset else objects.number ) if not error else None
+        rows = get_fragment( key ) if key else None
+        if rows is None:
+            if pks is not None:
+                base_qs = search.layout.get_plan().optimize_queryset( qs.model._default_manager.all(), prefetch=False )
+                data_table = search.layout.data_table( get_objects( base_qs, objects.object_list ), quote_obj_pks=True, table=self._get_layout_table( request, search ) )
+            else:
+                data_table = search.layout.data_table( objects.object_list, quote_obj_pks=True, projection=True, table=self._get_layout_table( request, search ) )
+            rows = render_rows( data_table, reverse_name )
+            if key:
+                set_fragment( key, rows )
 
         # Paginator params
         from urllib import urlencode
@@ -254,12 +536,14 @@ class CustomSearchAdmin( AdminCommentMixin, admin.ModelAdmin ):
                 'ot': ot,
                 'error': error,
                 'objects': objects,
-                'object_count': len( qs ),
-                'data_table': search.layout.data_table( objects.object_list, quote_obj_pks=True ),
+                'keyset': keyset,
+                'page_range': elided_page_range( objects ) if isinstance( objects, Page ) else None,
+                'object_count': object_count,
+                'estimated_count': estimated_count,
+                'rows': rows,
                 'messages': [],
                 'app_label': search._meta.app_label,
                 'opts': search._meta,
-                'reverse_name': "admin:%s_%s_change" % ( qs.model._meta.app_label, qs.model._meta.model_name ),
                 'searchval': searchval if searchval is not None else "",
                 'has_labels': has_labels,
             },
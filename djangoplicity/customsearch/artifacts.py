@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Storage of export files.
+
+If CUSTOMSEARCH_EXPORT_STORAGE is set, finished exports are saved to a Django
+storage instead of being attached to the notification email, and the email
+contains a signed download link which expires after
+CUSTOMSEARCH_EXPORT_LINK_MAX_AGE seconds (default 7 days).
+
+Settings:
+
+* CUSTOMSEARCH_EXPORT_STORAGE - 'default' for the default file storage, or
+  the import path of a storage class.
+* CUSTOMSEARCH_EXPORT_STORAGE_OPTIONS - keyword arguments of the storage
+  class.
+* CUSTOMSEARCH_EXPORT_COMPRESSION - None, 'gzip' or 'zip'.
+
+Files are stored in a directory named after their creation time, so the
+cleanup_exports task can remove expired ones without relying on the
+modification times of the storage.
+
+The part files of exports being written (see tasks.py) are kept in the same
+storage, so a retried export or the merge of a sharded export can read the
+parts written by other workers. Without CUSTOMSEARCH_EXPORT_STORAGE, they
+are kept in CUSTOMSEARCH_EXPORT_SHARD_DIR (default: the temporary
+directory), which must then be shared by the workers.
+"""
+
+import gzip
+import os
+import shutil
+import time
+import uuid
+import zipfile
+
+from django.conf import settings
+from django.core import signing
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, default_storage, get_storage_class
+from tempfile import NamedTemporaryFile, gettempdir
+
+EXPORT_DIR = 'customsearch/exports'
+
+PART_DIR = 'customsearch/parts'
+
+TOKEN_SALT = 'djangoplicity.customsearch.export'
+
+
+def get_export_storage():
+    """
+    Get the storage of export files, or None if exports are sent by email.
+    """
+    storage = getattr( settings, 'CUSTOMSEARCH_EXPORT_STORAGE', None )
+    if not storage:
+        return None
+    if storage == 'default':
+        return default_storage
+    return get_storage_class( storage )( **getattr( settings, 'CUSTOMSEARCH_EXPORT_STORAGE_OPTIONS', {} ) )
+
+
+def get_part_storage():
+    """
+    Get the storage of the part files of exports.
+    """
+    storage = get_export_storage()
+    if storage is None:
+        storage = FileSystemStorage( location=getattr( settings, 'CUSTOMSEARCH_EXPORT_SHARD_DIR', None ) or gettempdir() )
+    return storage
+
+
+def part_name( export_id, index ):
+    return '%s/%s/%05d.part' % ( PART_DIR, export_id, index )
+
+
+def store_part( f, name ):
+    """
+    Save a part file under the given name, replacing the part written by an
+    earlier attempt if any. Returns the name of the stored file.
+    """
+    storage = get_part_storage()
+    storage.delete( name )
+    return storage.save( name, File( f ) )
+
+
+def delete_parts( names ):
+    """
+    Delete part files, and the directories of their exports if they are
+    empty and the storage is a file system.
+    """
+    storage = get_part_storage()
+    directories = set()
+    for name in names:
+        storage.delete( name )
+        directories.add( name.rsplit( '/', 1 )[0] )
+    for directory in directories:
+        try:
+            os.rmdir( storage.path( directory ) )
+        except ( OSError, NotImplementedError ):
+            pass
+
+
+def get_link_max_age():
+    return getattr( settings, 'CUSTOMSEARCH_EXPORT_LINK_MAX_AGE', 7 * 24 * 3600 )
+
+
+def _compress( filename, compression ):
+    """
+    Compress a file to a temporary file, and return the temporary file and
+    the suffix of the compressed file name.
+    """
+    f = NamedTemporaryFile( suffix='.tmp' )
+    if compression == 'gzip':
+        with open( filename, 'rb' ) as src:
+            gz = gzip.GzipFile( filename=os.path.basename( filename ), mode='wb', fileobj=f )
+            shutil.copyfileobj( src, gz )
+            gz.close()
+        suffix = '.gz'
+    elif compression == 'zip':
+        zf = zipfile.ZipFile( f, 'w', zipfile.ZIP_DEFLATED, True )
+        zf.write( filename, os.path.basename( filename ) )
+        zf.close()
+        suffix = '.zip'
+    else:
+        raise ValueError( "Unknown compression: %r" % compression )
+    f.seek( 0 )
+    return ( f, suffix )
+
+
+def store_export( filename, name ):
+    """
+    Save an export file to the export storage under the given file name,
+    compressing it if configured. Returns the name of the stored file.
+    """
+    storage = get_export_storage()
+    path = '%s/%d-%s/%s' % ( EXPORT_DIR, int( time.time() ), uuid.uuid4().hex, name )
+
+    compression = getattr( settings, 'CUSTOMSEARCH_EXPORT_COMPRESSION', None )
+    if compression:
+        f, suffix = _compress( filename, compression )
+        path += suffix
+    else:
+        f = open( filename, 'rb' )
+    try:
+        return storage.save( path, File( f ) )
+    finally:
+        f.close()
+
+
+def export_token( name ):
+    """
+    Get the signed token of a stored export file.
+    """
+    return signing.dumps( name, salt=TOKEN_SALT )
+
+
+def load_export_token( token ):
+    """
+    Get the stored export file name from a signed token. Raises
+    signing.BadSignature (or its subclass signing.SignatureExpired).
+    """
+    return signing.loads( token, salt=TOKEN_SALT, max_age=get_link_max_age() )
+
+
+def cleanup_exports( max_age=None ):
+    """
+    Delete the stored export files older than max_age seconds (default: the
+    link max age). Returns the number of deleted files.
+    """
+    storage = get_export_storage()
+    if storage is None:
+        return 0
+    if max_age is None:
+        max_age = get_link_max_age()
+
+    try:
+        directories = storage.listdir( EXPORT_DIR )[0]
+    except ( OSError, IOError ):
+        # The directory does not exist yet
+        return 0
+
+    deleted = 0
+    limit = time.time() - max_age
+    for directory in directories:
+        try:
+            created = int( directory.split( '-', 1 )[0] )
+        except ValueError:
+            continue
+        if created < limit:
+            path = '%s/%s' % ( EXPORT_DIR, directory )
+            for name in storage.listdir( path )[1]:
+                storage.delete( '%s/%s' % ( path, name ) )
+                deleted += 1
+            # Remove the empty directory of file system storages
+            try:
+                os.rmdir( storage.path( path ) )
+            except ( OSError, NotImplementedError ):
+                pass
+    return deleted
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Coalescing of identical export requests.
+
+Export requests are keyed by the search, its definition version, the search
+parameters, the export format and the data watermarks of the searched models
+(see versions.py). The first request for a key takes a lock in the cache
+and runs the export; requests made while the export runs only add their
+email address to the key, and get the same file once the export completes,
+or are told that it failed.
+
+If exports are stored (see artifacts.py), the stored file is also given to
+identical requests made up to CUSTOMSEARCH_EXPORT_DEDUPE_TIMEOUT seconds
+(default 600) after the export completed.
+"""
+
+import hashlib
+
+from django.conf import settings
+
+from djangoplicity.customsearch.versions import get_cache, get_data_watermark, get_search_version
+
+
+def _lock_timeout():
+    return getattr( settings, 'CUSTOMSEARCH_EXPORT_LOCK_TIMEOUT', 3600 )
+
+
+def export_key( search, searchval=None, ordering=None, ordering_direction=None, export_format='xlsx' ):
+    watermarks = [get_data_watermark( m ) for m in search.model.data_models()]
+    params = repr( ( searchval or u'', ordering, ordering_direction, export_format, watermarks ) ).encode( 'utf8' )
+    return 'customsearch:export:%s:%s:%s' % ( search.pk, get_search_version( search.pk ), hashlib.md5( params ).hexdigest() )
+
+
+def acquire( key, export_id=True ):
+    """
+    Take the lock of an export, on behalf of the export with the given id
+    (see progress.py). Returns False if the export is already running.
+    """
+    cache = get_cache()
+    # The counter of requesters must exist once the lock is visible, and
+    # must not be reset if another export holds the lock
+    cache.add( '%s:n' % key, 0, _lock_timeout() )
+    return cache.add( '%s:lock' % key, export_id, _lock_timeout() )
+
+
+def add_requester( key, email ):
+    """
+    Add an email address to a running export. Returns False if the export
+    is not running (anymore).
+    """
+    cache = get_cache()
+    try:
+        n = cache.incr( '%s:n' % key )
+    except ValueError:
+        return False
+    cache.set( '%s:email:%s' % ( key, n ), email, _lock_timeout() )
+    return cache.get( '%s:lock' % key ) is not None
+
+
+def get_running( key ):
+    """
+    Get the id of the running export for a key, or None.
+    """
+    return get_cache().get( '%s:lock' % key )
+
+
+def release( key, artifact=None ):
+    """
+    Release the lock of an export, and return the email addresses added
+    while it ran. The name of the stored export file, if any, is kept for
+    identical requests.
+    """
+    cache = get_cache()
+    if artifact is not None:
+        cache.set( '%s:done' % key, artifact, getattr( settings, 'CUSTOMSEARCH_EXPORT_DEDUPE_TIMEOUT', 600 ) )
+    cache.delete( '%s:lock' % key )
+
+    n = cache.get( '%s:n' % key ) or 0
+    keys = ['%s:email:%s' % ( key, i + 1 ) for i in range( n )]
+    emails = cache.get_many( keys )
+    cache.delete_many( keys + ['%s:n' % key] )
+    return [emails[k] for k in keys if k in emails]
+
+
+def fail( key ):
+    """
+    Release the lock of a failed export, and return the email addresses
+    added while it ran. The stored file of an earlier export of the key is
+    forgotten as well.
+    """
+    get_cache().delete( '%s:done' % key )
+    return release( key )
+
+
+def get_completed( key ):
+    """
+    Get the name of the stored file of a recently completed export, or None.
+    """
+    return get_cache().get( '%s:done' % key )
@@ -30,38 +30,143 @@
 # POSSIBILITY OF SUCH DAMAGE
 
 import xlwt
+import csv
 import datetime
 import decimal
+import math
+import os
+import re
+import shutil
+import zipfile
+from cStringIO import StringIO
+from django.db import models
+from djangoplicity.customsearch.layout import chunked
+from itertools import islice
+from tempfile import NamedTemporaryFile
+from xml.sax.saxutils import escape, quoteattr
+
+FIELD_TYPES = (
+    ( models.DateTimeField, datetime.datetime ),
+    ( models.DateField, datetime.date ),
+    ( models.TimeField, datetime.time ),
+    ( models.BooleanField, bool ),
+    ( models.NullBooleanField, bool ),
+    ( models.DecimalField, decimal.Decimal ),
+    ( models.FloatField, float ),
+    ( models.AutoField, int ),
+    ( models.IntegerField, int ),
+    ( models.CharField, unicode ),
+    ( models.TextField, unicode ),
+)
+# Python type of the values of Django model fields (subclasses first)
+
+_missing = object()
+
+
+def field_type( field ):
+    """
+    Get the Python type of the values of a Django model field, or None if
+    unknown.
+    """
+    for fieldcls, cls in FIELD_TYPES:
+        if isinstance( field, fieldcls ):
+            return cls
+    return None
 
 
 class Exporter( object ):
     """
     Abstract base class for all exporters
+
+    Values are converted by a function compiled once per column, instead of
+    checking the type of each value. The type of a column is taken from its
+    Django model field if given in fields (a list of fields or None, in the
+    order of the header), or else from the first non-null value of the
+    column. Values of another type are converted with a function looked up
+    by type. Subclasses define the conversions in _make_converter().
     """
-    def __init__( self, header=[] ):
+    def __init__( self, header=[], fields=None ):
         self._wrote_header = False
         self._header_mapping = {}
         self._header = []
+        self._header_funcs = []
+        self._fields = list( fields ) if fields else []
+        self._type_converters = {}
+        self._columns = None
         i = 0
 
         for h, func in header:
             self._header.append( h )
             self._header_mapping[h] = {'func': func, 'idx': i}
+            self._header_funcs.append( ( h, func ) )
             i += 1
 
     def _prepare_row( self, data ):
+        get = data.get
         row = []
-        for h in self._header:
-            func = self._header_mapping[h]['func']
-            try:
-                val = data[h]
-                if func:
-                    val = func( val )
-            except KeyError:
+        for h, func in self._header_funcs:
+            val = get( h, _missing )
+            if val is _missing:
                 val = None
+            elif func:
+                val = func( val )
             row.append( val )
         return row
 
+    def _make_converter( self, cls ):
+        """
+        Get the function converting values of the given type.
+        """
+        return lambda value: value
+
+    def _converter( self, cls ):
+        convert = self._type_converters.get( cls )
+        if convert is None:
+            convert = self._type_converters[cls] = self._make_converter( cls )
+        return convert
+
+    def _convert( self, value ):
+        """
+        Convert a value of any type.
+        """
+        return self._converter( value.__class__ )( value )
+
+    def _column_converter( self, cls ):
+        convert = self._converter( cls )
+        fallback = self._convert
+
+        def column( value ):
+            if value.__class__ is cls:
+                return convert( value )
+            return fallback( value )
+        return column
+
+    def _probe( self, i ):
+        """
+        Converter of a column of unknown type, which replaces itself with a
+        typed converter on the first non-null value.
+        """
+        def probe( value ):
+            if value is None:
+                return self._convert( value )
+            self._columns[i] = self._column_converter( value.__class__ )
+            return self._columns[i]( value )
+        return probe
+
+    def converters( self, size ):
+        """
+        Get the converters of the columns of rows of the given size.
+        """
+        if self._columns is None or len( self._columns ) != size:
+            self._columns = []
+            for i in range( size ):
+                cls = field_type( self._fields[i] ) if i < len( self._fields ) else None
+                self._columns.append( self._column_converter( cls ) if cls else self._probe( i ) )
+        return self._columns
+
+    def convert_row( self, row ):
+        return [convert( v ) for convert, v in zip( self.converters( len( row ) ), row )]
+
     def writeheader( self, **kwargs ):
         if not self._wrote_header:
             self._wrote_header = True
@@ -78,6 +183,20 @@ class Exporter( object ):
         for r in rows:
             self.writerow( r )
 
+    def writepart( self, rows, out ):
+        """
+        Write rows, without header, to a file object in a format which can
+        be appended to an export with appendpart(). Used to render parts of
+        an export in parallel.
+        """
+        raise NotImplementedError
+
+    def appendpart( self, fileobj ):
+        """
+        Append rows written by writepart() to the export.
+        """
+        raise NotImplementedError
+
 
 class ExcelExporter( Exporter ):
     """
@@ -97,8 +216,8 @@ class ExcelExporter( Exporter ):
         'time': xlwt.easyxf( num_format_str="hh:mm:ss" ),
     }
 
-    def __init__( self, filename_or_stream=None, title="Contacts", header=[], flush_rows=500 ):
-        super( ExcelExporter, self ).__init__( header=header )
+    def __init__( self, filename_or_stream=None, title="Contacts", header=[], flush_rows=500, fields=None ):
+        super( ExcelExporter, self ).__init__( header=header, fields=fields )
         self._out = filename_or_stream
         self._wb = xlwt.Workbook()
         self._ws = self._wb.add_sheet( title )
@@ -114,39 +233,354 @@ class ExcelExporter( Exporter ):
         defaults.update( kwargs )
         super( ExcelExporter, self ).writeheader( **defaults )
 
+    def _make_converter( self, cls ):
+        if cls is type( None ) or issubclass( cls, ( basestring, int, long, float, decimal.Decimal, bool ) ):
+            return lambda value: [value]
+        for datecls, style in [( datetime.datetime, 'datetime' ), ( datetime.date, 'date' ), ( datetime.time, 'time' )]:
+            if issubclass( cls, datecls ):
+                style = self.styles[style]
+                return lambda value: [value, style]
+        return lambda value: [unicode( value )]
+
     def _prepare_value( self, value ):
-        if (isinstance( value, basestring ) or
-            isinstance( value, int ) or
-            isinstance( value, float ) or
-            isinstance( value, long ) or
-            isinstance( value, decimal.Decimal ) or
-            isinstance( value, bool ) or
-            isinstance( value, decimal.Decimal ) or
-            value is None):
-            return [value]
-        elif isinstance( value, datetime.datetime ):
-            return [value, self.styles['datetime']]
-        elif isinstance( value, datetime.date ):
-            return [value, self.styles['date']]
-        elif isinstance( value, datetime.time ):
-            return [value, self.styles['time']]
-        else:
-            return [unicode( value )]
+        return self._convert( value )
 
     def _prepare_values( self, values ):
         return map( lambda x: self._prepare_value( x ), values )
 
     def writerow( self, row, style=None, **kwargs ):
         i = 0
-        for cval in row:
-            if style is not None:
+        if style is not None:
+            for cval in row:
                 self._ws.write( self._row, i, self._prepare_value(cval)[0], style )
-            else:
-                self._ws.write( self._row, i, *self._prepare_value(cval) )
-            i += 1
+                i += 1
+        else:
+            for args in self.convert_row( row ):
+                self._ws.write( self._row, i, *args )
+                i += 1
         # Writing large amount of data requires the sheet to be flushed from time to time
         # otherwise a "ValueError: More than 4094 XFs (styles)" error is thrown.
         # Once the rows are flushed, they can no longer be edited.
         if self._flush_rows > 0 and self._row % self._flush_rows == 0:
             self._ws.flush_row_data()
         self._row += 1
+
+
+class CsvExporter( Exporter ):
+    """
+    CSV exporter writing UTF-8 encoded rows
+
+    Example::
+        exporter = CsvExporter( filename_or_stream=open( '/path/to/file.csv', 'wb' ), header=[ ('id',None), ('email', None) ] )
+        for obj in queryset:
+            exporter.writedata( { 'id' : obj.id, 'email' : obj.email } )
+    """
+    mimetype = "text/csv"
+
+    def __init__( self, filename_or_stream=None, header=[], dialect='excel', fields=None ):
+        super( CsvExporter, self ).__init__( header=header, fields=fields )
+        self._out = filename_or_stream
+        self._writer = csv.writer( filename_or_stream, dialect=dialect )
+        self.writeheader()
+
+    def _make_converter( self, cls ):
+        if cls is type( None ):
+            return lambda value: ''
+        elif issubclass( cls, unicode ):
+            return lambda value: value.encode( 'utf-8' )
+        elif issubclass( cls, str ):
+            return lambda value: value
+        else:
+            return lambda value: unicode( value ).encode( 'utf-8' )
+
+    def writeheader( self, **kwargs ):
+        if not self._wrote_header:
+            self._wrote_header = True
+            self._writer.writerow( [self._convert( h ) for h in self._header] )
+
+    def writerow( self, row, **kwargs ):
+        self._writer.writerow( self.convert_row( row ) )
+
+    def writerows( self, rows, **kwargs ):
+        convert_row = self.convert_row
+        self._writer.writerows( convert_row( r ) for r in rows )
+
+    def writepart( self, rows, out ):
+        convert_row = self.convert_row
+        csv.writer( out, dialect=self._writer.dialect ).writerows( convert_row( r ) for r in rows )
+
+    def appendpart( self, fileobj ):
+        shutil.copyfileobj( fileobj, self._out )
+
+
+def iter_csv( header, rows, batch_size=500, fields=None ):
+    """
+    Generate a CSV file in chunks of batch_size rows, e.g. for a
+    StreamingHttpResponse. The header is generated on its own so it can be
+    sent right away.
+    """
+    buf = StringIO()
+    exporter = CsvExporter( buf, header=[ (h, None) for h in header ], fields=fields )
+
+    def flush():
+        data = buf.getvalue()
+        buf.seek( 0 )
+        buf.truncate()
+        return data
+
+    yield flush()
+    rows = iter( rows )
+    while True:
+        exporter.writerows( islice( rows, batch_size ) )
+        data = flush()
+        if not data:
+            return
+        yield data
+
+
+class XlsxStreamingExporter( Exporter ):
+    """
+    Excel 2007+ (.xlsx) exporter with bounded memory usage
+
+    Rows are written as XML to temporary sheet files as they come, and the
+    sheets are only zipped into the workbook on save(). Strings are written
+    inline and all cells use one of a fixed set of styles, so neither the
+    number of rows nor the number of distinct values is kept in memory. When
+    a sheet is full, the rows continue on a new sheet. Each row is written
+    on its own line, so parts written by writepart() can be appended line by
+    line.
+
+    Example::
+        exporter = XlsxStreamingExporter( filename_or_stream='/path/to/excelfile.xlsx', header=[ ('id',None), ('email', None) ] )
+        for obj in queryset:
+            exporter.writedata( { 'id' : obj.id, 'email' : obj.email } )
+        exporter.save()
+    """
+    mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+    max_rows = 1048576
+    # Maximum number of rows of a worksheet
+
+    styles = {
+        'header': 1,
+        'datetime': 2,
+        'date': 3,
+        'time': 4,
+    }
+    # Indexes of the cell formats in STYLES_XML
+
+    epoch = datetime.datetime( 1899, 12, 30 )
+
+    entities = { '\n': '&#10;', '\r': '&#13;' }
+    # Line breaks are escaped to keep each row on one line
+
+    invalid_chars = re.compile( u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]' )
+    # Characters not allowed in XML
+
+    def __init__( self, filename_or_stream=None, title="Contacts", header=[], max_rows=None, fields=None ):
+        super( XlsxStreamingExporter, self ).__init__( header=header, fields=fields )
+        self._out = filename_or_stream
+        self._title = re.sub( r'[\[\]:*?/\\]', '-', title )[:25] or 'Sheet'
+        if max_rows is not None:
+            self.max_rows = max_rows
+        self._sheets = []
+        self._sheet = None
+        self._row = 0
+
+    def _add_sheet( self ):
+        """
+        Start a new sheet, and write the header on it.
+        """
+        if self._sheet is not None:
+            self._close_sheet()
+        self._sheet = NamedTemporaryFile( suffix='.xml', delete=False )
+        self._sheets.append( self._sheet.name )
+        self._sheet.write( '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>\n' )
+        self._row = 0
+        self._wrote_header = False
+        self.writeheader()
+
+    def _close_sheet( self ):
+        self._sheet.write( '</sheetData></worksheet>' )
+        self._sheet.close()
+
+    def writeheader( self, **kwargs ):
+        if self._sheet is None:
+            # The header is written on each new sheet
+            self._add_sheet()
+            return
+        defaults = { 'style': 'header' }
+        defaults.update( kwargs )
+        super( XlsxStreamingExporter, self ).writeheader( **defaults )
+
+    def _string_cell( self, value, style ):
+        value = self.invalid_chars.sub( u'', value )
+        return u'<c t="inlineStr"%s><is><t xml:space="preserve">%s</t></is></c>' % ( style, escape( value, self.entities ) )
+
+    def _date_cell( self, delta, style ):
+        days = delta.days + ( delta.seconds + delta.microseconds / 1e6 ) / 86400.0
+        return u'<c s="%s"><v>%r</v></c>' % ( style, days )
+
+    def _make_converter( self, cls, style=None ):
+        """
+        Get the function returning the XML of a cell for values of a type.
+        """
+        s = ' s="%s"' % self.styles[style] if style else ''
+        if cls is type( None ):
+            cell = u'<c%s/>' % s
+            return lambda value: cell
+        elif issubclass( cls, bool ):
+            return lambda value: u'<c t="b"%s><v>%d</v></c>' % ( s, value )
+        elif issubclass( cls, ( int, long ) ):
+            return lambda value: u'<c%s><v>%s</v></c>' % ( s, value )
+
+        # NaN and infinity are not valid cell values, so they are left empty
+        empty = u'<c%s/>' % s
+        if issubclass( cls, decimal.Decimal ):
+            return lambda value: u'<c%s><v>%s</v></c>' % ( s, value ) if value.is_finite() else empty
+        elif issubclass( cls, float ):
+            return lambda value: u'<c%s><v>%r</v></c>' % ( s, value ) if not ( math.isnan( value ) or math.isinf( value ) ) else empty
+
+        epoch = self.epoch
+        date_cell = self._date_cell
+        if issubclass( cls, datetime.datetime ):
+            s = self.styles[style or 'datetime']
+            return lambda value: date_cell( value.replace( tzinfo=None ) - epoch, s )
+        elif issubclass( cls, datetime.date ):
+            s = self.styles[style or 'date']
+            return lambda value: date_cell( datetime.datetime( value.year, value.month, value.day ) - epoch, s )
+        elif issubclass( cls, datetime.time ):
+            s = self.styles[style or 'time']
+            return lambda value: date_cell( datetime.timedelta( hours=value.hour, minutes=value.minute, seconds=value.second, microseconds=value.microsecond ), s )
+
+        string_cell = self._string_cell
+        if issubclass( cls, str ):
+            return lambda value: string_cell( value.decode( 'utf-8', 'replace' ), s )
+        else:
+            return lambda value: string_cell( unicode( value ), s )
+
+    def _prepare_value( self, value, style=None ):
+        """
+        Get the XML of a cell.
+        """
+        if style:
+            return self._make_converter( value.__class__, style )( value )
+        return self._convert( value )
+
+    def _row_xml( self, row, style=None ):
+        if style:
+            cells = [self._prepare_value( v, style ) for v in row]
+        else:
+            cells = self.convert_row( row )
+        return ( u'<row>%s</row>\n' % u''.join( cells ) ).encode( 'utf-8' )
+
+    def _write( self, lines ):
+        """
+        Write encoded rows to the current sheet, starting a new sheet when
+        it is full.
+        """
+        buf = []
+        for line in lines:
+            if self._sheet is None or self._row >= self.max_rows:
+                if buf:
+                    self._sheet.write( ''.join( buf ) )
+                    buf = []
+                self._add_sheet()
+            buf.append( line )
+            self._row += 1
+            if len( buf ) >= 1000:
+                self._sheet.write( ''.join( buf ) )
+                buf = []
+        if buf:
+            self._sheet.write( ''.join( buf ) )
+
+    def writerow( self, row, style=None, **kwargs ):
+        self.writerows( [row], style=style )
+
+    def writerows( self, rows, style=None, **kwargs ):
+        row_xml = self._row_xml
+        self._write( row_xml( r, style ) for r in rows )
+
+    def writepart( self, rows, out ):
+        row_xml = self._row_xml
+        for chunk in chunked( rows, 1000 ):
+            out.write( ''.join( [row_xml( r ) for r in chunk] ) )
+
+    def appendpart( self, fileobj ):
+        self._write( iter( fileobj.readline, '' ) )
+
+    def save( self, filename_or_stream=None ):
+        if self._sheet is None:
+            self._add_sheet()
+        self._close_sheet()
+        names = [self._title] + ['%s (%d)' % ( self._title, i + 2 ) for i in range( len( self._sheets ) - 1 )]
+        try:
+            zf = zipfile.ZipFile( filename_or_stream if filename_or_stream else self._out, 'w', zipfile.ZIP_DEFLATED, True )
+            zf.writestr( '[Content_Types].xml', CONTENT_TYPES_XML % ''.join(
+                [SHEET_CONTENT_TYPE_XML % ( i + 1 ) for i in range( len( names ) )] ) )
+            zf.writestr( '_rels/.rels', RELS_XML )
+            zf.writestr( 'xl/workbook.xml', ( WORKBOOK_XML % ''.join(
+                [u'<sheet name=%s sheetId="%d" r:id="rId%d"/>' % ( quoteattr( name ), i + 1, i + 1 ) for i, name in enumerate( names )] ) ).encode( 'utf-8' ) )
+            zf.writestr( 'xl/_rels/workbook.xml.rels', WORKBOOK_RELS_XML % ( ''.join(
+                [SHEET_REL_XML % ( i + 1, i + 1 ) for i in range( len( names ) )] ), len( names ) + 1 ) )
+            zf.writestr( 'xl/styles.xml', STYLES_XML )
+            for i, filename in enumerate( self._sheets ):
+                zf.write( filename, 'xl/worksheets/sheet%d.xml' % ( i + 1 ) )
+            zf.close()
+        finally:
+            for filename in self._sheets:
+                os.remove( filename )
+            self._sheets = []
+
+
+CONTENT_TYPES_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">\
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>\
+<Default Extension="xml" ContentType="application/xml"/>\
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>\
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>\
+%s</Types>'''
+
+SHEET_CONTENT_TYPE_XML = '''<Override PartName="/xl/worksheets/sheet%d.xml" \
+ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'''
+
+RELS_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">\
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>\
+</Relationships>'''
+
+WORKBOOK_XML = u'''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" \
+xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>%s</sheets></workbook>'''
+
+WORKBOOK_RELS_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">%s\
+<Relationship Id="rId%d" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>\
+</Relationships>'''
+
+SHEET_REL_XML = '''<Relationship Id="rId%d" \
+Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet%d.xml"/>'''
+
+STYLES_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">\
+<numFmts count="3">\
+<numFmt numFmtId="164" formatCode="yyyy/mm/dd hh:mm:ss"/>\
+<numFmt numFmtId="165" formatCode="yyyy/mm/dd"/>\
+<numFmt numFmtId="166" formatCode="hh:mm:ss"/>\
+</numFmts>\
+<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>\
+<font><b/><sz val="11"/><color rgb="FFFFFFFF"/><name val="Calibri"/></font></fonts>\
+<fills count="3"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill>\
+<fill><patternFill patternType="solid"><fgColor rgb="FF000000"/></patternFill></fill></fills>\
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>\
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>\
+<cellXfs count="5">\
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>\
+<xf numFmtId="0" fontId="1" fillId="2" borderId="0" xfId="0" applyFont="1" applyFill="1"/>\
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>\
+<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>\
+<xf numFmtId="166" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>\
+</cellXfs>\
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>\
+</styleSheet>'''
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+"""
+Rendering and caching of the rows of results tables.
+
+The rows of a results page are rendered by render_rows() instead of template
+loops: the change link is only reversed once per table, and each value is
+formatted like a template variable ( {{ value }} ) would be.
+
+The rendered rows are cached for CUSTOMSEARCH_FRAGMENT_CACHE_TIMEOUT seconds
+(default 300, None or 0 disables the cache) in the CUSTOMSEARCH_CACHE cache.
+They are keyed by the definition version of the search, the data watermarks
+of the searched models (see versions.py), the time bucket of searches
+relative to the current time (see query.py) and the page parameters, so
+cached rows are never shown after the search or its data changed.
+"""
+
+from django.conf import settings
+from django.urls import reverse
+from django.utils.encoding import force_text, iri_to_uri
+from django.utils.formats import localize
+from django.utils.html import conditional_escape, escape
+from django.utils.http import RFC3986_SUBDELIMS, urlquote
+from django.utils.safestring import mark_safe
+from django.utils.timezone import template_localtime
+
+from djangoplicity.customsearch.query import get_time_bucket
+from djangoplicity.customsearch.versions import get_cache, get_data_watermark, get_search_version
+
+import hashlib
+
+PK_PLACEHOLDER = '__customsearch_pk__'
+
+
+def format_value( value ):
+    """
+    Format a value for HTML like the template engine does for a variable.
+    """
+    return conditional_escape( force_text( localize( template_localtime( value ) ) ) )
+
+
+def _url_part( value ):
+    """
+    Quote a value for a URL path like reverse() quotes its arguments.
+    """
+    return iri_to_uri( urlquote( value, safe=RFC3986_SUBDELIMS + '/~:@' ) )
+
+
+def render_rows( data_table, reverse_name ):
+    """
+    Render the rows of a data table (see CustomSearchLayout.data_table())
+    as HTML table rows, with a link to the admin change page of each object.
+    """
+    url_prefix, url_suffix = [escape( p ) for p in reverse( reverse_name, args=[PK_PLACEHOLDER] ).split( PK_PLACEHOLDER )]
+    rows = []
+    for i, row in enumerate( data_table ):
+        rows.append( u'<tr class="row%d"><td align="center"><a href="%s%s%s" class="changelink">&nbsp;</a></td>%s</tr>' % (
+            i % 2 + 1, url_prefix, escape( _url_part( row['object_pk'] ) ), url_suffix,
+            u''.join( [u'<td>%s</td>' % format_value( v ) for v in row['values']] ),
+        ) )
+    return mark_safe( u'\n'.join( rows ) )
+
+
+def _timeout():
+    return getattr( settings, 'CUSTOMSEARCH_FRAGMENT_CACHE_TIMEOUT', 300 )
+
+
+def fragment_key( search, *params ):
+    """
+    Get the cache key of the rendered rows of a results page. The params
+    identify the page (e.g. freetext search, ordering and page number).
+    """
+    watermarks = [get_data_watermark( m ) for m in search.model.data_models()]
+    data = repr( ( watermarks, get_time_bucket( search ), params ) ).encode( 'utf8' )
+    return 'customsearch:rows:%s:%s:%s' % ( search.pk, get_search_version( search.pk ), hashlib.md5( data ).hexdigest() )
+
+
+def get_fragment( key ):
+    """
+    Get cached rendered rows, or None.
+    """
+    if not _timeout():
+        return None
+    html = get_cache().get( key )
+    return mark_safe( html ) if html is not None else None
+
+
+def set_fragment( key, html ):
+    if _timeout():
+        get_cache().set( key, force_text( html ), _timeout() )
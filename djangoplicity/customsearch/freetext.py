@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Freetext search backends.
+
+The freetext box of the search results matches the text against all fields
+of the search model with enable_freetext set. How the text is matched is
+chosen per search model (see CustomSearchModel.freetext_backend):
+
+* icontains - case-insensitive substring match on each field.
+* fulltext - PostgreSQL full-text search on a tsvector of the fields stored
+  in the table of the model, with prefix matching of each word of the text.
+  Fields on related models are still matched with icontains. The tsvector
+  can be indexed with the customsearch_fulltext_index management command,
+  which must be run again when the freetext fields of the model change. On
+  other databases the icontains backend is used.
+* index - an in-process inverted index of the fields (see invertedindex.py),
+  for databases without full-text search and for tests.
+
+The configuration of the tsvector is set with CUSTOMSEARCH_FULLTEXT_CONFIG
+(default 'simple').
+"""
+
+import operator
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, models
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.lookups import Lookup
+
+from djangoplicity.customsearch.invertedindex import search_inverted_index
+from djangoplicity.customsearch.lookups import semi_join
+
+FREETEXT_BACKENDS = (
+    ( 'icontains', 'Contains (case-insensitive)' ),
+    ( 'fulltext', 'Full-text search (PostgreSQL)' ),
+    ( 'index', 'In-process inverted index' ),
+)
+
+
+def get_fulltext_config():
+    config = getattr( settings, 'CUSTOMSEARCH_FULLTEXT_CONFIG', 'simple' )
+    if not re.match( r'^[\w.]+$', config ):
+        raise ImproperlyConfigured( "Invalid CUSTOMSEARCH_FULLTEXT_CONFIG: %r" % config )
+    return config
+
+
+def document_sql( columns, config, table=None ):
+    """
+    SQL of the tsvector of a list of columns. The index created by
+    fulltext_index_sql() is only used if the expressions are the same.
+    """
+    prefix = "%s." % table if table else ''
+    values = ["COALESCE(%s%s::text, '')" % ( prefix, column ) for column in columns]
+    return "to_tsvector('%s'::regconfig, %s)" % ( config, " || ' ' || ".join( values ) )
+
+
+def fulltext_index_name( search_model ):
+    return 'customsearch_fulltext_%s' % search_model.pk
+
+
+def fulltext_index_sql( search_model, connection ):
+    """
+    Get the SQL statements creating the full-text index of a search model,
+    or an empty list if none of its freetext fields can be indexed.
+    """
+    model = search_model.model.model_class()
+    fields = FullTextBackend().local_fields( model, [f.full_field_name() for f in search_model.customsearchfield_set.filter( enable_freetext=True )] )
+    if not fields:
+        return []
+    qn = connection.ops.quote_name
+    return [
+        'DROP INDEX CONCURRENTLY IF EXISTS %s' % qn( fulltext_index_name( search_model ) ),
+        'CREATE INDEX CONCURRENTLY %s ON %s USING gin ((%s))' % (
+            qn( fulltext_index_name( search_model ) ),
+            qn( model._meta.db_table ),
+            document_sql( [qn( f.column ) for f in fields], get_fulltext_config() ),
+        ),
+    ]
+
+
+class FullTextQuery( object ):
+    """
+    Right-hand side of the customsearch_fulltext lookup.
+    """
+    def __init__( self, columns, config, query ):
+        self.columns = columns
+        self.config = config
+        self.query = query
+
+
+class FullTextMatch( Lookup ):
+    """
+    Full-text match on columns of the table of the left-hand side, e.g.::
+
+        Q( pk__customsearch_fulltext=FullTextQuery( ['name'], 'simple', 'word:*' ) )
+    """
+    lookup_name = 'customsearch_fulltext'
+
+    def get_prep_lookup( self ):
+        return self.rhs
+
+    def as_sql( self, compiler, connection ):
+        qn = compiler.quote_name_unless_alias
+        document = document_sql( [qn( c ) for c in self.rhs.columns], self.rhs.config, qn( self.lhs.alias ) )
+        return '%s @@ to_tsquery(%%s::regconfig, %%s)' % document, [self.rhs.config, self.rhs.query]
+
+
+models.Field.register_lookup( FullTextMatch )
+
+
+class IContainsBackend( object ):
+    """
+    Match the text anywhere in any of the fields.
+    """
+    def qobjects( self, queryset, fields, freetext ):
+        model = queryset.model
+        single = [models.Q( **{ str( "%s__icontains" % f ): freetext } ) for f, relation in fields if not relation]
+        multi = [models.Q( **{ str( "%s__icontains" % f ): freetext } ) for f, relation in fields if relation]
+        if multi:
+            single.append( semi_join( model, [reduce( operator.or_, multi )] ) )
+        return single
+
+    def filter( self, queryset, fields, freetext ):
+        """
+        Filter a queryset on a list of ( lookup, relation ) tuples (see
+        SearchPlan.freetext_fields).
+        """
+        qobjects = self.qobjects( queryset, fields, freetext )
+        return queryset.filter( reduce( operator.or_, qobjects ) ) if qobjects else queryset
+
+
+class FullTextBackend( IContainsBackend ):
+    """
+    Match all words of the text as prefixes of words in the fields.
+    """
+    def local_fields( self, model, lookups ):
+        """
+        Get the fields of the model's own table among a list of lookups.
+        """
+        fields = []
+        for lookup in lookups:
+            if LOOKUP_SEP in lookup:
+                continue
+            try:
+                field = model._meta.get_field( lookup )
+            except FieldDoesNotExist:
+                continue
+            if field.concrete and not field.is_relation:
+                fields.append( field )
+        return fields
+
+    def qobjects( self, queryset, fields, freetext ):
+        words = re.findall( r'\w+', freetext, re.UNICODE )
+        local = self.local_fields( queryset.model, [f for f, relation in fields] )
+        if not words or not local or connections[queryset.db].vendor != 'postgresql':
+            return super( FullTextBackend, self ).qobjects( queryset, fields, freetext )
+
+        names = [f.name for f in local]
+        query = FullTextQuery( [f.column for f in local], get_fulltext_config(), ' & '.join( '%s:*' % w for w in words ) )
+        return [models.Q( pk__customsearch_fulltext=query )] + \
+            super( FullTextBackend, self ).qobjects( queryset, [( f, relation ) for f, relation in fields if f not in names], freetext )
+
+
+class InvertedIndexBackend( IContainsBackend ):
+    """
+    Match all words of the text with an in-process inverted index. Texts
+    matching more than CUSTOMSEARCH_FREETEXT_INDEX_MAX_PKS objects (default
+    5000) fall back to icontains rather than an unbounded IN list.
+    """
+    def qobjects( self, queryset, fields, freetext ):
+        pks = search_inverted_index( queryset.model, [f for f, relation in fields], freetext )
+        if pks is None or len( pks ) > getattr( settings, 'CUSTOMSEARCH_FREETEXT_INDEX_MAX_PKS', 5000 ):
+            return super( InvertedIndexBackend, self ).qobjects( queryset, fields, freetext )
+        return [models.Q( pk__in=pks )]
+
+
+_backends = {
+    'icontains': IContainsBackend(),
+    'fulltext': FullTextBackend(),
+    'index': InvertedIndexBackend(),
+}
+
+
+def get_freetext_backend( name ):
+    """
+    Get a freetext backend by name, defaulting to icontains.
+    """
+    return _backends.get( name, _backends['icontains'] )
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+In-process inverted index for freetext search.
+
+The index maps each word of the freetext fields of a model to the sorted
+primary keys of the objects containing it (the postings). Postings are
+stored in integer arrays when the primary key is an integer. The words
+themselves are indexed by their substrings of up to three characters, so the
+words containing a searched word (like icontains) are found without scanning
+the vocabulary. A freetext search returns the primary keys of the objects in
+which every word of the text is found, by intersecting the postings, and the
+queryset is filtered on them instead of a LIKE condition on each field.
+
+Indexes are built on first use and kept up-to-date from the post_save and
+post_delete signals of the model. Changes made by other processes, to related
+objects or with QuerySet.update() are not seen, so indexes older than
+CUSTOMSEARCH_FREETEXT_INDEX_MAX_AGE seconds (default 300, None for no limit)
+are rebuilt. Database queries are run without holding locks; a rebuilt index
+replaces the old one once it is complete. This is meant for small to medium
+sized models.
+"""
+
+from array import array
+from bisect import bisect_left, insort
+import heapq
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import models
+from django.db.models.signals import post_delete, post_save
+
+_indexes = {}
+# Inverted indexes by ( model, lookups )
+
+_lock = threading.Lock()
+# Protects _indexes and _changes
+
+_changes = {}
+# Sets of the primary keys of the objects changed while an index is built,
+# one per running build, by index key
+
+GRAM_SIZE = 3
+# Maximum length of the word substrings which are indexed
+
+
+def tokenize( value ):
+    """
+    Split a value into lower case words.
+    """
+    if value is None:
+        return []
+    if not isinstance( value, basestring ):
+        value = unicode( value )
+    return re.findall( r'\w+', value.lower(), re.UNICODE )
+
+
+def grams( word ):
+    """
+    Get the substrings of up to GRAM_SIZE characters of a word.
+    """
+    return set( word[i:i + n] for n in range( 1, GRAM_SIZE + 1 ) for i in range( len( word ) - n + 1 ) )
+
+
+def _union( postings ):
+    """
+    Merge sorted lists of primary keys into one sorted list.
+    """
+    if len( postings ) == 1:
+        return postings[0]
+    result = []
+    for pk in heapq.merge( *postings ):
+        if not result or result[-1] != pk:
+            result.append( pk )
+    return result
+
+
+def _intersect( a, b ):
+    """
+    Intersect two sorted lists of primary keys, a being the shortest.
+    """
+    result = []
+    i = 0
+    for pk in a:
+        i = bisect_left( b, pk, i )
+        if i == len( b ):
+            break
+        if b[i] == pk:
+            result.append( pk )
+    return result
+
+
+class InvertedIndex( object ):
+    """
+    Inverted index of a list of field lookups of a model.
+    """
+    def __init__( self, model, lookups ):
+        self.model = model
+        self.lookups = list( lookups )
+        self.integer_pks = isinstance( model._meta.pk, ( models.AutoField, models.IntegerField ) )
+        self.postings = {}
+        self.documents = {}
+        self.grams = {}
+        self.built = None
+        self.lock = threading.Lock()
+
+    def _postings( self, pks ):
+        return array( 'l', pks ) if self.integer_pks else list( pks )
+
+    def _documents( self, queryset ):
+        """
+        Get the set of words of each object of a queryset.
+        """
+        documents = {}
+        # One query per lookup, so multi-valued lookups do not multiply rows
+        for lookup in self.lookups:
+            for pk, value in queryset.values_list( 'pk', lookup ).iterator():
+                words = tokenize( value )
+                if words:
+                    documents.setdefault( pk, set() ).update( words )
+                else:
+                    documents.setdefault( pk, set() )
+        return documents
+
+    def expired( self ):
+        max_age = getattr( settings, 'CUSTOMSEARCH_FREETEXT_INDEX_MAX_AGE', 300 )
+        return self.built is None or ( max_age is not None and time.time() - self.built > max_age )
+
+    def build( self ):
+        built = time.time()
+        documents = self._documents( self.model._default_manager.all() )
+        postings = {}
+        for pk, words in documents.items():
+            for word in words:
+                postings.setdefault( word, [] ).append( pk )
+        self.postings = dict( ( word, self._postings( sorted( pks ) ) ) for word, pks in postings.items() )
+        self.documents = dict( ( pk, frozenset( words ) ) for pk, words in documents.items() )
+        self.grams = {}
+        for word in self.postings:
+            self._add_word( word )
+        self.built = built
+
+    def _add_word( self, word ):
+        for gram in grams( word ):
+            self.grams.setdefault( gram, set() ).add( word )
+
+    def _remove_word( self, word ):
+        for gram in grams( word ):
+            words = self.grams[gram]
+            words.discard( word )
+            if not words:
+                del self.grams[gram]
+
+    def _remove( self, pk ):
+        for word in self.documents.pop( pk, () ):
+            pks = self.postings[word]
+            i = bisect_left( pks, pk )
+            if i < len( pks ) and pks[i] == pk:
+                pks.pop( i )
+            if not pks:
+                del self.postings[word]
+                self._remove_word( word )
+
+    def remove( self, pk ):
+        with self.lock:
+            self._remove( pk )
+
+    def update( self, pk ):
+        """
+        Re-index an object after it was saved.
+        """
+        words = self._documents( self.model._default_manager.filter( pk=pk ) ).get( pk )
+        with self.lock:
+            self._remove( pk )
+            if words is None:
+                return
+            self.documents[pk] = frozenset( words )
+            for word in words:
+                if word not in self.postings:
+                    self.postings[word] = self._postings( [] )
+                    self._add_word( word )
+                insort( self.postings[word], pk )
+
+    def _words( self, word ):
+        """
+        Get the indexed words containing a word.
+        """
+        if len( word ) <= GRAM_SIZE:
+            return list( self.grams.get( word, () ) )
+        candidates = sorted( [self.grams.get( word[i:i + GRAM_SIZE], () ) for i in range( len( word ) - GRAM_SIZE + 1 )], key=len )
+        return [w for w in candidates[0] if word in w and all( w in c for c in candidates[1:] )]
+
+    def search( self, text ):
+        """
+        Get the sorted primary keys of the objects containing all words of
+        the text, or None if the text contains no words. Like icontains, a
+        word also matches longer words containing it.
+        """
+        words = tokenize( text )
+        if not words:
+            return None
+        with self.lock:
+            postings = []
+            for word in set( words ):
+                matches = self._words( word )
+                if not matches:
+                    return []
+                postings.append( _union( [self.postings[w] for w in matches] ) )
+
+        postings.sort( key=len )
+        result = postings[0]
+        for pks in postings[1:]:
+            result = _intersect( result, pks )
+            if not result:
+                break
+        return list( result )
+
+
+def get_inverted_index( model, lookups ):
+    """
+    Get the inverted index of a list of field lookups of a model, building it
+    if needed. The index is built without holding the lock, so searches on
+    the current index can go on meanwhile.
+    """
+    key = ( model, tuple( lookups ) )
+    changed = set()
+    with _lock:
+        index = _indexes.get( key )
+        if index is not None and not index.expired():
+            return index
+        _changes.setdefault( key, [] ).append( changed )
+    _connect( model )
+
+    index = InvertedIndex( model, lookups )
+    try:
+        index.build()
+    except Exception:
+        with _lock:
+            _end_build( key, changed )
+        raise
+    # Later changes are applied to the index by _object_changed()
+    with _lock:
+        _end_build( key, changed )
+        _indexes[key] = index
+
+    # Objects saved while the index was built may not be included
+    for pk in changed:
+        index.update( pk )
+    return index
+
+
+def _end_build( key, changed ):
+    """
+    Stop recording the changes for a build. Must be called with the lock held.
+    """
+    builds = [c for c in _changes[key] if c is not changed]
+    if builds:
+        _changes[key] = builds
+    else:
+        del _changes[key]
+
+
+def search_inverted_index( model, lookups, text ):
+    return get_inverted_index( model, lookups ).search( text )
+
+
+def invalidate_inverted_indexes():
+    """
+    Drop all inverted indexes, e.g. when the freetext fields change.
+    """
+    with _lock:
+        _indexes.clear()
+
+
+def _connect( model ):
+    """
+    Connect the signal handlers keeping the indexes of a model up-to-date.
+    """
+    uid = 'customsearch-invertedindex-%s.%s' % ( model._meta.app_label, model._meta.model_name )
+    post_save.connect( _object_changed, sender=model, dispatch_uid=uid )
+    post_delete.connect( _object_changed, sender=model, dispatch_uid=uid )
+
+
+def _object_changed( sender, instance, signal, **kwargs ):
+    with _lock:
+        for key, builds in _changes.items():
+            if key[0] is sender:
+                for changed in builds:
+                    changed.add( instance.pk )
+        indexes = [index for key, index in _indexes.items() if key[0] is sender]
+    for index in indexes:
+        if signal is post_delete:
+            index.remove( instance.pk )
+        else:
+            index.update( instance.pk )
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+"""
+JSON representation of search results.
+
+Results are paginated with a cursor (see pagination.KeysetPaginator), and
+can be restricted to some of the layout columns, identified by the full
+field name of their field (e.g. 'author__name'). Rows are read with the
+compiled layout plan, with values_list() if all selected columns are
+database fields.
+"""
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError
+
+from djangoplicity.customsearch.pagination import KeysetPaginator
+
+
+class ResultsJSONEncoder( DjangoJSONEncoder ):
+    """
+    JSON encoder which encodes unknown values (e.g. related objects of
+    columns which are not projected) as text.
+    """
+    def default( self, o ):
+        try:
+            return super( ResultsJSONEncoder, self ).default( o )
+        except TypeError:
+            return unicode( o )
+
+
+def search_results( search, searchval=None, ordering=None, ordering_direction=None, cursor=None, per_page=100, fields=None ):
+    """
+    Get a page of the results of a search as a dictionary which can be
+    encoded with ResultsJSONEncoder. Raises KeyError if fields contains a
+    field which is not in the layout of the search, and ValueError if the
+    cursor does not fit the ordering or the search query fails.
+    """
+    plan = search.layout.get_plan()
+    layout_table = table = plan.bind()
+    if fields:
+        plan = plan.select( fields )
+        table = layout_table.select( plan )
+
+    # The ordering refers to the columns of the whole layout
+    ( search, qs, searchval, _error, _header, ordering, ordering_direction ) = search.get_results_queryset(
+        searchval=searchval, ordering=ordering, ordering_direction=ordering_direction, evaluate=False, table=layout_table )
+
+    # A cursor which does not fit the ordering raises InvalidCursor, a
+    # ValueError
+    try:
+        page = KeysetPaginator( qs, per_page ).page( cursor )
+        rows = list( search.layout.iter_data_table( page.object_list, projection=True, plan=plan, table=table ) )
+    except DatabaseError, e:
+        raise ValueError( unicode( e ) )
+
+    return {
+        'search': { 'id': search.pk, 'name': search.name },
+        'searchval': searchval,
+        'ordering': ordering,
+        'ordering_direction': ordering_direction,
+        'columns': [{ 'name': name, 'field': field.full_field_name() } for field, name, _field_name in table.header],
+        'results': [{ 'pk': pk, 'values': values } for pk, values in rows],
+        'next': page.next_cursor,
+        'previous': page.previous_cursor,
+    }
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Compiled layout plans.
+
+Resolving a layout field into something that can be read from a model
+instance requires model introspection (content type lookup, ``_meta.get_field()``,
+relation checks and selector parsing). A layout plan does this work once per
+layout and keeps a list of typed columns, so rendering a row only needs
+attribute access.
+
+Plans are cached per process, keyed by the version of the layout, which
+changes when the layout, its fields or the search fields are saved or deleted
+(see versions.py and the signal handlers in models.py). Processes compile
+a plan again once they see a new version, or after
+CUSTOMSEARCH_PLAN_CACHE_TIMEOUT seconds.
+"""
+
+from django.db.models import prefetch_related_objects
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.fields.related import ForeignObjectRel
+from itertools import islice
+import time
+
+from djangoplicity.customsearch.versions import bump_layout_versions, get_layout_version, get_plan_timeout
+
+_plans = {}
+# Cache of ( version, compiled layout plan, expiry time ) tuples indexed by
+# layout primary key
+
+
+class LayoutColumn( object ):
+    """
+    Base class for a column in a layout plan.
+    """
+    def __init__( self, field, field_object=None, accessor=None, expand=False ):
+        self.field = field
+        self.field_object = field_object
+        self.accessor = accessor or field.field_name
+        self.expand = expand
+
+    def header( self ):
+        return [( self.field, self.field.name, self.field.field_name )]
+
+    def values( self, obj ):
+        raise NotImplementedError
+
+    def bind( self ):
+        """
+        Prepare the column for rendering one table. Returns a tuple of
+        the header entries and a function returning the column values
+        for an object.
+        """
+        return ( self.header(), self.values )
+
+    def select_related( self ):
+        """
+        Lookups which should be passed to QuerySet.select_related()
+        """
+        return []
+
+    def projection( self ):
+        """
+        Field lookup which can be passed to QuerySet.values_list() to
+        read the column value, or None if the column needs a model instance.
+        """
+        return None
+
+    def value_field( self ):
+        """
+        Model field of the column values, or None if unknown.
+        """
+        return None
+
+    def prefetch_related( self ):
+        """
+        Lookups which should be passed to QuerySet.prefetch_related()
+        """
+        return []
+
+
+class PropertyColumn( LayoutColumn ):
+    """
+    Column for an attribute which is not a model field (e.g. a property()).
+    """
+    def values( self, obj ):
+        return [getattr( obj, self.accessor )]
+
+
+class ValueColumn( LayoutColumn ):
+    """
+    Column for a plain or foreign key field. If the column is expanded, the
+    first part of the selector is followed on the related object.
+    """
+    def __init__( self, field, field_object=None, accessor=None, expand=False ):
+        super( ValueColumn, self ).__init__( field, field_object=field_object, accessor=accessor, expand=expand )
+        self.attr = field.selector.split( '__' )[1] if expand and field.selector.startswith( '__' ) else None
+
+    def values( self, obj ):
+        result = getattr( obj, self.accessor )
+        if self.attr and result:
+            result = getattr( result, self.attr )
+        return [result]
+
+    def select_related( self ):
+        if not _is_single_relation( self.field_object ):
+            return []
+
+        path = self.accessor
+        if self.attr:
+            # Follow the selector as well if it points to another relation
+            # (e.g. author__country).
+            try:
+                if _is_single_relation( self.field_object.related_model._meta.get_field( self.attr ) ):
+                    path = "%s__%s" % ( path, self.attr )
+            except FieldDoesNotExist:
+                pass
+        return [path]
+
+    def projection( self ):
+        if not self.field_object.is_relation:
+            return self.accessor
+        elif self.attr and _is_single_relation( self.field_object ):
+            try:
+                if not self.field_object.related_model._meta.get_field( self.attr ).is_relation:
+                    return "%s__%s" % ( self.accessor, self.attr )
+            except FieldDoesNotExist:
+                pass
+        return None
+
+    def value_field( self ):
+        if not self.field_object.is_relation:
+            return self.field_object
+        elif self.attr and self.field_object.related_model is not None:
+            try:
+                field_object = self.field_object.related_model._meta.get_field( self.attr )
+                if not field_object.is_relation:
+                    return field_object
+            except FieldDoesNotExist:
+                pass
+        return None
+
+
+class RelatedColumn( LayoutColumn ):
+    """
+    Column for a many-to-many or reverse relation, rendered as a list of
+    quoted values separated by semicolons.
+    """
+    def values( self, obj ):
+        tmp = "\";\"".join( [unicode( x ).replace( '"', '""' ) for x in getattr( obj, self.accessor ).all()] )
+        return [ '"%s"' % tmp if tmp else "" ]
+
+    def prefetch_related( self ):
+        return [self.accessor]
+
+
+class ExpandedRelatedColumn( LayoutColumn ):
+    """
+    Column for a many-to-many or reverse relation, expanded into one column
+    per object of the related model.
+    """
+    def header( self ):
+        return self.bind()[0]
+
+    def bind( self ):
+        # The related objects (i.e. the columns) are fetched once per
+        # table, and each cell is a lookup in the set of related primary
+        # keys of the row.
+        remote = list( self.field_object.related_model.objects.all() )
+        remote_pks = [v.pk for v in remote]
+        accessor = self.accessor
+
+        def values( obj ):
+            rels = set( [v.pk for v in getattr( obj, accessor ).all()] )
+            return [ "X" if pk in rels else "" for pk in remote_pks ]
+
+        header = [( self.field, "%s: %s" % ( self.field.name, unicode( v ) ), "%s:%s" % ( self.field.field_name, v.pk ) ) for v in remote]
+        return ( header, values )
+
+    def values( self, obj ):
+        return self.bind()[1]( obj )
+
+    def prefetch_related( self ):
+        return [self.accessor]
+
+
+class LayoutPlan( object ):
+    """
+    Precomputed list of columns for a layout.
+    """
+    def __init__( self, columns ):
+        self.columns = columns
+        self.select_related = _unique( sum( [c.select_related() for c in columns], [] ) )
+        self.prefetch_related = _unique( sum( [c.prefetch_related() for c in columns], [] ) )
+
+        projection = [c.projection() for c in columns]
+        self.projectable = None not in projection
+        if self.projectable:
+            self._values_fields = _unique( projection )
+            self._values_index = [self._values_fields.index( p ) + 1 for p in projection]
+
+    def optimize_queryset( self, qs, prefetch=True ):
+        """
+        Add the select_related() and prefetch_related() lookups needed
+        to render the layout to a queryset.
+        """
+        if self.select_related:
+            qs = qs.select_related( *self.select_related )
+        if prefetch and self.prefetch_related:
+            qs = qs.prefetch_related( *self.prefetch_related )
+        return qs
+
+    def prefetch( self, objects ):
+        """
+        Prefetch related objects for a list of model instances (e.g. a
+        chunk read with QuerySet.iterator()).
+        """
+        if self.prefetch_related and objects:
+            prefetch_related_objects( objects, *self.prefetch_related )
+
+    def iter_values( self, qs ):
+        """
+        Read the rows of a queryset with values_list() instead of model
+        instances, yielding ( pk, values ) tuples. Only possible if the
+        plan is projectable, i.e. all columns are database fields.
+        """
+        index = self._values_index
+        for t in qs.prefetch_related( None ).values_list( 'pk', *self._values_fields ).iterator():
+            yield ( t[0], [t[i] for i in index] )
+
+    def bind( self ):
+        """
+        Bind the plan to a single table (see LayoutTable).
+        """
+        return LayoutTable( self.columns, [c.bind() for c in self.columns] )
+
+    def header( self ):
+        return self.bind().header
+
+    def select( self, field_names ):
+        """
+        Get a plan with only the columns of the given fields (see
+        CustomSearchField.full_field_name()), in the given order. Raises
+        KeyError for fields which are not in the plan.
+        """
+        columns = dict( ( c.field.full_field_name(), c ) for c in self.columns )
+        return LayoutPlan( [columns[name] for name in field_names] )
+
+    def value_fields( self, header ):
+        """
+        Get the model field of the values of each entry of a header (see
+        header()), or None if unknown.
+        """
+        fields = dict( ( c.field.pk, c.value_field() ) for c in self.columns )
+        return [fields.get( field.pk ) for field, _name, _field_name in header]
+
+
+class LayoutTable( object ):
+    """
+    A layout plan bound to one table. Data shared by all rows, such as the
+    related objects of expanded columns, is only fetched once.
+    """
+    def __init__( self, columns, bound_columns ):
+        self._bound = dict( zip( columns, bound_columns ) )
+        self.header = []
+        self._extractors = []
+        for header, values in bound_columns:
+            self.header += header
+            self._extractors.append( values )
+
+    def select( self, plan ):
+        """
+        Get the table of a plan with a subset of the columns (see
+        LayoutPlan.select()), without binding the columns again.
+        """
+        return LayoutTable( plan.columns, [self._bound[c] for c in plan.columns] )
+
+    def row( self, obj ):
+        row = []
+        for values in self._extractors:
+            row += values( obj )
+        return row
+
+
+def _is_single_relation( field_object ):
+    return field_object.concrete and ( field_object.many_to_one or field_object.one_to_one )
+
+
+def _unique( lookups ):
+    seen = set()
+    return [l for l in lookups if not ( l in seen or seen.add( l ) )]
+
+
+def chunked( iterable, size ):
+    """
+    Split an iterable into lists of at most size elements.
+    """
+    iterator = iter( iterable )
+    while True:
+        chunk = list( islice( iterator, size ) )
+        if not chunk:
+            return
+        yield chunk
+
+
+def compile_column( modelcls, field, expand=False ):
+    """
+    Resolve a CustomSearchField into a layout column for the given model class.
+    """
+    try:
+        field_object = modelcls._meta.get_field( field.field_name )
+    except FieldDoesNotExist:
+        # The field is most likely a property()
+        return PropertyColumn( field )
+
+    accessor = field.field_name
+    multiple = field_object.many_to_many
+    if isinstance( field_object, ForeignObjectRel ):
+        multiple = True
+        accessor = field_object.get_accessor_name()
+
+    if multiple and expand:
+        return ExpandedRelatedColumn( field, field_object, accessor, expand )
+    elif multiple:
+        return RelatedColumn( field, field_object, accessor, expand )
+    else:
+        return ValueColumn( field, field_object, accessor, expand )
+
+
+def compile_layout( layout ):
+    """
+    Compile a CustomSearchLayout into a LayoutPlan.
+    """
+    modelcls = layout.model.model.model_class()
+    return LayoutPlan( [
+        compile_column( modelcls, f.field, expand=f.expand_rel ) for f in layout.customsearchlayoutfield_set.all().select_related( 'field' )
+    ] )
+
+
+def get_layout_plan( layout ):
+    """
+    Get the compiled plan for a layout from the cache, or compile it if
+    the layout version changed.
+    """
+    version = get_layout_version( layout.pk )
+
+    cached = _plans.get( layout.pk )
+    if cached is not None and cached[0] == version and cached[2] > time.time():
+        return cached[1]
+
+    plan = compile_layout( layout )
+    _plans[layout.pk] = ( version, plan, time.time() + get_plan_timeout() )
+    return plan
+
+
+def invalidate_layout_plan( layout_pks ):
+    """
+    Give layouts a new version, so their plans are compiled again by all
+    processes.
+    """
+    bump_layout_versions( layout_pks )
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Field lookup helpers and custom lookups used by compiled searches.
+"""
+
+from django.db import models
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.lookups import In
+
+
+class UpperIn( In ):
+    """
+    Case-insensitive IN lookup, i.e. the equivalent of several iexact
+    lookups ORed together::
+
+        UPPER( field ) IN ( UPPER( %s ), UPPER( %s ), ... )
+    """
+    lookup_name = 'iin'
+
+    def process_lhs( self, compiler, connection, lhs=None ):
+        sql, params = super( UpperIn, self ).process_lhs( compiler, connection, lhs )
+        return 'UPPER(%s)' % sql, params
+
+    def batch_process_rhs( self, compiler, connection, rhs=None ):
+        sqls, params = super( UpperIn, self ).batch_process_rhs( compiler, connection, rhs )
+        return ['UPPER(%s)' % sql for sql in sqls], params
+
+
+models.CharField.register_lookup( UpperIn )
+models.TextField.register_lookup( UpperIn )
+
+
+def resolve_lookup( model, lookup ):
+    """
+    Resolve a field lookup such as groups__name__icontains into a tuple
+    ( relation, field ). relation is the path of the first multi-valued
+    relation (many-to-many or reverse foreign key) crossed by the lookup, or
+    None if the lookup is single-valued. field is the last model field of the
+    lookup.
+    """
+    opts = model._meta
+    path = []
+    relation = None
+    field = None
+    for part in lookup.split( LOOKUP_SEP ):
+        try:
+            field = opts.get_field( part )
+        except FieldDoesNotExist:
+            # A lookup type, transform or 'pk'
+            break
+        path.append( part )
+        if not field.is_relation:
+            break
+        if relation is None and ( field.many_to_many or field.one_to_many ):
+            relation = LOOKUP_SEP.join( path )
+        opts = field.related_model._meta
+    return ( relation, field )
+
+
+def semi_join( model, qobjects ):
+    """
+    Get a Q object matching the objects of model that match all qobjects,
+    using a subquery instead of a JOIN.
+    """
+    return models.Q( pk__in=model._default_manager.filter( *qobjects ).values( 'pk' ) )
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Create the full-text indexes of the search models using the fulltext
+freetext backend (see freetext.py).
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from djangoplicity.customsearch.freetext import fulltext_index_sql
+from djangoplicity.customsearch.models import CustomSearchModel
+
+
+class Command( BaseCommand ):
+    help = 'Create or rebuild the full-text indexes of custom search models.'
+
+    def add_arguments( self, parser ):
+        parser.add_argument( 'models', nargs='*', type=int, help='Primary keys of the search models (default: all using the fulltext backend)' )
+
+    def handle( self, *args, **options ):
+        if connection.vendor != 'postgresql':
+            raise CommandError( 'Full-text indexes are only supported on PostgreSQL.' )
+
+        search_models = CustomSearchModel.objects.filter( freetext_backend='fulltext' )
+        if options['models']:
+            search_models = search_models.filter( pk__in=options['models'] )
+
+        cursor = connection.cursor()
+        for search_model in search_models:
+            statements = fulltext_index_sql( search_model, connection )
+            if not statements:
+                self.stdout.write( 'Skipping %s: no freetext fields to index' % search_model )
+                continue
+            self.stdout.write( 'Indexing %s' % search_model )
+            for sql in statements:
+                cursor.execute( sql )
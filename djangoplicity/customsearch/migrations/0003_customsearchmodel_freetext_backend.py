@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customsearch', '0002_customsearchcondition_and_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customsearchmodel',
+            name='freetext_backend',
+            field=models.CharField(choices=[(b'icontains', b'Contains (case-insensitive)'), (b'fulltext', b'Full-text search (PostgreSQL)')], default=b'icontains', help_text=b'How the freetext search box matches the freetext fields.', max_length=30),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customsearch', '0004_alter_customsearchmodel_freetext_backend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customsearch',
+            name='async_results',
+            field=models.BooleanField(default=False, help_text=b'Compute the results in the background instead of during the request, for expensive searches. Requires the result cache.'),
+        ),
+    ]
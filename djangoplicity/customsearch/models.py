@@ -45,13 +45,20 @@ used for e.g. label generation if djangoplicity-contacts is installed.
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.admin.utils import quote
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import DatabaseError, models, transaction
 from django.db.models.aggregates import Max, Min
 from django.db.models.fields import FieldDoesNotExist
-from django.db.models.fields.related import ForeignObjectRel
+from django.db.models.functions import Now
+from django.db.models.query import QuerySet
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from djangoplicity.customsearch.freetext import FREETEXT_BACKENDS
+from djangoplicity.customsearch.invertedindex import invalidate_inverted_indexes
+from djangoplicity.customsearch.layout import chunked, get_layout_plan, invalidate_layout_plan
+from djangoplicity.customsearch.query import compile_ordering, get_search_plan
+from djangoplicity.customsearch.versions import bump_data_watermark, bump_search_versions
 
 from datetime import datetime
-import operator
 
 MATCH_TYPE = (
     ( '__exact', 'Exact' ),
@@ -78,6 +85,9 @@ MATCH_TYPE = (
 )
 # List of allowed field loookup types
 
+ITERATOR_CHUNK_SIZE = 2000
+# Number of rows fetched per round-trip when streaming a result set
+
 
 class CustomSearchGroup( models.Model ):
     """
@@ -95,6 +105,56 @@ class CustomSearchModel( models.Model ):
     """
     name = models.CharField( max_length=255 )
     model = models.ForeignKey( ContentType )
+    freetext_backend = models.CharField( max_length=30, choices=FREETEXT_BACKENDS, default='icontains', help_text='How the freetext search box matches the freetext fields.' )
+
+    def data_models( self ):
+        """
+        Get the models whose data is shown by searches on this model: the
+        model itself and the related models of its fields (see
+        versions.get_data_watermark()).
+        """
+        modelcls = self.model.model_class()
+        if modelcls is None:
+            return []
+
+        result = [modelcls]
+        for field in self.customsearchfield_set.all():
+            try:
+                related = modelcls._meta.get_field( field.field_name ).related_model
+                if related is not None and field.selector:
+                    # Follow the selector if it points to another relation
+                    try:
+                        related = related._meta.get_field( field.selector.split( '__' )[1] ).related_model or related
+                    except FieldDoesNotExist:
+                        pass
+            except FieldDoesNotExist:
+                continue
+            if related is not None and related not in result:
+                result.append( related )
+        return result
+
+    def through_models( self ):
+        """
+        Get the intermediary models of the many-to-many fields of this
+        model, whose changes are tracked like those of the data models.
+        """
+        modelcls = self.model.model_class()
+        if modelcls is None:
+            return []
+
+        result = []
+        for field in self.customsearchfield_set.all():
+            try:
+                modelfield = modelcls._meta.get_field( field.field_name )
+            except FieldDoesNotExist:
+                continue
+            if modelfield.many_to_many:
+                # Forward fields have the through model on their remote
+                # field, reverse relations on themselves
+                through = modelfield.remote_field.through if isinstance( modelfield, models.ManyToManyField ) else modelfield.through
+                if through not in result:
+                    result.append( through )
+        return result
 
     def __unicode__( self ):
         return self.name
@@ -140,79 +200,92 @@ class CustomSearchLayout( models.Model ):
     name = models.CharField( max_length=255 )
     fields = models.ManyToManyField( CustomSearchField, through='CustomSearchLayoutField' )
 
+    def get_plan( self ):
+        """
+        Get the compiled layout plan (see djangoplicity.customsearch.layout).
+        """
+        return get_layout_plan( self )
+
     def header( self ):
         """
         """
-        header = []
-        for f in CustomSearchLayoutField.objects.filter( layout=self ).select_related():
-            header += self._get_header_value( f.field, expand=f.expand_rel )
-        return header
+        return self.get_plan().header()
+
+    def bind( self ):
+        """
+        Bind the layout plan to one table (see layout.LayoutTable). The
+        related objects of expanded columns are fetched once, so a table
+        should be used for both the header and the rows of a request.
+        """
+        return self.get_plan().bind()
 
-    def data_table( self, queryset, quote_obj_pks=False ):
+    def data_table( self, queryset, quote_obj_pks=False, projection=False, table=None ):
         """
+        If projection is True and all layout columns are database fields,
+        the rows are read with values_list() and 'object' is None. The rows
+        are rendered with the given bound table (see bind()) if any.
         """
         data = []
-        layout_qs = CustomSearchLayoutField.objects.filter( layout=self ).select_related()
+        plan = self.get_plan()
 
-        for obj in queryset:
-            row = []
-            for f in layout_qs:
-                row += self._get_field_value( obj, f.field, expand=f.expand_rel )
-            data.append( { 'object': obj, 'values': row, 'object_pk': quote(obj.pk) if quote_obj_pks else obj.pk} )
+        if projection and plan.projectable and isinstance( queryset, QuerySet ):
+            for pk, values in plan.iter_values( queryset ):
+                data.append( { 'object': None, 'values': values, 'object_pk': quote( pk ) if quote_obj_pks else pk } )
+            return data
+
+        # Sliced querysets (e.g. a paginator page) must already include
+        # select_related() - see get_results_queryset().
+        if isinstance( queryset, QuerySet ) and queryset._result_cache is None and queryset.query.can_filter():
+            queryset = plan.optimize_queryset( queryset )
+
+        objects = list( queryset )
+        if not ( isinstance( queryset, QuerySet ) and queryset._prefetch_related_lookups ):
+            plan.prefetch( objects )
+
+        row = ( table if table is not None else plan.bind() ).row
+        for obj in objects:
+            data.append( { 'object': obj, 'values': row( obj ), 'object_pk': quote(obj.pk) if quote_obj_pks else obj.pk} )
 
         return data
 
-    def _get_field_value( self, obj, field, expand=False ):
-        modelcls = self.model.model.model_class()
-        try:
-            field_object = modelcls._meta.get_field( field.field_name )
-        except FieldDoesNotExist:
-            # The field is most likely a property()
-            return [getattr(obj, field.field_name)]
-
-        m2m = field_object.many_to_many
-
-        # Get accessor value
-        accessor = field.field_name
-        if isinstance( field_object, ForeignObjectRel ):
-            m2m = True
-            accessor = field_object.get_accessor_name()
-
-        if m2m and expand:
-            rels = getattr( obj, accessor ).all()
-
-            cols = []
-            for v in field_object.remote_field.model.objects.all():
-                if v in rels:
-                    cols.append( "X" )
-                else:
-                    cols.append( "" )
-            return cols
-        elif m2m and not expand:
-            tmp = "\";\"".join( [unicode( x ).replace( '"', '""' ) for x in getattr( obj, accessor ).all()] )
-            return [ '"%s"' % tmp if tmp else "" ]
-        else:
-            result = getattr( obj, accessor )
-            if expand and result and field.selector.startswith('__'):
-                result = getattr( result, field.selector.split('__')[1] )
-            return [result]
+    def iter_data_table( self, queryset, quote_obj_pks=False, chunk_size=ITERATOR_CHUNK_SIZE, projection=False, plan=None, table=None ):
+        """
+        Generator version of data_table() for bulk consumers such as exports.
 
-    def _get_header_value( self, field, expand=False ):
-        modelcls = self.model.model.model_class()
-        try:
-            field_object = modelcls._meta.get_field( field.field_name )
-        except FieldDoesNotExist:
-            # The field is most likely a property()
-            return [(field, field.name, field.field_name)]
-
-        if field_object.many_to_many and expand:
-            if not field_object.auto_created or field_object.concrete:
-                cols = []
-                for v in field_object.remote_field.model.objects.all():
-                    cols.append( ( field, "%s: %s" % ( field.name, unicode( v ) ), "%s:%s" % ( field.field_name, v.pk ) ) )
-                return cols
+        The queryset is read in chunks through a server-side cursor and
+        only a ( object_pk, values ) tuple is yielded per row, so model
+        instances can be garbage collected as soon as their row is built.
+
+        A plan with a subset of the columns (see LayoutPlan.select()) can be
+        given instead of the layout plan, and a table bound from the plan
+        (see bind()) to share it with the header.
+        """
+        if plan is None:
+            plan = self.get_plan()
+
+        if projection and plan.projectable and isinstance( queryset, QuerySet ):
+            for pk, values in plan.iter_values( queryset ):
+                yield ( quote( pk ) if quote_obj_pks else pk, values )
+            return
+
+        row = ( table if table is not None else plan.bind() ).row
+
+        if isinstance( queryset, QuerySet ):
+            queryset = plan.optimize_queryset( queryset.prefetch_related( None ), prefetch=False )
+            try:
+                objects = queryset.iterator( chunk_size=chunk_size )
+            except TypeError:
+                # Django < 2.0 uses a fixed chunk size
+                objects = queryset.iterator()
         else:
-            return [( field, field.name, field.field_name )]
+            objects = iter( queryset )
+
+        # iterator() ignores prefetch_related(), so related objects are
+        # prefetched for one chunk of instances at a time.
+        for chunk in chunked( objects, chunk_size ):
+            plan.prefetch( chunk )
+            for obj in chunk:
+                yield ( quote( obj.pk ) if quote_obj_pks else obj.pk, row( obj ) )
 
     def __unicode__( self ):
         return "%s: %s" % ( self.model.name, self.name, )
@@ -242,6 +315,7 @@ class CustomSearch( models.Model ):
     model = models.ForeignKey( CustomSearchModel )
     group = models.ForeignKey( CustomSearchGroup, blank=True, null=True )
     layout = models.ForeignKey( CustomSearchLayout )
+    async_results = models.BooleanField( default=False, help_text="Compute the results in the background instead of during the request, for expensive searches. Requires the result cache." )
 
     class Meta:
         verbose_name_plural = 'custom searches'
@@ -322,7 +396,7 @@ class CustomSearch( models.Model ):
         if self.model_id and self.layout_id and self.model != self.layout.model:
             raise ValidationError( 'Layout %s does not belong to %s' % ( self.layout, self.model.name ) )
 
-    def _collect_search_conds( self ):
+    def _collect_search_conds( self, expressions=False ):
         include = {}
         exclude = {}
 
@@ -334,7 +408,7 @@ class CustomSearch( models.Model ):
                     'values': [],
                     'and_together': c.and_together,
                 }
-            tmp[c.field]['values'].append(( c.match, c.prepared_value() ))
+            tmp[c.field]['values'].append(( c.match, c.prepared_value( expressions=expressions ) ))
 
         return ( include, exclude )
 
@@ -342,11 +416,13 @@ class CustomSearch( models.Model ):
         modelclass = self.model.model.model_class()
         return modelclass.objects.none()
 
-    def get_results_queryset( self, searchval=None, ordering=None, ordering_direction=None, evaluate=True ):
+    def get_results_queryset( self, searchval=None, ordering=None, ordering_direction=None, evaluate=True, table=None ):
         """
-        Get the queryset for the selected custom search.
+        Get the queryset for the selected custom search. The header is taken
+        from the given bound layout table (see CustomSearchLayout.bind()) if
+        any.
         """
-        header = self.layout.header()
+        header = ( table if table is not None else self.layout.bind() ).header
 
         search_ordering = None
 
@@ -365,6 +441,7 @@ class CustomSearch( models.Model ):
             ordering_direction = None
 
         qs = self.get_queryset( freetext=searchval, override_ordering=search_ordering )
+        qs = self.layout.get_plan().optimize_queryset( qs )
 
         if evaluate:
             try:
@@ -382,77 +459,11 @@ class CustomSearch( models.Model ):
         """
         Execute the custom search
         """
-        # Collect all search conditions
-        include, exclude = self._collect_search_conds()
-
-        # Create Q objects for all conditions
-        include_queries = []
-        exclude_queries = []
-
-        # Generate queryset for search.
-        modelclass = self.model.model.model_class()
-        qs = modelclass.objects.all()
-
-        for field, values in include.items():
-            # By default we use OR, but if at least the first values' and_together
-            # is true then we user multiple filter():
-
-            if values['and_together']:
-                for match, val in values['values']:
-                    qs = qs.filter(**{ str("%s%s" % ( field.full_field_name(), match )): val })
-            else:
-                include_queries.append( reduce( operator.or_, [models.Q( **{ str("%s%s" % ( field.full_field_name(), match )): val } ) for ( match, val ) in values['values']] ) )
-
-        # TODO: implement and_together for exclude
-
-        for field, values in exclude.items():
-            exclude_queries.append( reduce( operator.or_, [models.Q( **{ str("%s%s" % ( field.full_field_name(), match )): val } ) for ( match, val ) in values['values']] ) )
-
-        if include_queries:
-            #  include queries are ANDed together, unless a same criterium is
-            #  repeated in which case the criterium value are ORed, e.g.:
-            #    contacts__country=Germany, contacts__group=Messenger, contacts_group=epodpress
-            #  would result in:
-            #    contacts__country=Germany AND (contacts__group=Messenger OR contact_groups=epodpress)
-            qs = qs.filter( *include_queries )
-        if exclude_queries:
-            # exclude queries are ORed togethere, e.g.:
-            #   contacts__city='', contacts__group=Messenger, contacts_group=epodpress
-            # would result in:
-            #   contacts__city='' OR contacts__group=Messenger OR contacts_group=epodpress
-            qs = qs.exclude( reduce( operator.or_, exclude_queries ) )
-
-        # Free text search in result set
-        if freetext:
-            qobjects = []
-            for f in CustomSearchField.objects.filter( model=self.model, enable_freetext=True ):
-                arg = "%s__icontains" % f.full_field_name()
-                qobjects.append( models.Q( **{ str( arg ): freetext } ) )
-            qs = qs.filter( reduce( operator.or_, qobjects ) )
-        qs = qs.distinct()
-
-        # Ordering
-        # ========
-        # NOTE: distinct() and order_by() does not work well together (https://docs.djangoproject.com/en/1.3/ref/models/querysets/#distinct).
-        # If you order by a related field (e.g. groups__name) then groups__name is included in the SELECT columns (e.g SELECT first_name, ..., contact_groups.name).
-        # This means that distinct() method (akak SELECT DISTINCT) will no longer be able to detect duplicate Contact objects
-        #
-        # The work around is to either annotate each Model object with the value you want to order by, or add an extra attribute
-        # on the Model you want to order (see e.g. http://archlinux.me/dusty/2010/12/07/django-dont-use-distinct-and-order_by-across-relations/)
-        if override_ordering is None:
-            ordering = self.customsearchordering_set.all().select_related( 'field' )
-        else:
-            ordering = override_ordering
-
-        if len( ordering ) > 0:
-            for o in ordering:
-                qs = o.annotate_qs( qs )
-            qs = qs.order_by( *[o.order_by_field() for o in ordering] )
-
-        return qs
+        ordering = None if override_ordering is None else compile_ordering( override_ordering )
+        return get_search_plan( self ).queryset( freetext=freetext, ordering=ordering )
 
     def get_data_table( self ):
-        return self.layout.rows( self.get_queryset() )
+        return self.layout.iter_data_table( self.get_queryset() )
 
 
 class CustomSearchCondition( models.Model ):
@@ -474,12 +485,15 @@ class CustomSearchCondition( models.Model ):
     value = models.CharField( max_length=255, blank=True )
     and_together = models.BooleanField(default=False, help_text='"AND" conditions together instead of "OR"')
 
-    def prepared_value( self ):
+    def prepared_value( self, expressions=False ):
         """
         Prepare value from string representation.
+
+        If expressions is True, now() is returned as a database expression
+        instead of the current time, so the value can be cached.
         """
         if self.match in self.date_lookups and self.value == 'now()':
-            return datetime.now()
+            return Now() if expressions else datetime.now()
         if self.match in self.number_lookups:
             try:
                 return int( self.value )
@@ -562,3 +576,91 @@ class CustomSearchOrdering( models.Model ):
 
         if not self.field.enable_search:
             raise ValidationError( 'Field %s does not allow ordering' % self.field )
+
+
+def _bump( func, pks ):
+    # Versions are bumped right away for this process, and again once the
+    # transaction commits, as other processes may compile plans from the
+    # data committed before and cache them under the first new version.
+    pks = list( pks )
+    func( pks )
+    transaction.on_commit( lambda: func( pks ) )
+
+
+@receiver( [post_save, post_delete], sender=CustomSearch )
+def _search_changed( sender, instance, **kwargs ):
+    _bump( bump_search_versions, [instance.pk] )
+
+
+@receiver( [post_save, post_delete], sender=CustomSearchCondition )
+@receiver( [post_save, post_delete], sender=CustomSearchOrdering )
+def _search_condition_changed( sender, instance, **kwargs ):
+    _bump( bump_search_versions, [instance.search_id] )
+
+
+@receiver( [post_save, post_delete], sender=CustomSearchLayout )
+def _layout_changed( sender, instance, **kwargs ):
+    _bump( invalidate_layout_plan, [instance.pk] )
+    _bump( bump_search_versions, CustomSearch.objects.filter( layout=instance.pk ).values_list( 'pk', flat=True ) )
+
+
+@receiver( [post_save, post_delete], sender=CustomSearchLayoutField )
+def _layout_field_changed( sender, instance, **kwargs ):
+    _bump( invalidate_layout_plan, [instance.layout_id] )
+    _bump( bump_search_versions, CustomSearch.objects.filter( layout=instance.layout_id ).values_list( 'pk', flat=True ) )
+
+
+@receiver( [post_save, post_delete], sender=CustomSearchField )
+def _search_field_changed( sender, instance, **kwargs ):
+    # A field may be used by any number of layouts
+    _bump( invalidate_layout_plan, CustomSearchLayout.objects.filter( model=instance.model_id ).values_list( 'pk', flat=True ) )
+    invalidate_inverted_indexes()
+    _bump( bump_search_versions, CustomSearch.objects.filter( model=instance.model_id ).values_list( 'pk', flat=True ) )
+    # Connect the receivers of new data models in this process right away
+    track_data_models()
+
+
+@receiver( [post_save, post_delete], sender=CustomSearchModel )
+def _search_model_changed( sender, instance, **kwargs ):
+    _bump( invalidate_layout_plan, CustomSearchLayout.objects.filter( model=instance.pk ).values_list( 'pk', flat=True ) )
+    _bump( bump_search_versions, CustomSearch.objects.filter( model=instance.pk ).values_list( 'pk', flat=True ) )
+    # Connect the receivers of new data models in this process right away
+    track_data_models()
+
+
+def track_data_models():
+    """
+    Connect the watermark receivers of the data models and many-to-many
+    fields of all search models. Run once when the application starts (see
+    apps.py), so saves in every process are tracked without any cost for
+    models which are not searched. Data models added in other processes are
+    only tracked after a restart; until then pages and rows derived from
+    their watermarks expire after their maximum age (see versions.py).
+    """
+    try:
+        # In a savepoint, so a missing table (e.g. during migrations) does
+        # not break the current transaction
+        with transaction.atomic():
+            search_models = list( CustomSearchModel.objects.select_related( 'model' ).prefetch_related( 'customsearchfield_set' ) )
+            data_models = set( m for search_model in search_models for m in search_model.data_models() )
+            through_models = set( m for search_model in search_models for m in search_model.through_models() )
+    except DatabaseError:
+        return
+    for model in data_models:
+        uid = 'customsearch-watermark-%s.%s' % ( model._meta.app_label, model._meta.model_name )
+        post_save.connect( _data_changed, sender=model, dispatch_uid=uid )
+        post_delete.connect( _data_changed, sender=model, dispatch_uid=uid )
+    for model in through_models:
+        uid = 'customsearch-watermark-%s.%s' % ( model._meta.app_label, model._meta.model_name )
+        m2m_changed.connect( _relation_changed, sender=model, dispatch_uid=uid )
+
+
+def _relation_changed( sender, instance, action, model, **kwargs ):
+    if action in ( 'post_add', 'post_remove', 'post_clear' ):
+        _data_changed( instance.__class__ )
+        _data_changed( model )
+
+
+def _data_changed( sender, **kwargs ):
+    bump_data_watermark( sender )
+    transaction.on_commit( lambda: bump_data_watermark( sender ) )
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Pagination helpers for custom search results.
+"""
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+
+import base64
+import json
+import operator
+
+
+class CountedPaginator( Paginator ):
+    """
+    Paginator which can be given the number of objects, so the count
+    computed once for a request (see count_results()) is not run again.
+    """
+    def __init__( self, object_list, per_page, count=None, **kwargs ):
+        super( CountedPaginator, self ).__init__( object_list, per_page, **kwargs )
+        if count is not None:
+            self.count = count
+
+
+class UncountedPage( object ):
+    """
+    A page of results returned by UncountedPaginator.
+    """
+    def __init__( self, object_list, number, has_next ):
+        self.object_list = object_list
+        self.number = number
+        self._has_next = has_next
+
+    def has_next( self ):
+        return self._has_next
+
+    def has_previous( self ):
+        return self.number > 1
+
+    def has_other_pages( self ):
+        return self.has_next() or self.has_previous()
+
+    def next_page_number( self ):
+        return self.number + 1
+
+    def previous_page_number( self ):
+        return self.number - 1
+
+
+class UncountedPaginator( object ):
+    """
+    Page number pagination of a queryset without counting the results. One
+    row more than the page size is fetched to know if there is a next page.
+    """
+    def __init__( self, queryset, per_page ):
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def page( self, number ):
+        """
+        Get a page. Invalid page numbers return the first page.
+        """
+        try:
+            number = max( int( number ), 1 )
+        except ( TypeError, ValueError ):
+            number = 1
+        offset = ( number - 1 ) * self.per_page
+        object_list = list( self.queryset[offset:offset + self.per_page + 1] )
+        return UncountedPage( object_list[:self.per_page], number, len( object_list ) > self.per_page )
+
+
+def elided_page_range( page, on_each_side=3, on_ends=2 ):
+    """
+    Get the page numbers to show for a page of a Paginator: the first and
+    last on_ends pages, and on_each_side pages around the current one. Gaps
+    are represented by None.
+    """
+    num_pages = page.paginator.num_pages
+    if num_pages <= ( on_each_side + on_ends ) * 2 + 1:
+        return list( range( 1, num_pages + 1 ) )
+
+    pages = []
+    if page.number > 1 + on_each_side + on_ends + 1:
+        pages += list( range( 1, on_ends + 1 ) ) + [None] + list( range( page.number - on_each_side, page.number + 1 ) )
+    else:
+        pages += list( range( 1, page.number + 1 ) )
+
+    if page.number < num_pages - on_each_side - on_ends - 1:
+        pages += list( range( page.number + 1, page.number + on_each_side + 1 ) ) + [None] + list( range( num_pages - on_ends + 1, num_pages + 1 ) )
+    else:
+        pages += list( range( page.number + 1, num_pages + 1 ) )
+    return pages
+
+
+def count_results( queryset, estimate_threshold=None ):
+    """
+    Count the results of a queryset and return a ( count, estimated )
+    tuple.
+
+    If estimate_threshold is given and the query planner estimates more
+    rows than the threshold, the estimate is returned instead of running
+    a COUNT(*) over the entire result set.
+    """
+    if estimate_threshold is not None:
+        estimate = estimate_count( queryset )
+        if estimate is not None and estimate > estimate_threshold:
+            return ( estimate, True )
+    return ( queryset.count(), False )
+
+
+def estimate_count( queryset ):
+    """
+    Get the query planner's estimate of the number of rows of a queryset,
+    or None if the database backend does not provide one.
+    """
+    plan = explain( queryset )
+    return int( plan['Plan Rows'] ) if plan is not None else None
+
+
+def estimate_cost( queryset ):
+    """
+    Get the query planner's estimated total cost of a queryset, or None if
+    the database backend does not provide one.
+    """
+    plan = explain( queryset )
+    return float( plan['Total Cost'] ) if plan is not None else None
+
+
+def explain( queryset ):
+    """
+    Get the top node of the query plan of a queryset as a dictionary, or
+    None if the database backend is not PostgreSQL.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute( 'EXPLAIN (FORMAT JSON) %s' % sql, params )
+        plan = cursor.fetchone()[0]
+    if isinstance( plan, basestring ):
+        plan = json.loads( plan )
+    return plan[0]['Plan']
+
+
+class KeysetPage( object ):
+    """
+    A page of results returned by KeysetPaginator.
+    """
+    def __init__( self, object_list, next_cursor=None, previous_cursor=None ):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next( self ):
+        return self.next_cursor is not None
+
+    def has_previous( self ):
+        return self.previous_cursor is not None
+
+    def has_other_pages( self ):
+        return self.has_next() or self.has_previous()
+
+
+class InvalidCursor( ValueError ):
+    """
+    Raised if the values of a cursor cannot be compared to the ordering
+    fields of a queryset.
+    """
+    pass
+
+
+class KeysetPaginator( object ):
+    """
+    Keyset (seek) pagination of a queryset.
+
+    Instead of an OFFSET, each page is fetched by filtering on the
+    ordering values of the last (or first) row of the previous page, so
+    deep pages are as cheap as the first one and rows are not skipped or
+    repeated when data changes between requests. The ordering of the
+    queryset (or the model default ordering) is used, with the primary
+    key added as a tiebreaker.
+
+    The position of NULL values is taken from the database features
+    (e.g. PostgreSQL sorts them after all other values).
+    """
+    def __init__( self, queryset, per_page ):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.keys = get_ordering_keys( queryset )
+        self.nulls_largest = connections[queryset.db].features.nulls_order_largest
+
+    def page( self, cursor=None ):
+        """
+        Get the page starting after the row identified by the cursor. A
+        missing or malformed cursor returns the first page, and a cursor
+        whose values do not fit the ordering fields raises InvalidCursor.
+        """
+        backwards, values = self._decode_cursor( cursor )
+
+        qs = self.queryset
+        if values is not None:
+            seek = _seek_q( self.keys, values, backwards, self.nulls_largest )
+            if seek is None:
+                return self.page() if backwards else KeysetPage( qs.none() )
+            try:
+                qs = qs.filter( seek )
+            except ( ValidationError, TypeError, ValueError ), e:
+                raise InvalidCursor( unicode( e ) )
+
+        order_by = [_order_by( name, desc != backwards ) for name, desc in self.keys]
+        names = [name for name, _desc in self.keys]
+
+        # Fetch only the primary keys and ordering values first, then
+        # the page objects with a primary key lookup.
+        rows = []
+        seen = set()
+        for row in qs.order_by( *order_by ).values_list( 'pk', *names )[:self.per_page + 1]:
+            if row[0] not in seen:
+                seen.add( row[0] )
+                rows.append( row )
+
+        more = len( rows ) > self.per_page
+        if backwards and not more:
+            # Reached the beginning of the results
+            return self.page()
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        object_list = self.queryset.filter( pk__in=[r[0] for r in rows] ).order_by( *[_order_by( name, desc ) for name, desc in self.keys] )
+        first = self._encode_cursor( rows[0][1:], True ) if rows else None
+        last = self._encode_cursor( rows[-1][1:], False ) if rows else None
+
+        if backwards:
+            return KeysetPage( object_list, next_cursor=last, previous_cursor=first )
+        else:
+            return KeysetPage( object_list, next_cursor=last if more else None, previous_cursor=first if values is not None else None )
+
+    def _encode_cursor( self, values, backwards ):
+        data = json.dumps( ['p' if backwards else 'n'] + list( values ), cls=DjangoJSONEncoder )
+        return base64.urlsafe_b64encode( data.encode( 'utf8' ) ).decode( 'ascii' ).rstrip( '=' )
+
+    def _decode_cursor( self, cursor ):
+        if not cursor:
+            return ( False, None )
+        try:
+            cursor = str( cursor )
+            data = json.loads( base64.urlsafe_b64decode( cursor + '=' * ( -len( cursor ) % 4 ) ).decode( 'utf8' ) )
+            direction, values = data[0], data[1:]
+        except ( ValueError, TypeError, IndexError, UnicodeError ):
+            return ( False, None )
+        if direction not in ( 'n', 'p' ) or len( values ) != len( self.keys ):
+            return ( False, None )
+        return ( direction == 'p', values )
+
+
+def get_ordering_keys( queryset ):
+    """
+    Get the ordering of a queryset as a list of ( name, descending )
+    tuples, ending with the primary key.
+    """
+    query = queryset.query
+    ordering = list( query.order_by ) or ( list( query.get_meta().ordering ) if query.default_ordering else [] )
+
+    pk_names = set( ['pk', query.get_meta().pk.name, query.get_meta().pk.attname] )
+    keys = []
+    for o in ordering:
+        if not isinstance( o, basestring ) or o == '?':
+            # Expressions and random ordering cannot be used for seeking
+            continue
+        name = o.lstrip( '-' )
+        keys.append( ( name, o.startswith( '-' ) ) )
+        if name in pk_names:
+            return keys
+
+    keys.append( ( 'pk', False ) )
+    return keys
+
+
+def _order_by( name, descending ):
+    return '-%s' % name if descending else name
+
+
+def _seek_q( keys, values, backwards, nulls_largest ):
+    """
+    Build a Q object matching the rows after the given ordering values.
+    Returns None if no rows can follow.
+    """
+    terms = []
+    for i, ( name, desc ) in enumerate( keys ):
+        desc = desc != backwards
+        after = _after_q( name, values[i], desc, nulls_largest != desc )
+        if after is None:
+            continue
+        terms.append( reduce( operator.and_, [_equal_q( n, v ) for ( n, _d ), v in zip( keys[:i], values[:i] )] + [after] ) )
+
+    return reduce( operator.or_, terms ) if terms else None
+
+
+def _equal_q( name, value ):
+    if value is None:
+        return Q( **{ str( '%s__isnull' % name ): True } )
+    return Q( **{ str( name ): value } )
+
+
+def _after_q( name, value, descending, nulls_last ):
+    if value is None:
+        return None if nulls_last else Q( **{ str( '%s__isnull' % name ): False } )
+
+    q = Q( **{ str( '%s__%s' % ( name, 'lt' if descending else 'gt' ) ): value } )
+    if nulls_last:
+        q |= Q( **{ str( '%s__isnull' % name ): True } )
+    return q
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+"""
+Progress, cancellation and checkpoints of exports.
+
+Each export has an id, under which its state ( search, state, number of rows
+written and total number of rows ) is stored in the cache for
+CUSTOMSEARCH_EXPORT_PROGRESS_TIMEOUT seconds (default one day). The state is
+one of 'running', 'done', 'cancelled' or 'failed'.
+
+Exports are written in chunks of CUSTOMSEARCH_EXPORT_CHECKPOINT_ROWS rows
+(default 5000) to part files (see artifacts.py), and after each chunk the
+position of the last written object and a digest of the primary keys of all
+written chunks are stored as a checkpoint. A retried export resumes after the
+checkpoint, provided the part files still exist and the results were split
+in the same chunks before the checkpoint.
+
+The primary keys of sharded exports are stored under the export id as well,
+so the shards only get the range of their rows as task arguments.
+"""
+
+import hashlib
+
+from django.conf import settings
+
+from djangoplicity.customsearch.resultcache import ResultCacheMiss, ResultPks, delete_pks, store_pks
+from djangoplicity.customsearch.versions import get_cache
+
+from uuid import uuid4
+
+
+class ExportCancelled( Exception ):
+    """
+    Raised while writing the rows of an export which was cancelled.
+    """
+    pass
+
+
+def _timeout():
+    return getattr( settings, 'CUSTOMSEARCH_EXPORT_PROGRESS_TIMEOUT', 24 * 3600 )
+
+
+def _key( export_id ):
+    return 'customsearch:progress:%s' % export_id
+
+
+def new_export_id():
+    return uuid4().hex
+
+
+def start( export_id, search_pk, total, export_key=None ):
+    """
+    Record the start of an export. The number of written rows is kept if the
+    export is resumed.
+    """
+    cache = get_cache()
+    cache.set( _key( export_id ), { 'search': search_pk, 'state': 'running', 'total': total, 'export_key': export_key }, _timeout() )
+    cache.add( '%s:rows' % _key( export_id ), 0, _timeout() )
+
+
+def set_rows( export_id, rows ):
+    get_cache().set( '%s:rows' % _key( export_id ), rows, _timeout() )
+
+
+def add_rows( export_id, rows ):
+    """
+    Add to the number of written rows. Safe to call from the parallel shards
+    of an export.
+    """
+    cache = get_cache()
+    try:
+        cache.incr( '%s:rows' % _key( export_id ), rows )
+    except ValueError:
+        cache.add( '%s:rows' % _key( export_id ), rows, _timeout() )
+
+
+def get_progress( export_id ):
+    """
+    Get the state of an export as a dictionary with search, state, rows and
+    total keys, or None if the export is unknown.
+    """
+    cache = get_cache()
+    values = cache.get_many( [_key( export_id ), '%s:rows' % _key( export_id )] )
+    progress = values.get( _key( export_id ) )
+    if progress is None:
+        return None
+    progress['rows'] = values.get( '%s:rows' % _key( export_id ), 0 )
+    return progress
+
+
+def _set_state( export_id, state ):
+    cache = get_cache()
+    progress = cache.get( _key( export_id ) )
+    if progress is None or progress['state'] != 'running':
+        return None
+    progress['state'] = state
+    cache.set( _key( export_id ), progress, _timeout() )
+    return progress
+
+
+def finish( export_id ):
+    """
+    Record the completion of an export, and remove its checkpoint and
+    primary keys.
+    """
+    _set_state( export_id, 'done' )
+    clear_checkpoint( export_id )
+    clear_pks( export_id )
+
+
+def fail( export_id ):
+    """
+    Record the failure of an export, and remove its checkpoint and primary
+    keys.
+    """
+    _set_state( export_id, 'failed' )
+    clear_checkpoint( export_id )
+    clear_pks( export_id )
+
+
+def cancel( export_id ):
+    """
+    Cancel a running export. The export stops at the next chunk of rows.
+    Returns the state of the export, or None if it was not running.
+    """
+    return _set_state( export_id, 'cancelled' )
+
+
+def is_cancelled( export_id ):
+    progress = get_cache().get( _key( export_id ) )
+    return progress is not None and progress['state'] == 'cancelled'
+
+
+def track( rows, export_id, size=1000 ):
+    """
+    Count the rows written by an export, and raise ExportCancelled if the
+    export is cancelled. Checked every size rows.
+    """
+    n = 0
+    for row in rows:
+        yield row
+        n += 1
+        if n == size:
+            add_rows( export_id, n )
+            n = 0
+            if is_cancelled( export_id ):
+                raise ExportCancelled( export_id )
+    if n:
+        add_rows( export_id, n )
+
+
+def get_checkpoint_size():
+    return getattr( settings, 'CUSTOMSEARCH_EXPORT_CHECKPOINT_ROWS', 5000 )
+
+
+def chunk_digest( digest, pks ):
+    """
+    Add a chunk of primary keys to the digest of the previous chunks.
+    """
+    return hashlib.md5( ( u'%s:%s' % ( digest, u','.join( unicode( pk ) for pk in pks ) ) ).encode( 'utf8' ) ).hexdigest()
+
+
+def get_checkpoint( export_id ):
+    """
+    Get the checkpoint of an export as a dictionary with position, digest
+    (see chunk_digest()) and parts (the names of the written part files)
+    keys, or None.
+    """
+    return get_cache().get( '%s:checkpoint' % _key( export_id ) )
+
+
+def set_checkpoint( export_id, position, digest, parts ):
+    get_cache().set( '%s:checkpoint' % _key( export_id ), { 'position': position, 'digest': digest, 'parts': parts }, _timeout() )
+
+
+def clear_checkpoint( export_id ):
+    get_cache().delete( '%s:checkpoint' % _key( export_id ) )
+
+
+def set_pks( export_id, pks ):
+    """
+    Store the ordered primary keys of the results of an export.
+    """
+    store_pks( get_cache(), '%s:pks' % _key( export_id ), pks, _timeout() )
+
+
+def get_pks( export_id, start, stop ):
+    """
+    Get a range of the primary keys stored by set_pks(). Raises
+    ResultCacheMiss if they expired.
+    """
+    cache = get_cache()
+    key = '%s:pks' % _key( export_id )
+    count = cache.get( key )
+    if count is None:
+        raise ResultCacheMiss( key )
+    return ResultPks( cache, key, count )[start:stop]
+
+
+def clear_pks( export_id ):
+    delete_pks( get_cache(), '%s:pks' % _key( export_id ) )
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Compiled search plans.
+
+Building the queryset of a custom search requires loading its conditions,
+orderings and freetext fields, and turning them into Q objects. A search plan
+holds the result of this compilation, so applying a search to a model only
+requires building the queryset.
+
+Plans are cached in two layers: a process-local dictionary and a shared
+Django cache (see CUSTOMSEARCH_CACHE). Both are keyed by the definition
+version of the search (see versions.py), which changes whenever the search,
+its conditions, orderings or fields are saved or deleted. Plans expire after
+CUSTOMSEARCH_PLAN_CACHE_TIMEOUT seconds (see versions.get_plan_timeout()).
+
+Searches with conditions relative to the current time (a date value of
+now()) give other results as time passes, without any version change.
+Anything caching or validating their results must also be keyed by
+get_time_bucket().
+"""
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models.aggregates import Max, Min
+from django.db.models.functions import Now
+
+from djangoplicity.customsearch.freetext import get_freetext_backend
+from djangoplicity.customsearch.lookups import UpperIn, resolve_lookup, semi_join
+from djangoplicity.customsearch.versions import get_cache, get_plan_timeout, get_search_version
+
+import operator
+import time
+
+_plans = {}
+# Process-local cache of ( version, plan, expiry time ) tuples indexed by search
+# primary key
+
+
+class SearchPlan( object ):
+    """
+    Compiled form of a custom search. Plans only contain picklable data so
+    they can be stored in a shared cache.
+
+    Conditions are stored as ( Q object, relation ) tuples, where relation is
+    the path of the first multi-valued relation (many-to-many or reverse
+    foreign key) crossed by the condition, or None. Such conditions are
+    applied as a semi-join (pk__in subquery) instead of a JOIN, so they do
+    not duplicate rows and the result rarely needs a DISTINCT.
+
+    An empty plan is a search whose conditions contradict each other, and
+    which can therefore never match. A time-dependent plan has conditions
+    relative to the current time.
+    """
+    def __init__( self, app_label, model_name, filters=None, include=None, exclude=None, freetext_fields=None, freetext_backend='icontains', ordering=None, empty=False, time_dependent=False ):
+        self.app_label = app_label
+        self.model_name = model_name
+        self.empty = empty
+        self.filters = filters or []
+        self.include = include or []
+        self.exclude = exclude or []
+        self.freetext_fields = freetext_fields or []
+        self.freetext_backend = freetext_backend
+        self.ordering = ordering or []
+        self.time_dependent = time_dependent
+
+    def get_model( self ):
+        return apps.get_model( self.app_label, self.model_name )
+
+    def queryset( self, freetext=None, ordering=None ):
+        """
+        Build the queryset for the search. The ordering of the search can be
+        overridden with a list compiled with compile_ordering().
+        """
+        model = self.get_model()
+        if self.empty:
+            return model.objects.none()
+        qs = model.objects.all()
+
+        for q, relation in self.filters:
+            qs = qs.filter( semi_join( model, [q] ) if relation else q )
+
+        if self.include:
+            #  include queries are ANDed together, unless a same criterium is
+            #  repeated in which case the criterium value are ORed, e.g.:
+            #    contacts__country=Germany, contacts__group=Messenger, contacts_group=epodpress
+            #  would result in:
+            #    contacts__country=Germany AND (contacts__group=Messenger OR contact_groups=epodpress)
+            #
+            #  Conditions on the same multi-valued relation are put in the
+            #  same subquery, so they must match the same related object as
+            #  they would in a single filter() call.
+            include = [q for q, relation in self.include if not relation]
+            relations = {}
+            for q, relation in self.include:
+                if relation:
+                    if relation not in relations:
+                        relations[relation] = []
+                        include.append( relations[relation] )
+                    relations[relation].append( q )
+            qs = qs.filter( *[semi_join( model, q ) if isinstance( q, list ) else q for q in include] )
+        if self.exclude:
+            # exclude queries are ORed togethere, e.g.:
+            #   contacts__city='', contacts__group=Messenger, contacts_group=epodpress
+            # would result in:
+            #   contacts__city='' OR contacts__group=Messenger OR contacts_group=epodpress
+            qs = qs.exclude( reduce( operator.or_, [semi_join( model, [q] ) if relation else q for q, relation in self.exclude] ) )
+
+        # Free text search in result set
+        if freetext and self.freetext_fields:
+            qs = get_freetext_backend( self.freetext_backend ).filter( qs, self.freetext_fields, freetext )
+
+        # Ordering
+        # ========
+        # NOTE: distinct() and order_by() does not work well together (https://docs.djangoproject.com/en/1.3/ref/models/querysets/#distinct).
+        # If you order by a related field (e.g. groups__name) then groups__name is included in the SELECT columns (e.g SELECT first_name, ..., contact_groups.name).
+        # This means that distinct() method (akak SELECT DISTINCT) will no longer be able to detect duplicate Contact objects
+        #
+        # The work around is to either annotate each Model object with the value you want to order by, or add an extra attribute
+        # on the Model you want to order (see e.g. http://archlinux.me/dusty/2010/12/07/django-dont-use-distinct-and-order_by-across-relations/)
+        ordering = self.ordering if ordering is None else ordering
+
+        # Only ordering by a multi-valued relation without an aggregate still
+        # joins more than one row per object.
+        order_by = [o for o, annotation in ordering if not annotation] if ordering else model._meta.ordering
+        if [o for o in order_by if isinstance( o, basestring ) and resolve_lookup( model, o.lstrip( '-' ) )[0]]:
+            qs = qs.distinct()
+
+        if ordering:
+            for order_by, annotation in ordering:
+                if annotation:
+                    name, aggregate, field_name = annotation
+                    qs = qs.annotate( **{ name: aggregate( field_name ) } )
+            qs = qs.order_by( *[order_by for order_by, _annotation in ordering] )
+
+        return qs
+
+
+def compile_ordering( orderings ):
+    """
+    Compile CustomSearchOrdering objects into a list of ( order_by, annotation )
+    tuples (see CustomSearchOrdering.annotate_qs()).
+    """
+    ordering = []
+    for o in orderings:
+        annotation = None
+        if o.field.sort_selector:
+            name = str( '%s__%s' % ( o.field.sort_field_name(), 'max' if o.descending else 'min' ) )
+            annotation = ( name, Max if o.descending else Min, o.field.sort_field_name() )
+        ordering.append( ( o.order_by_field(), annotation ) )
+    return ordering
+
+
+def _q( lookup, match, val ):
+    return models.Q( **{ str( "%s%s" % ( lookup, match ) ): val } )
+
+
+def _is_text( field ):
+    return isinstance( field, ( models.CharField, models.TextField ) )
+
+
+def _is_value( val ):
+    return val is not None and not hasattr( val, 'resolve_expression' )
+
+
+def _normalize( field, val, ignore_case=False ):
+    """
+    Normalize the value of an exact condition so equal values compare equal.
+    """
+    if _is_text( field ):
+        val = unicode( val )
+        return val.lower() if ignore_case else val
+    try:
+        return field.to_python( val )
+    except ValidationError:
+        return val
+
+
+def _unique( conditions ):
+    """
+    Remove duplicate ( match, value ) conditions, keeping the first one.
+    """
+    result = []
+    seen = []
+    for match, val in conditions:
+        key = ( match, val.lower() if match == '__iexact' and isinstance( val, basestring ) else val )
+        if key not in seen:
+            seen.append( key )
+            result.append( ( match, val ) )
+    return result
+
+
+def _any_of( lookup, conditions, field=None ):
+    """
+    OR together conditions on the same field. If the field is given, exact
+    and iexact conditions are merged into a single IN lookup.
+    """
+    if field is None:
+        return reduce( operator.or_, [_q( lookup, match, val ) for ( match, val ) in conditions] )
+
+    exact = []
+    iexact = []
+    qobjects = []
+    for match, val in conditions:
+        if match == '__exact' and _is_value( val ):
+            exact.append( val )
+        elif match == '__iexact' and isinstance( val, basestring ) and _is_text( field ):
+            iexact.append( val )
+        else:
+            qobjects.append( _q( lookup, match, val ) )
+
+    if len( exact ) == 1:
+        qobjects.append( _q( lookup, '__exact', exact[0] ) )
+    elif exact:
+        qobjects.append( _q( lookup, '__in', exact ) )
+    if len( iexact ) == 1:
+        qobjects.append( _q( lookup, '__iexact', iexact[0] ) )
+    elif iexact:
+        qobjects.append( _q( lookup, '__' + UpperIn.lookup_name, iexact ) )
+
+    return reduce( operator.or_, qobjects )
+
+
+def _contradicts( field, conditions ):
+    """
+    Check if conditions ANDed together on a single-valued field can never
+    match, e.g. name=Germany AND name=France.
+    """
+    exact = set( _normalize( field, val, ignore_case=True ) for ( match, val ) in conditions if match == '__exact' and _is_value( val ) )
+    isnull = set( val for ( match, val ) in conditions if match == '__isnull' )
+    return len( exact ) > 1 or len( isnull ) > 1 or ( True in isnull and len( exact ) > 0 )
+
+
+def _excluded( field, include, exclude ):
+    """
+    Check if an OR-group of exact include conditions on a single-valued field
+    is entirely excluded by exact exclude conditions on the same field.
+    """
+    if not include or [val for ( match, val ) in include if match != '__exact' or not _is_value( val )]:
+        return False
+    excluded = [_normalize( field, val ) for ( match, val ) in exclude if match == '__exact' and _is_value( val )]
+    return all( _normalize( field, val ) in excluded for ( match, val ) in include )
+
+
+def compile_search( search, optimize=True ):
+    """
+    Compile a CustomSearch into a SearchPlan.
+
+    Unless optimize is False, the conditions are simplified first: duplicates
+    are removed, ORed exact and iexact conditions on a field are merged into
+    IN lookups, and contradictory conditions on single-valued fields result
+    in an empty plan.
+    """
+    include, exclude = search._collect_search_conds( expressions=True )
+    time_dependent = any( isinstance( val, Now ) for values in include.values() + exclude.values() for match, val in values['values'] )
+
+    contenttype = search.model.model
+    model = contenttype.model_class()
+
+    filters = []
+    include_queries = []
+    exclude_queries = []
+    empty = False
+
+    excluded = {}
+    for field, values in exclude.items():
+        lookup = field.full_field_name()
+        ( relation, modelfield ) = resolve_lookup( model, lookup )
+        conditions = values['values']
+        if optimize:
+            conditions = _unique( conditions )
+            if not relation and modelfield is not None:
+                excluded[field] = conditions
+        exclude_queries.append( ( _any_of( lookup, conditions, modelfield if optimize else None ), relation ) )
+
+    # TODO: implement and_together for exclude
+
+    for field, values in include.items():
+        lookup = field.full_field_name()
+        ( relation, modelfield ) = resolve_lookup( model, lookup )
+        conditions = values['values']
+        if optimize:
+            conditions = _unique( conditions )
+            if not relation and modelfield is not None:
+                if values['and_together'] and _contradicts( modelfield, conditions ):
+                    empty = True
+                elif not values['and_together'] and _excluded( modelfield, conditions, excluded.get( field, [] ) ):
+                    empty = True
+
+        # By default we use OR, but if at least the first values' and_together
+        # is true then we user multiple filter():
+        if values['and_together']:
+            for match, val in conditions:
+                filters.append( ( _q( lookup, match, val ), relation ) )
+        else:
+            include_queries.append( ( _any_of( lookup, conditions, modelfield if optimize else None ), relation ) )
+
+    return SearchPlan(
+        contenttype.app_label,
+        contenttype.model,
+        filters=filters,
+        include=include_queries,
+        exclude=exclude_queries,
+        freetext_fields=[( f.full_field_name(), resolve_lookup( model, f.full_field_name() )[0] ) for f in search.model.customsearchfield_set.filter( enable_freetext=True )],
+        freetext_backend=search.model.freetext_backend,
+        ordering=compile_ordering( search.customsearchordering_set.all().select_related( 'field' ) ),
+        empty=empty,
+        time_dependent=time_dependent,
+    )
+
+
+def get_search_plan( search ):
+    """
+    Get the compiled plan of a search from the process-local cache or the
+    shared cache, or compile it.
+    """
+    version = get_search_version( search.pk )
+
+    cached = _plans.get( search.pk )
+    if cached is not None and cached[0] == version and cached[2] > time.time():
+        return cached[1]
+
+    cache = get_cache()
+    key = 'customsearch:plan:%s:%s' % ( search.pk, version )
+    plan = cache.get( key )
+    if plan is None:
+        plan = compile_search( search )
+        cache.set( key, plan, get_plan_timeout() )
+
+    _plans[search.pk] = ( version, plan, time.time() + get_plan_timeout() )
+    return plan
+
+
+def get_time_bucket( search ):
+    """
+    Get the current time bucket of a time-dependent search, or None. The
+    bucket changes every CUSTOMSEARCH_TIME_DEPENDENT_MAX_AGE seconds
+    (default 60), so results keyed by it are at most that old.
+    """
+    if not get_search_plan( search ).time_dependent:
+        return None
+    return int( time.time() // getattr( settings, 'CUSTOMSEARCH_TIME_DEPENDENT_MAX_AGE', 60 ) )
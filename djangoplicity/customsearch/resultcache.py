@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Cache of search result primary keys.
+
+The ordered list of primary keys of a search result is stored in a Django
+cache, keyed by the definition version of the search (see versions.py), the
+freetext search value and the ordering. Paginating, exporting and generating
+labels for the same result then only needs primary key lookups instead of
+running the full search query again.
+
+The cache is disabled by default. To enable it, set CUSTOMSEARCH_RESULT_CACHE
+to the alias of the cache to use. Entries expire after
+CUSTOMSEARCH_RESULT_CACHE_TIMEOUT seconds, and eviction of least recently used
+entries is left to the cache backend (e.g. memcached or LocMemCache). Results
+with more than CUSTOMSEARCH_RESULT_CACHE_MAX_ROWS rows are not cached, and no
+more rows than that are read for them. Results of searches relative to the
+current time are keyed by its time bucket as well (see query.py).
+
+Results of expensive searches can be computed in the background by a Celery
+task (see tasks.compute_results), which stores them in the cache for the
+admin to display. Failures are kept for CUSTOMSEARCH_ASYNC_RESULTS_TIMEOUT
+seconds (default 600), which is also the maximum time a computation is
+considered to be running.
+
+Lists are stored in chunks of RESULT_CACHE_CHUNK_SIZE keys, so fetching a
+page only reads one or two chunks and entries stay below item size limits
+of the cache backend.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from djangoplicity.customsearch.layout import chunked
+from djangoplicity.customsearch.query import get_time_bucket
+from djangoplicity.customsearch.versions import get_search_version
+
+import hashlib
+
+RESULT_CACHE_CHUNK_SIZE = 10000
+
+
+def get_result_cache():
+    """
+    Get the result cache, or None if it is not enabled.
+    """
+    alias = getattr( settings, 'CUSTOMSEARCH_RESULT_CACHE', None )
+    return caches[alias] if alias else None
+
+
+def result_cache_key( search, searchval=None, ordering=None, ordering_direction=None ):
+    # Results of searches relative to the current time expire with its bucket
+    params = repr( ( searchval or u'', ordering, ordering_direction, get_time_bucket( search ) ) ).encode( 'utf8' )
+    return 'customsearch:results:%s:%s:%s' % ( search.pk, get_search_version( search.pk ), hashlib.md5( params ).hexdigest() )
+
+
+class ResultPks( object ):
+    """
+    Ordered primary keys of a search result stored in the result cache.
+    Behaves like a read-only list, so it can be passed to a Paginator.
+    """
+    def __init__( self, cache, key, count ):
+        self.cache = cache
+        self.key = key
+        self.count = count
+
+    def __len__( self ):
+        return self.count
+
+    def _chunk( self, i ):
+        chunk = self.cache.get( '%s:%s' % ( self.key, i ) )
+        if chunk is None:
+            raise ResultCacheMiss( self.key )
+        return chunk
+
+    def __getitem__( self, index ):
+        if isinstance( index, slice ):
+            start, stop, step = index.indices( self.count )
+            if start >= stop:
+                return []
+            first, last = start // RESULT_CACHE_CHUNK_SIZE, ( stop - 1 ) // RESULT_CACHE_CHUNK_SIZE
+            pks = []
+            for i in range( first, last + 1 ):
+                pks += self._chunk( i )
+            offset = first * RESULT_CACHE_CHUNK_SIZE
+            return pks[start - offset:stop - offset:step]
+
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError( index )
+        return self._chunk( index // RESULT_CACHE_CHUNK_SIZE )[index % RESULT_CACHE_CHUNK_SIZE]
+
+    def __iter__( self ):
+        for i in range( ( self.count + RESULT_CACHE_CHUNK_SIZE - 1 ) // RESULT_CACHE_CHUNK_SIZE ):
+            for pk in self._chunk( i ):
+                yield pk
+
+
+class ResultCacheMiss( Exception ):
+    """
+    Raised if a chunk of a cached result was evicted.
+    """
+    pass
+
+
+def ordered_pks( qs, max_rows=None ):
+    """
+    Get the primary keys of the objects of a queryset, in order, or None if
+    the query returns more than max_rows rows (only max_rows + 1 are read).
+    """
+    # SELECT DISTINCT may return an object more than once when ordering by a
+    # multi-valued relation, so only the first occurrence is kept.
+    pks = []
+    seen = set()
+    values = qs.values_list( 'pk', flat=True )
+    if max_rows is not None:
+        values = values[:max_rows + 1]
+    for i, pk in enumerate( values.iterator() ):
+        if i == max_rows:
+            return None
+        if pk not in seen:
+            seen.add( pk )
+            pks.append( pk )
+    return pks
+
+
+def get_result_pks( search, qs, searchval=None, ordering=None, ordering_direction=None, refresh=False ):
+    """
+    Get the ordered primary keys of a search result from the result cache,
+    running the query and caching the result if needed (or if refresh is
+    True). Returns a list or a ResultPks instance, or None if the result
+    cache is not enabled or the result has more than
+    CUSTOMSEARCH_RESULT_CACHE_MAX_ROWS rows.
+    """
+    cache = get_result_cache()
+    if cache is None:
+        return None
+
+    key = result_cache_key( search, searchval, ordering, ordering_direction )
+    timeout = getattr( settings, 'CUSTOMSEARCH_RESULT_CACHE_TIMEOUT', 600 )
+    if not refresh:
+        pks = get_cached_result_pks( search, searchval, ordering, ordering_direction )
+        if pks is not None:
+            return pks
+        if cache.get( '%s:overflow' % key ):
+            return None
+
+    pks = ordered_pks( qs, max_rows=getattr( settings, 'CUSTOMSEARCH_RESULT_CACHE_MAX_ROWS', 1000000 ) )
+    if pks is None:
+        # Remembered, so the rows are not read again for each page
+        cache.set( '%s:overflow' % key, True, timeout )
+        return None
+
+    store_pks( cache, key, pks, timeout )
+    return pks
+
+
+def store_pks( cache, key, pks, timeout ):
+    """
+    Store a list of primary keys in a cache, in chunks read by ResultPks.
+    """
+    data = dict( [( '%s:%s' % ( key, i ), chunk ) for i, chunk in enumerate( chunked( pks, RESULT_CACHE_CHUNK_SIZE ) )] )
+    cache.set_many( data, timeout )
+    cache.set( key, len( pks ), timeout )
+
+
+def delete_pks( cache, key ):
+    """
+    Delete a list of primary keys stored by store_pks().
+    """
+    count = cache.get( key )
+    if count is not None:
+        chunks = ( count + RESULT_CACHE_CHUNK_SIZE - 1 ) // RESULT_CACHE_CHUNK_SIZE
+        cache.delete_many( [key] + ['%s:%s' % ( key, i ) for i in range( chunks )] )
+
+
+def get_cached_result_pks( search, searchval=None, ordering=None, ordering_direction=None ):
+    """
+    Get the ordered primary keys of a search result from the result cache,
+    without running the query. Returns None if the result is not cached or
+    the result cache is not enabled.
+    """
+    cache = get_result_cache()
+    if cache is None:
+        return None
+
+    key = result_cache_key( search, searchval, ordering, ordering_direction )
+    count = cache.get( key )
+    if count is None:
+        return None
+    pks = ResultPks( cache, key, count )
+    try:
+        # Make sure the entry is complete
+        pks[-1:]
+        pks[:1]
+        return pks
+    except ResultCacheMiss:
+        return None
+
+
+def _async_timeout():
+    return getattr( settings, 'CUSTOMSEARCH_ASYNC_RESULTS_TIMEOUT', 600 )
+
+
+def start_computing( search, searchval=None, ordering=None, ordering_direction=None ):
+    """
+    Mark a search result as being computed in the background. Returns False
+    if it already is.
+    """
+    key = result_cache_key( search, searchval, ordering, ordering_direction )
+    cache = get_result_cache()
+    cache.delete( '%s:error' % key )
+    return cache.add( '%s:computing' % key, True, _async_timeout() )
+
+
+def finish_computing( search, searchval=None, ordering=None, ordering_direction=None, error=None ):
+    """
+    Mark the background computation of a search result as completed,
+    recording the error message if it failed.
+    """
+    key = result_cache_key( search, searchval, ordering, ordering_direction )
+    cache = get_result_cache()
+    if error is not None:
+        cache.set( '%s:error' % key, error, _async_timeout() )
+    cache.delete( '%s:computing' % key )
+
+
+def get_computing_error( search, searchval=None, ordering=None, ordering_direction=None ):
+    """
+    Get the error message of a failed background computation of a search
+    result, or None.
+    """
+    return get_result_cache().get( '%s:error' % result_cache_key( search, searchval, ordering, ordering_direction ) )
+
+
+def get_objects( queryset, pks ):
+    """
+    Get a list of the objects of a queryset for a list of primary keys, in
+    the same order as the primary keys.
+    """
+    objects = queryset.in_bulk( pks )
+    return [objects[pk] for pk in pks if pk in objects]
+
+
+def iter_rows( layout, queryset, pks, chunk_size=RESULT_CACHE_CHUNK_SIZE, projection=False, table=None ):
+    """
+    Yield the ( pk, values ) rows of a layout for the objects of a queryset
+    identified by a list of primary keys, in the order of the list. All
+    chunks are rendered with one bound table (see CustomSearchLayout.bind()).
+    """
+    if table is None:
+        table = layout.bind()
+    for chunk in chunked( pks, chunk_size ):
+        rows = dict( layout.iter_data_table( queryset.filter( pk__in=chunk ), chunk_size=chunk_size, projection=projection, table=table ) )
+        for pk in chunk:
+            if pk in rows:
+                yield ( pk, rows[pk] )
+
+
+def iter_results( search, queryset, searchval=None, ordering=None, ordering_direction=None, projection=True, table=None ):
+    """
+    Yield the ( pk, values ) layout rows of the results of a search, using
+    the primary keys from the result cache if enabled.
+    """
+    pks = get_result_pks( search, queryset, searchval, ordering, ordering_direction )
+    if pks is None:
+        return search.layout.iter_data_table( queryset, projection=projection, table=table )
+    return iter_rows( search.layout, queryset.model._default_manager.all(), pks, projection=projection, table=table )
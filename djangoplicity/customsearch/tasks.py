@@ -29,46 +29,371 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE
 
-from djangoplicity.customsearch.exporter import ExcelExporter
+from djangoplicity.customsearch import artifacts, coalesce, progress
+from djangoplicity.customsearch.exporter import XlsxStreamingExporter
 from djangoplicity.customsearch.models import CustomSearch
+from djangoplicity.customsearch.resultcache import finish_computing, get_result_pks, iter_rows, ordered_pks
 from django.conf import settings
 
+from celery import chord
 from celery.task import task
 from django.core.mail import EmailMessage
+from django.urls import reverse
+from urlparse import urljoin
 from tempfile import NamedTemporaryFile
 import os
 
 
-@task
-def export_search(search_id, email, searchval=None, ordering=None, ordering_direction=None):
+@task(acks_late=True, reject_on_worker_lost=True)
+def export_search(search_id, email, searchval=None, ordering=None, ordering_direction=None, shards=None, base_url=None, export_key=None, export_id=None):
     '''
     Export a given search to file and email to the given address
+
+    If CUSTOMSEARCH_EXPORT_STORAGE is set, the file is stored and the email
+    contains a download link, made absolute with base_url (see
+    artifacts.py).
+
+    If export_key is given, the export was started by request_export(), and
+    the lock of the key is released when it completes. If the export fails,
+    everyone who requested it is told so by email.
+
+    The progress of the export is recorded under export_id (default: the id
+    of the task), and the export can be cancelled with cancel_export(). The
+    rows are written in chunks with a checkpoint after each chunk, and the
+    task is only acknowledged once it completes, so if a worker stops during
+    the export the task is run again and resumes from the last checkpoint
+    (see progress.py).
+
+    If shards (default: CUSTOMSEARCH_EXPORT_SHARDS) is more than 1 and the
+    search has at least CUSTOMSEARCH_EXPORT_SHARD_MIN_ROWS results, the
+    results are split in shards rendered in parallel by export_shard
+    subtasks, and merged by merge_export_shards. The primary keys of the
+    results are stored with the progress of the export, and each shard only
+    gets its range. If a shard or the merge fails, fail_export removes the
+    part files and releases the export. This requires a Celery result
+    backend, and part files readable by all workers (see artifacts.py).
     '''
-    search = CustomSearch.objects.get(pk=search_id)
+    if export_id is None:
+        export_id = export_search.request.id or progress.new_export_id()
+    if progress.is_cancelled(export_id):
+        return
+    try:
+        _export_search(search_id, email, searchval, ordering, ordering_direction, shards, base_url, export_key, export_id)
+    except Exception:
+        _fail_export(search_id, email, export_key, export_id)
+        raise
 
-    # Rename the / from the search name if any
-    prefix = search.name.replace('/', '-')
 
-    # Generate a temporary file
-    f = NamedTemporaryFile(prefix=prefix + '-', suffix='.xls', delete=False)
+def _export_search(search_id, email, searchval, ordering, ordering_direction, shards, base_url, export_key, export_id):
+    search = CustomSearch.objects.get(pk=search_id)
 
-    (search, qs, searchval, _error, header, _o, _ot) = search.get_results_queryset(
+    (search, qs, searchval, _error, _header, o, ot) = search.get_results_queryset(
             searchval=searchval,
             ordering=ordering,
             ordering_direction=ordering_direction)
 
-    exporter = ExcelExporter(f, header=[ (x[1], None) for x in header ])
+    pks = get_result_pks(search, qs, searchval, o, ot)
+    if pks is None:
+        pks = ordered_pks(qs)
+    progress.start(export_id, search.pk, len(pks), export_key)
+
+    if shards is None:
+        shards = getattr(settings, 'CUSTOMSEARCH_EXPORT_SHARDS', 1)
+    if shards > 1 and len(pks) >= getattr(settings, 'CUSTOMSEARCH_EXPORT_SHARD_MIN_ROWS', 10000):
+        size = -(-len(pks) // shards)
+        progress.set_pks(export_id, pks)
+        parts = [export_shard.s(search.pk, export_id, i, start, start + size) for i, start in enumerate(range(0, len(pks), size))]
+        merge = merge_export_shards.s(search.pk, email, base_url=base_url, export_key=export_key, export_id=export_id)
+        merge.link_error(fail_export.si(search.pk, email, len(parts), export_key, export_id))
+        chord(parts)(merge)
+        return
+
+    parts = _write_parts(search, pks, export_id)
+    if parts is None:
+        # Cancelled
+        return
+    filename = _merge_parts(search, parts)
+    _send_export(search, email, filename, base_url, export_key, export_id)
+
+
+@task(acks_late=True, reject_on_worker_lost=True)
+def export_shard(search_id, export_id, index, start, stop):
+    '''
+    Render the rows start to stop of an export to its index-th part file,
+    and return its name, or None if the export was cancelled
+    '''
+    search = CustomSearch.objects.get(pk=search_id)
+    pks = progress.get_pks(export_id, start, stop)
+    try:
+        table = search.layout.bind()
+        return _write_part(search, table, _part_exporter(search, table), search.model.model.model_class()._default_manager.all(), pks, export_id, index)
+    except progress.ExportCancelled:
+        return None
+
+
+@task
+def merge_export_shards(parts, search_id, email, base_url=None, export_key=None, export_id=None):
+    '''
+    Merge the part files of a sharded export in order, and email the export
+    to the given address
+    '''
+    search = CustomSearch.objects.get(pk=search_id)
+    if None in parts or (export_id and progress.is_cancelled(export_id)):
+        artifacts.delete_parts(name for name in parts if name)
+        return
+
+    filename = _merge_parts(search, parts)
+    _send_export(search, email, filename, base_url, export_key, export_id)
+
+
+@task
+def fail_export(search_id, email, parts, export_key=None, export_id=None):
+    '''
+    Error callback of a sharded export: remove the part files written by
+    the shards, release the lock of the export, record its failure and
+    notify its requesters
+    '''
+    artifacts.delete_parts(artifacts.part_name(export_id, i) for i in range(parts))
+    _fail_export(search_id, email, export_key, export_id)
+
+
+def _fail_export(search_id, email, export_key, export_id):
+    emails = [email]
+    if export_key:
+        # Requesters added while the export ran would otherwise never hear
+        # back, and get no file from the next identical request either
+        emails += coalesce.fail(export_key)
+    progress.fail(export_id)
+    _send_notice(search_id, emails, 'failed', 'The export could not be completed. Please request it again.\n')
+
+
+def _send_notice(search_id, emails, state, body):
+    search = CustomSearch.objects.filter(pk=search_id).first()
+    for email in emails:
+        EmailMessage('Custom Search export %s: "%s"' % (state, search.name if search else search_id),
+                    body, settings.DEFAULT_FROM_EMAIL, [email]).send()
+
+
+def _part_exporter(search, table):
+    header = table.header
+    return XlsxStreamingExporter(header=[ (x[1], None) for x in header ], fields=search.layout.get_plan().value_fields(header))
+
+
+def _write_part(search, table, exporter, queryset, pks, export_id, index):
+    '''
+    Render the rows of the given objects to the index-th part file of an
+    export, and return its name
+    '''
+    rows = progress.track((values for _pk, values in iter_rows(search.layout, queryset, pks, projection=True, table=table)), export_id)
+
+    with NamedTemporaryFile(suffix='.part') as f:
+        exporter.writepart(rows, f)
+        f.seek(0)
+        return artifacts.store_part(f, artifacts.part_name(export_id, index))
+
+
+def _write_parts(search, pks, export_id):
+    '''
+    Render the rows of an export to part files of
+    CUSTOMSEARCH_EXPORT_CHECKPOINT_ROWS rows, resuming from the checkpoint of
+    the export if any. Returns the names of the part files, or None if the
+    export was cancelled.
+    '''
+    table = search.layout.bind()
+    exporter = _part_exporter(search, table)
+    queryset = search.model.model.model_class()._default_manager.all()
+
+    size = progress.get_checkpoint_size()
+    position, parts, digest = 0, [], ''
+    checkpoint = progress.get_checkpoint(export_id)
+    if checkpoint is not None:
+        # Only resume if the chunks written before the checkpoint did not
+        # change, and their part files are still there
+        resumed = ''
+        for start in range(0, min(checkpoint['position'], len(pks)), size):
+            resumed = progress.chunk_digest(resumed, pks[start:start + size])
+        storage = artifacts.get_part_storage()
+        if checkpoint['position'] <= len(pks) and resumed == checkpoint['digest'] \
+                and all(storage.exists(name) for name in checkpoint['parts']):
+            position, parts, digest = checkpoint['position'], checkpoint['parts'], resumed
+        else:
+            artifacts.delete_parts(checkpoint['parts'])
+    progress.set_rows(export_id, position)
 
-    for row in search.layout.data_table(qs):
-        exporter.writerow(row['values'])
-    exporter.save(f)
-    f.close()
+    try:
+        while position < len(pks):
+            chunk = pks[position:position + size]
+            parts.append(_write_part(search, table, exporter, queryset, chunk, export_id, len(parts)))
+            position += len(chunk)
+            digest = progress.chunk_digest(digest, chunk)
+            progress.set_checkpoint(export_id, position, digest, parts)
+    except Exception as e:
+        artifacts.delete_parts(parts)
+        progress.clear_checkpoint(export_id)
+        if isinstance(e, progress.ExportCancelled):
+            return None
+        raise
+    return parts
 
-    # Send the export file as attachment
-    email = EmailMessage('Custom Search export ready: "%s"' % search.name,
-                '', settings.DEFAULT_FROM_EMAIL, [email])
-    email.attach_file(f.name)
-    email.send()
+
+def _merge_parts(search, parts):
+    '''
+    Merge part files in order to an export file, and return its name. The
+    part files are removed.
+    '''
+    header = search.layout.header()
+
+    f = _export_file(search)
+    exporter = XlsxStreamingExporter(f, header=[ (x[1], None) for x in header ], fields=search.layout.get_plan().value_fields(header))
+    storage = artifacts.get_part_storage()
+    try:
+        for name in parts:
+            part = storage.open(name, 'rb')
+            try:
+                exporter.appendpart(part)
+            finally:
+                part.close()
+        exporter.save(f)
+    finally:
+        f.close()
+        artifacts.delete_parts(parts)
+    return f.name
+
+
+@task
+def send_export_link(search_id, emails, name, base_url=None):
+    '''
+    Email the download link of a stored export file
+    '''
+    search = CustomSearch.objects.get(pk=search_id)
+    for email in emails:
+        _send_link(search, email, name, base_url)
+
+
+def request_export(search, email, searchval=None, ordering=None, ordering_direction=None, base_url=None):
+    '''
+    Start an export of a search, unless an identical export is running or
+    recently completed, in which case the same file is sent (see
+    coalesce.py). Returns the id of the running export, or None if the file
+    of a completed export is sent.
+    '''
+    key = coalesce.export_key(search, searchval, ordering, ordering_direction)
+    name = coalesce.get_completed(key)
+    if name is None:
+        export_id = progress.new_export_id()
+        if coalesce.acquire(key, export_id):
+            export_search.delay(search.pk, email, searchval, ordering, ordering_direction, base_url=base_url, export_key=key, export_id=export_id)
+            return export_id
+        running = coalesce.get_running(key)
+        if coalesce.add_requester(key, email):
+            return running
+        # The export completed in the meantime
+        name = coalesce.get_completed(key)
+    if name is not None:
+        send_export_link.delay(search.pk, [email], name, base_url)
+        return None
+    export_id = progress.new_export_id()
+    export_search.delay(search.pk, email, searchval, ordering, ordering_direction, base_url=base_url, export_id=export_id)
+    return export_id
+
+
+def cancel_export(export_id):
+    '''
+    Cancel a running export, for all its requesters. The requesters added
+    while it ran are told so by email. Returns False if the export was not
+    running.
+    '''
+    state = progress.cancel(export_id)
+    if state is None:
+        return False
+    key = state.get('export_key')
+    if key and coalesce.get_running(key) == export_id:
+        _send_notice(state['search'], coalesce.release(key), 'cancelled', 'The export was cancelled. Please request it again.\n')
+    return True
+
+
+@task
+def compute_results(search_id, searchval=None, ordering=None, ordering_direction=None):
+    '''
+    Run a search and store the primary keys of its results in the result
+    cache, for searches whose results are computed in the background by
+    the admin (see resultcache.py)
+    '''
+    search = CustomSearch.objects.get(pk=search_id)
+    error = None
+    try:
+        (search, qs, searchval, error, _header, o, ot) = search.get_results_queryset(
+                searchval=searchval,
+                ordering=ordering,
+                ordering_direction=ordering_direction,
+                evaluate=False)
+        if not error:
+            if get_result_pks(search, qs, searchval, o, ot, refresh=True) is None:
+                error = 'The search has too many results (more than %d) to be cached' % getattr(settings, 'CUSTOMSEARCH_RESULT_CACHE_MAX_ROWS', 1000000)
+    except Exception as e:
+        error = unicode(e)
+        raise
+    finally:
+        finish_computing(search, searchval, ordering, ordering_direction, error or None)
+
+
+@task
+def cleanup_exports():
+    '''
+    Delete the stored export files whose download link has expired. Should
+    be run periodically when CUSTOMSEARCH_EXPORT_STORAGE is set.
+    '''
+    return artifacts.cleanup_exports()
+
+
+def _export_name(search):
+    # Rename the / from the search name if any
+    return search.name.replace('/', '-')
+
+
+def _export_file(search):
+    prefix = _export_name(search)
+
+    # Generate a temporary file
+    return NamedTemporaryFile(prefix=prefix + '-', suffix='.xlsx', delete=False)
+
+
+def _send_link(search, email, name, base_url=None):
+    url = reverse('admin:customsearch_customsearch_export_download', args=[artifacts.export_token(name)])
+    if base_url:
+        url = urljoin(base_url, url)
+    body = 'Download the export from:\n\n%s\n\nThe link expires in %d days.\n' % (
+        url, artifacts.get_link_max_age() // (24 * 3600))
+    EmailMessage('Custom Search export ready: "%s"' % search.name, body, settings.DEFAULT_FROM_EMAIL, [email]).send()
+
+
+def _send_export(search, email, filename, base_url=None, export_key=None, export_id=None):
+    if export_id and progress.is_cancelled(export_id):
+        os.remove(filename)
+        return
+
+    name = None
+    if artifacts.get_export_storage() is not None:
+        name = artifacts.store_export(filename, '%s.xlsx' % _export_name(search))
+
+    emails = [email]
+    if export_key:
+        # Send the export to everyone who requested it while it ran
+        emails += coalesce.release(export_key, name)
+
+    for email in emails:
+        if name is not None:
+            # Send a download link to the stored file
+            _send_link(search, email, name, base_url)
+        else:
+            # Send the export file as attachment
+            message = EmailMessage('Custom Search export ready: "%s"' % search.name,
+                        '', settings.DEFAULT_FROM_EMAIL, [email])
+            message.attach_file(filename)
+            message.send()
 
     # Remove the temporary file
-    os.remove(f.name)
+    os.remove(filename)
+
+    if export_id:
+        progress.finish(export_id)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-customsearch
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Definition versions of custom searches.
+
+Each search has a version token stored in the cache, which changes whenever
+the search or anything it depends on (conditions, orderings, fields, layout)
+is saved or deleted. Cached data derived from a search definition is keyed by
+this version, so it never has to be deleted explicitly. Layouts have a version
+as well, for the compiled layout plans.
+
+Likewise, each model shown by searches (see CustomSearchModel.data_models())
+has a data watermark, which changes whenever an object of the model is saved
+or deleted, or a many-to-many field of a search model changes. The receivers
+doing so are connected per model when the application starts (see
+models.track_data_models()). Changes which send no signal are not tracked:
+QuerySet.update(), bulk_create() and raw SQL. Data derived from watermarks
+must therefore expire as well (see CUSTOMSEARCH_ETAG_MAX_AGE and
+CUSTOMSEARCH_FRAGMENT_CACHE_TIMEOUT).
+
+The cache alias can be set with the CUSTOMSEARCH_CACHE setting (defaults to
+'default'). It must be shared by all processes (e.g. Memcached, Redis or the
+database cache): with a local-memory cache, a change made in one process does
+not invalidate the data cached by the others. This is reported by a system
+check (see check_cache()).
+"""
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from uuid import uuid4
+
+
+def get_cache():
+    return caches[getattr( settings, 'CUSTOMSEARCH_CACHE', 'default' )]
+
+
+def check_cache( app_configs, **kwargs ):
+    """
+    System check warning when the cache is not shared between processes.
+    """
+    alias = getattr( settings, 'CUSTOMSEARCH_CACHE', 'default' )
+    if isinstance( caches[alias], ( LocMemCache, DummyCache ) ):
+        return [checks.Warning(
+            "The '%s' cache is not shared between processes, so changes to searches and data will not invalidate the results cached by other processes." % alias,
+            hint="Set CUSTOMSEARCH_CACHE to the alias of a shared cache (e.g. Memcached, Redis or the database cache).",
+            id='customsearch.W001',
+        )]
+    return []
+
+
+def get_plan_timeout():
+    """
+    Get the maximum age of compiled plans, after which they are compiled
+    again even if the version did not change (e.g. after a rolled back
+    change). Set with CUSTOMSEARCH_PLAN_CACHE_TIMEOUT (default one hour).
+    """
+    return getattr( settings, 'CUSTOMSEARCH_PLAN_CACHE_TIMEOUT', 3600 )
+
+
+def _version_key( search_pk ):
+    return 'customsearch:version:%s' % search_pk
+
+
+def _layout_version_key( layout_pk ):
+    return 'customsearch:layout:%s' % layout_pk
+
+
+def _watermark_key( model ):
+    return 'customsearch:data:%s.%s' % ( model._meta.app_label, model._meta.model_name )
+
+
+def _get_token( key ):
+    cache = get_cache()
+    token = cache.get( key )
+    if token is None:
+        token = uuid4().hex
+        if not cache.add( key, token, None ):
+            token = cache.get( key, token )
+    return token
+
+
+def get_search_version( search_pk ):
+    """
+    Get the definition version of a search. If the version is missing
+    from the cache (e.g. after eviction) a new one is generated, which
+    only means derived data is computed again.
+    """
+    return _get_token( _version_key( search_pk ) )
+
+
+def bump_search_versions( search_pks ):
+    """
+    Give the searches a new definition version.
+    """
+    cache = get_cache()
+    cache.set_many( dict( [( _version_key( pk ), uuid4().hex ) for pk in search_pks] ), None )
+
+
+def get_layout_version( layout_pk ):
+    """
+    Get the version of a layout, which changes whenever the compiled
+    layout plan (see layout.py) would change.
+    """
+    return _get_token( _layout_version_key( layout_pk ) )
+
+
+def bump_layout_versions( layout_pks ):
+    """
+    Give the layouts a new version.
+    """
+    get_cache().set_many( dict( [( _layout_version_key( pk ), uuid4().hex ) for pk in layout_pks] ), None )
+
+
+def get_data_watermark( model ):
+    """
+    Get the data watermark of a model.
+    """
+    return _get_token( _watermark_key( model._meta.concrete_model ) )
+
+
+def bump_data_watermark( model ):
+    """
+    Give a model a new data watermark.
+    """
+    get_cache().set( _watermark_key( model._meta.concrete_model ), uuid4().hex, None )
+
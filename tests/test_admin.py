@@ -1,8 +1,21 @@
 from datetime import datetime
+import json
+import re
+import shutil
+import tempfile
+
+from django.core import mail
 from django.urls import reverse
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.html import escape
 
+from djangoplicity.customsearch import progress, resultcache
+from djangoplicity.customsearch.fragments import render_rows
+from djangoplicity.customsearch.tasks import compute_results, export_search
+from djangoplicity.customsearch.versions import get_cache
 from test_project.models import Entry
 from .utils import (
     create_custom_search, create_custom_search_model,
@@ -13,6 +26,9 @@ from .utils import (
 
 class AdminSiteTests(TestCase):
     def setUp(self):
+        # Versions and plans are kept in the cache, which is not rolled
+        # back with the database after each test
+        get_cache().clear()
         self.client = Client()
         self.admin_user = get_user_model().objects.create_superuser(
             username='admin',
@@ -94,3 +110,189 @@ class AdminSiteTests(TestCase):
         self.assertContains(res, 'Labels')
         self.assertContains(res, 'Export')
         self.assertContains(res, 'Include entrys where title contains &quot;Lorem&quot;.')
+
+    @override_settings(CUSTOMSEARCH_KEYSET_PAGINATION=True)
+    def test_custom_search_search_page_keyset_pagination(self):
+        """Test that the search page shows next/previous links in keyset pagination mode"""
+        for i in range(150):
+            Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now())
+
+        url = reverse('admin:customsearch_customsearch_search', args=[self.cs.pk])
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertContains(res, 'Entry 149')
+        self.assertNotContains(res, '>Entry 49<')
+        self.assertNotContains(res, 'Previous')
+
+        cursor = res.context['objects'].next_cursor
+        res = self.client.get(url, {'c': cursor})
+        self.assertContains(res, '>Entry 49<')
+        self.assertContains(res, 'Previous')
+        self.assertNotContains(res, 'Next')
+
+    def test_custom_search_search_page_counts_once(self):
+        """Test that the search page counts the results only once"""
+        for i in range(150):
+            Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now())
+
+        url = reverse('admin:customsearch_customsearch_search', args=[self.cs.pk])
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(url, {'p': 2})
+        self.assertContains(res, '<strong>Total:</strong> 150', html=True)
+        self.assertEqual(len([q for q in queries.captured_queries if 'COUNT(' in q['sql']]), 1)
+
+    @override_settings(CUSTOMSEARCH_RESULT_CACHE='default')
+    def test_custom_search_search_page_result_cache(self):
+        """Test that the search page is paginated from the result cache"""
+        for i in range(150):
+            Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now())
+
+        url = reverse('admin:customsearch_customsearch_search', args=[self.cs.pk])
+        res = self.client.get(url, {'p': 2})
+        self.assertContains(res, '<strong>Total:</strong> 150', html=True)
+        self.assertContains(res, '>Entry 49<')
+
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(url, {'p': 1})
+        self.assertContains(res, '>Entry 149<')
+        self.assertFalse([q for q in queries.captured_queries if 'COUNT(' in q['sql'] or 'DISTINCT' in q['sql']])
+
+    def test_custom_search_csv_export(self):
+        """Test that the search results are streamed as CSV"""
+        for i in range(3):
+            Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now())
+        res = self.client.get(reverse('admin:customsearch_customsearch_export_csv', args=[self.cs.pk]))
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.streaming)
+        self.assertEqual(res['Content-Type'], 'text/csv')
+        lines = b''.join(res.streaming_content).splitlines()
+        self.assertEqual(lines[0], b'title')
+        self.assertEqual(sorted(lines[1:]), [b'Entry 0', b'Entry 1', b'Entry 2'])
+
+    def test_custom_search_export_download_link(self):
+        """Test that stored exports are emailed as a download link"""
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        Entry.objects.create(title='Entry', body='', pub_date=datetime.now())
+
+        with self.settings(
+            CUSTOMSEARCH_EXPORT_STORAGE='django.core.files.storage.FileSystemStorage',
+            CUSTOMSEARCH_EXPORT_STORAGE_OPTIONS={'location': location},
+        ):
+            export_search(self.cs.pk, 'user@example.org', base_url='http://testserver/')
+            self.assertEqual(mail.outbox[0].attachments, [])
+            url = re.search(r'http://testserver(\S+)', mail.outbox[0].body).group(1)
+
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(b''.join(res.streaming_content).startswith(b'PK'))
+
+            self.assertEqual(self.client.get(url.replace(':', 'x:', 1)).status_code, 404)
+
+    def test_custom_search_export_progress(self):
+        """Test that the export progress is shown and exports can be cancelled"""
+        progress.start('abc123', self.cs.pk, 3)
+        url = reverse('admin:customsearch_customsearch_export_progress', args=[self.cs.pk, 'abc123'])
+        res = self.client.get(url)
+        self.assertContains(res, '0 of 3 rows exported')
+        self.assertContains(res, 'Cancel export')
+
+        res = self.client.post(url, {'cancel': '1'})
+        self.assertContains(res, 'was cancelled')
+        self.assertEqual(progress.get_progress('abc123')['state'], 'cancelled')
+
+        url = reverse('admin:customsearch_customsearch_export_progress', args=[self.cs.pk, 'def456'])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        # Exports of other searches are not cancelled
+        progress.start('ghi789', self.cs.pk + 1, 3)
+        url = reverse('admin:customsearch_customsearch_export_progress', args=[self.cs.pk, 'ghi789'])
+        self.assertEqual(self.client.post(url, {'cancel': '1'}).status_code, 404)
+        self.assertEqual(progress.get_progress('ghi789')['state'], 'running')
+
+    @override_settings(CUSTOMSEARCH_RESULT_CACHE='default')
+    def test_custom_search_async_results(self):
+        """Test that expensive searches are shown once computed in the background"""
+        Entry.objects.create(title='Entry', body='', pub_date=datetime.now())
+        self.cs.async_results = True
+        self.cs.save()
+        url = reverse('admin:customsearch_customsearch_search', args=[self.cs.pk])
+
+        # Mark the computation as started, so no task is sent
+        self.assertTrue(resultcache.start_computing(self.cs))
+        self.assertContains(self.client.get(url), 'being computed')
+
+        compute_results(self.cs.pk)
+        res = self.client.get(url)
+        self.assertTemplateUsed(res, 'admin/customsearch/list.html')
+        self.assertEqual(res.context['object_count'], 1)
+
+    def test_custom_search_json(self):
+        """Test the JSON results view"""
+        for i in range(3):
+            Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now())
+        url = reverse('admin:customsearch_customsearch_search_json', args=[self.cs.pk])
+
+        res = self.client.get(url, {'n': 2, 'fields': 'title'})
+        self.assertEqual(res['Content-Type'], 'application/json')
+        data = json.loads(res.content)
+        self.assertEqual(len(data['results']), 2)
+        data = json.loads(self.client.get(url, {'n': 2, 'c': data['next']}).content)
+        self.assertEqual(len(data['results']), 1)
+
+        self.assertEqual(self.client.get(url, {'fields': 'unknown'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'n': 'x'}).status_code, 400)
+
+    def test_custom_search_not_modified(self):
+        """Test that unchanged results pages are answered with 304 Not Modified"""
+        entry = Entry.objects.create(title='Entry', body='', pub_date=datetime.now())
+        url = reverse('admin:customsearch_customsearch_search', args=[self.cs.pk])
+
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        etag = res['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertFalse([q for q in queries.captured_queries if 'test_project_entry' in q['sql']])
+
+        self.assertEqual(self.client.get(url + '?o=1', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        entry.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_custom_search_rows_are_cached(self):
+        """Test that the rendered rows of a results page are cached"""
+        entry = Entry.objects.create(title='<Entry>', body='', pub_date=datetime.now())
+        url = reverse('admin:customsearch_customsearch_search', args=[self.cs.pk])
+        change_url = reverse('admin:test_project_entry_change', args=[entry.pk])
+
+        res = self.client.get(url)
+        self.assertContains(res, '<a href="%s" class="changelink">' % change_url)
+        self.assertContains(res, '<td>&lt;Entry&gt;</td>')
+
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(url)
+        self.assertContains(res, '<td>&lt;Entry&gt;</td>')
+        self.assertEqual(len([q for q in queries.captured_queries if 'test_project_entry' in q['sql'] and 'COUNT(' not in q['sql']]), 0)
+
+        # Change links are quoted like {% url %} does
+        pk = u'a b&c\xe9'
+        rows = render_rows([{'object_pk': pk, 'values': []}], 'admin:test_project_entry_change')
+        self.assertIn('<a href="%s" class="changelink">' % escape(reverse('admin:test_project_entry_change', args=[pk])), rows)
+
+    @override_settings(CUSTOMSEARCH_COUNT_FREE_PAGINATION=True)
+    def test_custom_search_count_free_pagination(self):
+        """Test that results are paginated without counting them"""
+        for i in range(101):
+            Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now())
+        url = reverse('admin:customsearch_customsearch_search', args=[self.cs.pk])
+
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(url)
+        self.assertFalse([q for q in queries.captured_queries if 'COUNT(' in q['sql']])
+        self.assertContains(res, 'not counted')
+        self.assertContains(res, '?p=2')
+
+        res = self.client.get(url, {'p': 2})
+        self.assertContains(res, '?p=1')
+        self.assertNotContains(res, '?p=3')
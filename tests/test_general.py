@@ -1,12 +1,47 @@
+from cStringIO import StringIO
+from datetime import date, datetime
+from decimal import Decimal
+from xml.etree import ElementTree
+import base64
+import gzip
+import json
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+
+from django.contrib.auth.models import Group, User
+from django.core import mail, signing
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from djangoplicity.customsearch.models import (
     CustomSearchField,
-    CustomSearchLayoutField, CustomSearch,
+    CustomSearchLayoutField, CustomSearch, CustomSearchGroup,
     MATCH_TYPE
 )
-from test_project.models import Entry, Author
+from djangoplicity.customsearch import artifacts, coalesce, invertedindex, jsonapi, progress, resultcache
+from djangoplicity.customsearch.exporter import CsvExporter, XlsxStreamingExporter, iter_csv
+from djangoplicity.customsearch.fragments import format_value, fragment_key, get_fragment, set_fragment
+from djangoplicity.customsearch.freetext import FullTextQuery, document_sql, fulltext_index_sql
+from djangoplicity.customsearch.invertedindex import invalidate_inverted_indexes
+from djangoplicity.customsearch.jsonapi import ResultsJSONEncoder, search_results
+from djangoplicity.customsearch.pagination import CountedPaginator, InvalidCursor, KeysetPaginator, UncountedPaginator, \
+    count_results, elided_page_range
+from djangoplicity.customsearch.query import compile_search, get_search_plan, get_time_bucket
+from djangoplicity.customsearch.resultcache import get_result_pks, iter_rows, result_cache_key
+from djangoplicity.customsearch.versions import bump_layout_versions, bump_search_versions, check_cache, get_cache, \
+    get_data_watermark
+from djangoplicity.customsearch.tasks import cancel_export, compute_results, export_search, export_shard, fail_export, \
+    merge_export_shards
+from test_project.models import Article, Entry, Author
 from .utils import (
     create_custom_search, create_custom_search_model,
     create_custom_search_field, create_custom_search_group,
@@ -16,6 +51,17 @@ from .utils import (
 
 
 class TestModels(TestCase):
+    def setUp(self):
+        # Versions and plans are kept in the cache, which is not rolled
+        # back with the database after each test
+        get_cache().clear()
+        # Keep export parts out of the shared temporary directory
+        shard_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shard_dir)
+        shard_settings = override_settings(CUSTOMSEARCH_EXPORT_SHARD_DIR=shard_dir)
+        shard_settings.enable()
+        self.addCleanup(shard_settings.disable)
+
     @classmethod
     def setUpTestData(cls):
         cls.csm = create_custom_search_model(name='Entry Custom Search Model', model=Entry)
@@ -359,3 +405,777 @@ class TestModels(TestCase):
 
         order_by = ordering.order_by_field()
         self.assertEqual(order_by, 'body_field')
+
+    def test_custom_search_layout_iter_data_table(self):
+        """Test that iter_data_table streams the same rows as data_table"""
+        for title in ['Lorem', 'Ipsum', 'Dolor']:
+            Entry.objects.create(title=title, body='', pub_date=datetime.now())
+
+        qs = self.cs.get_queryset()
+        expected = [(row['object_pk'], row['values']) for row in self.csl.data_table(qs)]
+
+        rows = self.csl.iter_data_table(qs)
+        self.assertFalse(isinstance(rows, list))
+        self.assertEqual(list(rows), expected)
+        self.assertEqual(list(self.cs.get_data_table()), expected)
+
+    def test_custom_search_layout_plan_is_cached(self):
+        """Test that the layout plan is compiled once and invalidated when the layout changes"""
+        self.csl.header()
+        with self.assertNumQueries(0):
+            header = self.csl.header()
+        self.assertEqual([name for _field, name, _field_name in header], ['title'])
+
+        body = create_custom_search_field(model=self.csm, name='body')
+        create_custom_search_layout_field(layout=self.csl, field=body, position=1)
+        self.assertEqual(sorted(name for _field, name, _field_name in self.csl.header()), ['body', 'title'])
+
+        # Versions are shared, so plans are compiled again after changes
+        # made by other processes
+        plan = self.csl.get_plan()
+        bump_layout_versions([self.csl.pk])
+        self.assertIsNot(self.csl.get_plan(), plan)
+
+    def test_custom_search_layout_related_lookups(self):
+        """Test that relation columns are fetched with a constant number of queries"""
+        author_model = create_custom_search_model(name='Author model', model=Author)
+        author_layout = create_custom_search_layout(model=author_model, name='Author layout')
+        create_custom_search_layout_field(layout=author_layout, field=create_custom_search_field(author_model, 'article'))
+        author_search = create_custom_search(model=author_model, group=self.csg, layout=author_layout)
+
+        article_model = create_custom_search_model(name='Article model', model=Article)
+        article_layout = create_custom_search_layout(model=article_model, name='Article layout')
+        create_custom_search_layout_field(
+            layout=article_layout,
+            field=create_custom_search_field(article_model, 'author', selector='__first_name'),
+            expand_rel=True,
+        )
+        article_search = create_custom_search(model=article_model, group=self.csg, layout=article_layout)
+
+        for i in range(3):
+            author = Author.objects.create(first_name='First %s' % i, last_name='Last')
+            Article.objects.create(author=author, headline='Headline %s' % i)
+            Article.objects.create(author=author, headline='Other %s' % i)
+
+        self.assertEqual(author_layout.get_plan().prefetch_related, ['article_set'])
+        self.assertEqual(article_layout.get_plan().select_related, ['author'])
+
+        qs = author_search.get_results_queryset(evaluate=False)[1]
+        with self.assertNumQueries(2):
+            rows = author_layout.data_table(qs)
+        self.assertEqual(sorted(row['values'] for row in rows), [
+            ['"Headline %s";"Other %s"' % (i, i)] for i in range(3)
+        ])
+
+        qs = article_search.get_results_queryset(evaluate=False)[1]
+        with self.assertNumQueries(1):
+            rows = list(article_layout.iter_data_table(qs))
+        self.assertEqual(sorted(values for _pk, values in rows), sorted(
+            [['First %s' % i] for i in range(3)] * 2
+        ))
+
+    def test_custom_search_layout_expanded_relation(self):
+        """Test that expanded relation columns fetch the related table once per table"""
+        model = create_custom_search_model(name='Author model', model=Author)
+        layout = create_custom_search_layout(model=model, name='Author layout')
+        create_custom_search_layout_field(layout=layout, field=create_custom_search_field(model, 'article'), expand_rel=True)
+        search = create_custom_search(model=model, group=self.csg, layout=layout)
+
+        authors = [Author.objects.create(first_name='First %s' % i, last_name='Last') for i in range(3)]
+        articles = [Article.objects.create(author=author, headline='Headline %s' % i) for i, author in enumerate(authors)]
+
+        self.assertEqual(
+            [name for _field, name, _field_name in layout.header()],
+            ['article: %s' % a.headline for a in Article.objects.all()]
+        )
+
+        qs = search.get_results_queryset(evaluate=False)[1]
+        with self.assertNumQueries(3):
+            rows = layout.data_table(qs)
+
+        for row in rows:
+            self.assertEqual(row['values'], ['X' if a.author_id == row['object_pk'] else '' for a in articles])
+
+        # A bound table is shared by the header and the rows
+        table = layout.bind()
+        with self.assertNumQueries(2):
+            header = search.get_results_queryset(evaluate=False, table=table)[4]
+            self.assertEqual(layout.data_table(qs, table=table), rows)
+        self.assertEqual(header, table.header)
+        # Two queries per chunk, none for the related table
+        with self.assertNumQueries(6):
+            list(resultcache.iter_rows(layout, Author.objects.all(), [a.pk for a in authors], chunk_size=1, table=table))
+
+        # The JSON API fetches the related table once, for the ordering and the columns
+        with self.assertNumQueries(4):
+            data = search_results(search, fields=['article'])
+        self.assertEqual([c['name'] for c in data['columns']], [name for _field, name, _field_name in header])
+
+    def test_custom_search_layout_projection(self):
+        """Test that projected rows match rows built from model instances"""
+        model = create_custom_search_model(name='Article model', model=Article)
+        layout = create_custom_search_layout(model=model, name='Article layout')
+        create_custom_search_layout_field(layout=layout, field=create_custom_search_field(model, 'headline'), position=0)
+        create_custom_search_layout_field(
+            layout=layout,
+            field=create_custom_search_field(model, 'author', selector='__first_name'),
+            expand_rel=True,
+            position=1,
+        )
+        search = create_custom_search(model=model, group=self.csg, layout=layout)
+
+        author = Author.objects.create(first_name='First', last_name='Last')
+        Article.objects.create(author=author, headline='Lorem')
+        Article.objects.create(author=None, headline='Ipsum')
+
+        self.assertTrue(layout.get_plan().projectable)
+        qs = search.get_results_queryset(evaluate=False)[1]
+        expected = sorted((row['object_pk'], row['values']) for row in layout.data_table(qs))
+
+        with self.assertNumQueries(1):
+            rows = layout.data_table(qs, projection=True)
+        self.assertEqual(sorted((row['object_pk'], row['values']) for row in rows), expected)
+        self.assertEqual(sorted(layout.iter_data_table(qs, projection=True)), expected)
+
+        # Property and relation columns require model instances
+        create_custom_search_layout_field(layout=layout, field=create_custom_search_field(model, 'author'), position=2)
+        self.assertFalse(layout.get_plan().projectable)
+        self.assertTrue(all(row['object'] is not None for row in layout.data_table(qs, projection=True)))
+
+    def test_keyset_paginator(self):
+        """Test that keyset pagination walks the same rows as the ordered queryset"""
+        authors = [Author.objects.create(first_name=name, last_name='Last') for name in 'CABDCAE']
+        qs = Author.objects.all().order_by('first_name')
+        expected = list(qs.order_by('first_name', 'pk'))
+
+        paginator = KeysetPaginator(qs, 3)
+        self.assertEqual(paginator.keys, [('first_name', False), ('pk', False)])
+
+        pages = [paginator.page()]
+        self.assertFalse(pages[0].has_previous())
+        while pages[-1].has_next():
+            pages.append(paginator.page(pages[-1].next_cursor))
+        self.assertEqual(sum([list(p.object_list) for p in pages], []), expected)
+        self.assertEqual(len(pages), 3)
+
+        # Walk back from the last page
+        page = pages[-1]
+        self.assertEqual(list(paginator.page(page.previous_cursor).object_list), expected[3:6])
+        self.assertEqual(list(paginator.page(pages[1].previous_cursor).object_list), expected[:3])
+
+        # Invalid cursors return the first page
+        self.assertEqual(list(paginator.page('not a cursor').object_list), expected[:3])
+        self.assertEqual(len(authors), 7)
+
+        # Cursors with values which do not fit the ordering are rejected
+        cursor = base64.urlsafe_b64encode(json.dumps(['n', 'A', 'x']))
+        self.assertRaises(InvalidCursor, paginator.page, cursor)
+
+    def test_keyset_paginator_descending_with_nulls(self):
+        """Test keyset pagination over a descending ordering with NULL values"""
+        author = Author.objects.create(first_name='First', last_name='Last')
+        for i in range(5):
+            Article.objects.create(author=author if i % 2 else None, headline='Headline %s' % i)
+        qs = Article.objects.all().order_by('-author', '-headline')
+
+        paginator = KeysetPaginator(qs, 2)
+        self.assertEqual(paginator.keys, [('author', True), ('headline', True), ('pk', False)])
+
+        page = paginator.page()
+        rows = list(page.object_list)
+        while page.has_next():
+            page = paginator.page(page.next_cursor)
+            rows += list(page.object_list)
+        self.assertEqual(sorted(a.pk for a in rows), sorted(Article.objects.values_list('pk', flat=True)))
+
+    def test_counted_paginator(self):
+        """Test that a precomputed count is used by the paginator"""
+        for i in range(5):
+            Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now())
+        qs = self.cs.get_queryset()
+
+        count, estimated = count_results(qs)
+        self.assertEqual((count, estimated), (5, False))
+
+        paginator = CountedPaginator(qs, 2, count=count)
+        with self.assertNumQueries(1):
+            self.assertEqual(paginator.num_pages, 3)
+            self.assertEqual(len(paginator.page(3).object_list), 1)
+
+    @override_settings(CUSTOMSEARCH_RESULT_CACHE='default')
+    def test_result_cache(self):
+        """Test that the ordered primary keys of a search are cached until the search changes"""
+        entries = [Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now()) for i in range(5)]
+        qs = self.cs.get_queryset()
+
+        self.addCleanup(setattr, resultcache, 'RESULT_CACHE_CHUNK_SIZE', resultcache.RESULT_CACHE_CHUNK_SIZE)
+        resultcache.RESULT_CACHE_CHUNK_SIZE = 2
+
+        pks = get_result_pks(self.cs, qs)
+        self.assertEqual(pks, [e.pk for e in reversed(entries)])
+
+        with self.assertNumQueries(0):
+            cached = get_result_pks(self.cs, qs)
+            self.assertEqual(len(cached), 5)
+            self.assertEqual(cached[1:4], pks[1:4])
+            self.assertEqual(cached[-1], pks[-1])
+            self.assertEqual(list(cached), pks)
+
+        # Changing the search invalidates the cached result
+        create_custom_search_ordering(self.cs, field=self.csf)
+        get_search_plan(self.cs)
+        with self.assertNumQueries(1):
+            get_result_pks(self.cs, qs)
+
+        # Larger results are neither cached nor read in full, and not read
+        # again until the entry expires
+        with self.settings(CUSTOMSEARCH_RESULT_CACHE_MAX_ROWS=3):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertIsNone(get_result_pks(self.cs, qs, 'Entry'))
+            self.assertIn('LIMIT 4', queries.captured_queries[-1]['sql'])
+            with self.assertNumQueries(0):
+                self.assertIsNone(get_result_pks(self.cs, qs, 'Entry'))
+
+        # Results of searches relative to the current time expire
+        pub_date = create_custom_search_field(model=self.csm, name='pub_date')
+        create_custom_search_condition(search=self.cs, field=pub_date, value='now()', match=17)
+        with self.settings(CUSTOMSEARCH_TIME_DEPENDENT_MAX_AGE=10 ** 10):
+            key = result_cache_key(self.cs)
+        with self.settings(CUSTOMSEARCH_TIME_DEPENDENT_MAX_AGE=1):
+            self.assertNotEqual(key, result_cache_key(self.cs))
+
+    def test_iter_rows(self):
+        """Test that rows for a list of primary keys are returned in the same order"""
+        entries = [Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now()) for i in range(5)]
+        pks = [entries[3].pk, entries[0].pk, entries[4].pk]
+
+        rows = list(iter_rows(self.csl, Entry.objects.all(), pks, chunk_size=2, projection=True))
+        self.assertEqual(rows, [(e.pk, [e.title]) for e in [entries[3], entries[0], entries[4]]])
+        self.assertEqual(get_result_pks(self.cs, self.cs.get_queryset()), None)
+
+    def test_custom_search_plan_is_cached(self):
+        """Test that a compiled search is cached until the search changes"""
+        Entry.objects.create(title='Lorem', body='', pub_date=datetime.now())
+        Entry.objects.create(title='Ipsum', body='', pub_date=datetime.now())
+        create_custom_search_condition(search=self.cs, field=self.csf, value='Lorem', match=0)
+
+        self.cs.get_queryset()
+        with self.assertNumQueries(0):
+            qs = self.cs.get_queryset(freetext='Lor')
+        self.assertEqual([e.title for e in qs], ['Lorem'])
+
+        # The plan can be stored in a shared cache
+        plan = pickle.loads(pickle.dumps(get_search_plan(self.cs)))
+        self.assertEqual([e.title for e in plan.queryset()], ['Lorem'])
+
+        create_custom_search_condition(search=self.cs, field=self.csf, value='Ipsum', match=0)
+        self.assertEqual(sorted(e.title for e in self.cs.get_queryset()), ['Ipsum', 'Lorem'])
+
+        # Plans expire, e.g. in case a change was rolled back
+        with self.settings(CUSTOMSEARCH_PLAN_CACHE_TIMEOUT=-1):
+            bump_search_versions([self.cs.pk])
+            plan = get_search_plan(self.cs)
+            self.assertIsNot(get_search_plan(self.cs), plan)
+
+    def test_custom_search_now_condition(self):
+        """Test that now() conditions are compared with the current time"""
+        pub_date = create_custom_search_field(model=self.csm, name='pub_date')
+        condition = create_custom_search_condition(search=self.cs, field=pub_date, value='now()', match=17)
+        self.assertTrue(isinstance(condition.prepared_value(), datetime))
+
+        Entry.objects.create(title='Old', body='', pub_date=datetime(2000, 1, 1))
+        self.assertEqual([e.title for e in self.cs.get_queryset()], ['Old'])
+
+        # Such searches are keyed by a time bucket
+        with self.settings(CUSTOMSEARCH_TIME_DEPENDENT_MAX_AGE=60):
+            self.assertEqual(get_time_bucket(self.cs), int(time.time() // 60))
+        condition.delete()
+        self.assertIsNone(get_time_bucket(self.cs))
+
+    def test_custom_search_multivalued_conditions(self):
+        """Test that conditions on multi-valued relations do not duplicate rows"""
+        model = create_custom_search_model(name='Author model', model=Author)
+        layout = create_custom_search_layout(model=model, name='Author layout')
+        headline = create_custom_search_field(model, 'article', selector='__headline')
+        headline.enable_freetext = True
+        headline.save()
+        search = create_custom_search(model=model, group=self.csg, layout=layout)
+
+        for name, headlines in [('A', ['Lorem 1', 'Lorem 2']), ('B', ['Lorem 3', 'Ipsum']), ('C', ['Ipsum'])]:
+            author = Author.objects.create(first_name=name, last_name='Last')
+            for h in headlines:
+                Article.objects.create(author=author, headline=h)
+
+        create_custom_search_condition(search=search, field=headline, value='Lorem', match=2)
+        qs = search.get_queryset()
+        self.assertEqual(sorted(a.first_name for a in qs), ['A', 'B'])
+        self.assertFalse(qs.query.distinct)
+
+        self.assertEqual([a.first_name for a in search.get_queryset(freetext='ipsum')], ['B'])
+
+        create_custom_search_condition(search=search, field=headline, value='Ipsum', match=0, exclude=True)
+        self.assertEqual([a.first_name for a in search.get_queryset()], ['A'])
+
+        # Ordering by a multi-valued relation still joins it
+        create_custom_search_ordering(search, field=headline)
+        self.assertTrue(search.get_queryset().query.distinct)
+
+    def assertOptimizedEqual(self, search):
+        optimized = compile_search(search).queryset()
+        self.assertEqual(
+            sorted(e.pk for e in optimized),
+            sorted(e.pk for e in compile_search(search, optimize=False).queryset())
+        )
+        return optimized
+
+    def test_custom_search_optimize_exact_conditions(self):
+        """Test that ORed exact conditions are merged into IN lookups"""
+        for title in ['Lorem', 'lorem', 'Ipsum', 'Dolor', 'Sit']:
+            Entry.objects.create(title=title, body='', pub_date=datetime.now())
+
+        for title in ['Lorem', 'Ipsum', 'Amet', 'Lorem']:
+            create_custom_search_condition(search=self.cs, field=self.csf, value=title, match=0)
+        qs = self.assertOptimizedEqual(self.cs)
+        self.assertEqual(sorted(e.title for e in qs), ['Ipsum', 'Lorem'])
+        self.assertIn(' IN (', str(qs.query))
+        self.assertNotIn(' OR ', str(qs.query))
+
+        body = create_custom_search_field(model=self.csm, name='body')
+        for title in ['LOREM', 'dolor']:
+            create_custom_search_condition(search=self.cs, field=body, value=title, match=5)
+        Entry.objects.filter(title='Ipsum').update(body='Dolor')
+        qs = self.assertOptimizedEqual(self.cs)
+        self.assertEqual([e.title for e in qs], ['Ipsum'])
+        self.assertIn('UPPER(', str(qs.query))
+
+    def test_custom_search_optimize_contradictions(self):
+        """Test that contradictory conditions result in an empty queryset"""
+        Entry.objects.create(title='Lorem', body='', pub_date=datetime.now())
+
+        create_custom_search_condition(search=self.cs, field=self.csf, value='Lorem', match=0, and_together=True)
+        create_custom_search_condition(search=self.cs, field=self.csf, value='Lorem', match=0, and_together=True)
+        self.assertEqual(len(compile_search(self.cs).filters), 1)
+        self.assertEqual(len(self.assertOptimizedEqual(self.cs)), 1)
+
+        create_custom_search_condition(search=self.cs, field=self.csf, value='Ipsum', match=0, and_together=True)
+        self.assertTrue(compile_search(self.cs).empty)
+        self.assertEqual(len(self.assertOptimizedEqual(self.cs)), 0)
+
+        search = create_custom_search(model=self.csm, group=self.csg, layout=self.csl)
+        create_custom_search_condition(search=search, field=self.csf, value='Lorem', match=0)
+        create_custom_search_condition(search=search, field=self.csf, value='Lorem', match=0, exclude=True)
+        self.assertTrue(compile_search(search).empty)
+        self.assertEqual(len(self.assertOptimizedEqual(search)), 0)
+
+    def test_custom_search_fulltext_backend(self):
+        """Test the full-text freetext backend"""
+        Entry.objects.create(title='Lorem ipsum', body='', pub_date=datetime.now())
+        Entry.objects.create(title='Dolor', body='', pub_date=datetime.now())
+        self.addCleanup(setattr, self.csm, 'freetext_backend', 'icontains')
+        self.csm.freetext_backend = 'fulltext'
+        self.csm.save()
+
+        # Other databases fall back to icontains
+        self.assertEqual(get_search_plan(self.cs).freetext_backend, 'fulltext')
+        self.assertEqual([e.title for e in self.cs.get_queryset(freetext='Ipsum')], ['Lorem ipsum'])
+
+        # The query uses the indexed expression
+        qs = Entry.objects.filter(pk__customsearch_fulltext=FullTextQuery(['title'], 'simple', 'ipsum:*'))
+        self.assertIn(document_sql(['"title"'], 'simple', '"test_project_entry"'), str(qs.query))
+        self.assertIn(document_sql(['"title"'], 'simple'), fulltext_index_sql(self.csm, connection)[1])
+
+    def test_custom_search_inverted_index_backend(self):
+        """Test the in-process inverted index freetext backend"""
+        self.addCleanup(invalidate_inverted_indexes)
+        lorem = Entry.objects.create(title='Lorem ipsum', body='', pub_date=datetime.now())
+        Entry.objects.create(title='Ipsum dolor', body='', pub_date=datetime.now())
+        self.addCleanup(setattr, self.csm, 'freetext_backend', 'icontains')
+        self.csm.freetext_backend = 'index'
+        self.csm.save()
+
+        def search(freetext):
+            return sorted(e.title for e in self.cs.get_queryset(freetext=freetext))
+
+        self.assertEqual(search('IPSUM'), ['Ipsum dolor', 'Lorem ipsum'])
+        self.assertEqual(search('psu lore'), ['Lorem ipsum'])
+        self.assertEqual(search('orem'), ['Lorem ipsum'])
+        self.assertEqual(search('amet'), [])
+        with self.settings(CUSTOMSEARCH_FREETEXT_INDEX_MAX_PKS=1):
+            self.assertEqual(search('ipsum'), ['Ipsum dolor', 'Lorem ipsum'])
+
+        # The index is updated when objects are saved or deleted
+        sit = Entry.objects.create(title='Sit amet', body='', pub_date=datetime.now())
+        self.assertEqual(search('amet'), ['Sit amet'])
+        lorem.title = 'Lorem'
+        lorem.save()
+        self.assertEqual(search('ipsum'), ['Ipsum dolor'])
+        sit.delete()
+        self.assertEqual(search('amet'), [])
+
+        # Freetext candidates are combined with the conditions
+        create_custom_search_condition(search=self.cs, field=self.csf, value='Lorem', match=0)
+        self.assertEqual(search('lorem'), ['Lorem'])
+        self.assertEqual(search('dolor'), [])
+
+    def test_inverted_index_concurrent_builds(self):
+        """Test that changes during a build are seen even if another build of the index finished meanwhile"""
+        self.addCleanup(invalidate_inverted_indexes)
+        Entry.objects.create(title='Lorem', body='', pub_date=datetime.now())
+        build = invertedindex.InvertedIndex.build
+        self.addCleanup(setattr, invertedindex.InvertedIndex, 'build', build)
+        builds = []
+
+        def concurrent_build(index):
+            build(index)
+            builds.append(index)
+            if len(builds) == 1:
+                # Another build starts and finishes, then an object changes
+                invertedindex.get_inverted_index(Entry, ['title'])
+                Entry.objects.create(title='Ipsum', body='', pub_date=datetime.now())
+        invertedindex.InvertedIndex.build = concurrent_build
+
+        index = invertedindex.get_inverted_index(Entry, ['title'])
+        self.assertEqual(len(builds), 2)
+        self.assertEqual(len(index.search('ipsum')), 1)
+        self.assertEqual(invertedindex._changes, {})
+
+    def test_iter_csv(self):
+        """Test that CSV files are generated in chunks"""
+        chunks = list(iter_csv([u'Title', u'Date'], [[u'L\xf6rem, ipsum', datetime(2000, 1, 1)], [None, 1], [u'"Dolor"', True]], batch_size=2))
+        self.assertEqual(chunks, [
+            'Title,Date\r\n',
+            '"L\xc3\xb6rem, ipsum",2000-01-01 00:00:00\r\n,1\r\n',
+            '"""Dolor""",True\r\n',
+        ])
+
+    def test_xlsx_streaming_exporter(self):
+        """Test that the xlsx exporter writes valid sheets and starts a new sheet when one is full"""
+        out = StringIO()
+        exporter = XlsxStreamingExporter(out, title='Entries', header=[('Title', None), ('Date', None)], max_rows=3)
+        rows = [[u'L\xf6rem <ipsum> &', date(2000, 1, 2)], [None, 1.5], [u'Dolor\x01', True], [42, datetime(1900, 1, 1, 12)]]
+        for row in rows:
+            exporter.writerow(row)
+        exporter.save()
+
+        ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+        zf = zipfile.ZipFile(StringIO(out.getvalue()))
+        sheets = ElementTree.fromstring(zf.read('xl/workbook.xml')).findall('.//%ssheet' % ns)
+        self.assertEqual([s.get('name') for s in sheets], ['Entries', 'Entries (2)'])
+
+        def cells(name):
+            sheet = ElementTree.fromstring(zf.read(name))
+            return [[c.findtext('.//%st' % ns) or c.findtext('%sv' % ns) for c in r] for r in sheet.iter('%srow' % ns)]
+
+        self.assertEqual(cells('xl/worksheets/sheet1.xml'), [
+            ['Title', 'Date'], [u'L\xf6rem <ipsum> &', '36527.0'], [None, '1.5'],
+        ])
+        self.assertEqual(cells('xl/worksheets/sheet2.xml'), [
+            ['Title', 'Date'], ['Dolor', '1'], ['42', '2.5'],
+        ])
+
+        # NaN and infinity are written as empty cells
+        out = StringIO()
+        exporter = XlsxStreamingExporter(out, header=[('A', None), ('B', None)])
+        exporter.writerow([float('nan'), float('-inf')])
+        exporter.writerow([Decimal('NaN'), Decimal('1.5')])
+        exporter.save()
+        zf = zipfile.ZipFile(StringIO(out.getvalue()))
+        self.assertEqual(cells('xl/worksheets/sheet1.xml'), [['A', 'B'], [None, None], [None, '1.5']])
+
+    def test_exporter_column_converters(self):
+        """Test that exporters compile one converter per value type"""
+        fields = self.csl.get_plan().value_fields(self.csl.header())
+        self.assertEqual(fields, [Entry._meta.get_field('title')])
+
+        out = StringIO()
+        exporter = CsvExporter(out, header=[('Date', None), ('Value', None)], fields=[Entry._meta.get_field('pub_date'), None])
+        calls = []
+        make_converter = exporter._make_converter
+        exporter._make_converter = lambda cls: calls.append(cls) or make_converter(cls)
+
+        exporter.writerows([[date(2000, 1, 1), None], [date(2000, 1, 2), 1], [None, 2], [date(2000, 1, 3), u'x']])
+        self.assertEqual(len(calls), len(set(calls)))
+        self.assertEqual(out.getvalue().splitlines(), [
+            'Date,Value', '2000-01-01,', '2000-01-02,1', ',2', '2000-01-03,x',
+        ])
+
+    def test_export_shards(self):
+        """Test that a sharded export contains the same rows as a serial one"""
+        entries = [Entry.objects.create(title='Entry %s\nline' % i, body='', pub_date=datetime.now()) for i in range(5)]
+        create_custom_search_ordering(self.cs, field=self.csf, descending=True)
+
+        def sheet_rows(message):
+            zf = zipfile.ZipFile(StringIO(message.attachments[0][1]))
+            ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+            sheet = ElementTree.fromstring(zf.read('xl/worksheets/sheet1.xml'))
+            return [[c.findtext('.//%st' % ns) for c in r] for r in sheet.iter('%srow' % ns)]
+
+        export_search(self.cs.pk, 'user@example.org')
+        expected = sheet_rows(mail.outbox[0])
+        self.assertEqual(expected, [['title']] + [[e.title] for e in reversed(entries)])
+
+        # Shards get the range of their rows
+        progress.set_pks('sharded', [e.pk for e in reversed(entries)])
+        parts = [export_shard(self.cs.pk, 'sharded', 0, 0, 2), export_shard(self.cs.pk, 'sharded', 1, 2, 5)]
+        merge_export_shards(parts, self.cs.pk, 'user@example.org')
+        self.assertEqual(sheet_rows(mail.outbox[1]), expected)
+        self.assertFalse([name for name in parts if artifacts.get_part_storage().exists(name)])
+        self.assertFalse(artifacts.get_part_storage().exists('%s/sharded' % artifacts.PART_DIR))
+
+        # A failed shard export is cleaned up and released
+        progress.start('failed', self.cs.pk, 5, 'key')
+        progress.set_pks('failed', [e.pk for e in entries])
+        parts = [export_shard(self.cs.pk, 'failed', 0, 0, 2)]
+        coalesce.acquire('key', 'failed')
+        fail_export(self.cs.pk, 'user@example.org', 2, 'key', 'failed')
+        self.assertFalse(artifacts.get_part_storage().exists(parts[0]))
+        self.assertFalse(artifacts.get_part_storage().exists('%s/failed' % artifacts.PART_DIR))
+        self.assertIsNone(coalesce.get_running('key'))
+        self.assertEqual(progress.get_progress('failed')['state'], 'failed')
+        self.assertRaises(resultcache.ResultCacheMiss, progress.get_pks, 'failed', 0, 2)
+
+    def test_export_artifacts(self):
+        """Test that exports are stored with expiring links and cleaned up"""
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        src = os.path.join(location, 'src.xlsx')
+        with open(src, 'wb') as f:
+            f.write(b'data')
+
+        with self.settings(
+            CUSTOMSEARCH_EXPORT_STORAGE='django.core.files.storage.FileSystemStorage',
+            CUSTOMSEARCH_EXPORT_STORAGE_OPTIONS={'location': location},
+            CUSTOMSEARCH_EXPORT_COMPRESSION='gzip',
+        ):
+            storage = artifacts.get_export_storage()
+            name = artifacts.store_export(src, 'Search.xlsx')
+            self.assertTrue(name.endswith('/Search.xlsx.gz'))
+            self.assertEqual(gzip.GzipFile(fileobj=storage.open(name)).read(), b'data')
+            self.assertEqual(artifacts.load_export_token(artifacts.export_token(name)), name)
+
+            with self.settings(CUSTOMSEARCH_EXPORT_LINK_MAX_AGE=-1):
+                self.assertRaises(signing.SignatureExpired, artifacts.load_export_token, artifacts.export_token(name))
+
+            old = '%s/%d-abc/Old.xlsx' % (artifacts.EXPORT_DIR, time.time() - 3600)
+            storage.save(old, storage.open(name))
+            self.assertEqual(artifacts.cleanup_exports(max_age=60), 1)
+            self.assertFalse(storage.exists(old))
+            self.assertTrue(storage.exists(name))
+
+    def test_export_coalescing(self):
+        """Test that identical export requests share one export"""
+        entry = Entry.objects.create(title='Entry', body='', pub_date=datetime.now())
+        key = coalesce.export_key(self.cs, 'Entry')
+        self.assertEqual(key, coalesce.export_key(self.cs, 'Entry'))
+        self.assertNotEqual(key, coalesce.export_key(self.cs, 'Entry', ordering='1'))
+
+        self.assertTrue(coalesce.acquire(key))
+        self.assertTrue(coalesce.add_requester(key, 'second@example.org'))
+        # A request for a running export does not reset its requesters
+        self.assertFalse(coalesce.acquire(key))
+        self.assertTrue(coalesce.add_requester(key, 'third@example.org'))
+
+        export_search(self.cs.pk, 'first@example.org', 'Entry', export_key=key)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['first@example.org', 'second@example.org', 'third@example.org'])
+        self.assertEqual(len(set(m.attachments[0][1] for m in mail.outbox)), 1)
+
+        # The lock is released
+        self.assertFalse(coalesce.add_requester(key, 'fourth@example.org'))
+        self.assertTrue(coalesce.acquire(key))
+        coalesce.release(key)
+
+        # Everyone who requested a failed export is notified
+        mail.outbox = []
+        self.assertTrue(coalesce.acquire(key))
+        self.assertTrue(coalesce.add_requester(key, 'second@example.org'))
+        get_cache().set('%s:done' % key, 'stale.xlsx')
+        self.assertRaises(CustomSearch.DoesNotExist, export_search, 0, 'first@example.org', 'Entry', export_key=key)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['first@example.org', 'second@example.org'])
+        self.assertTrue(mail.outbox[0].subject.startswith('Custom Search export failed'))
+        self.assertIsNone(coalesce.get_running(key))
+        self.assertIsNone(coalesce.get_completed(key))
+
+        # Data changes give a new key
+        entry.save()
+        self.assertNotEqual(key, coalesce.export_key(self.cs, 'Entry'))
+
+    @override_settings(CUSTOMSEARCH_EXPORT_CHECKPOINT_ROWS=2)
+    def test_export_progress(self):
+        """Test export progress, resuming from a checkpoint and cancellation"""
+        entries = [Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now()) for i in range(5)]
+        pks = [e.pk for e in reversed(entries)]
+
+        # Resume after the first two rows
+        progress.set_pks('resumed', pks)
+        part = export_shard(self.cs.pk, 'resumed', 0, 0, 2)
+        self.assertTrue(part.startswith(artifacts.PART_DIR))
+        progress.set_checkpoint('resumed', 2, progress.chunk_digest('', pks[:2]), [part])
+        export_search(self.cs.pk, 'user@example.org', export_id='resumed')
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(artifacts.get_part_storage().exists(part))
+        self.assertIsNone(progress.get_checkpoint('resumed'))
+        state = progress.get_progress('resumed')
+        self.assertEqual((state['state'], state['rows'], state['total']), ('done', 5, 5))
+
+        # The checkpoint is ignored if the results changed, even if the
+        # last written object is the same
+        progress.set_pks('changed', [pks[3], pks[1]])
+        part = export_shard(self.cs.pk, 'changed', 0, 0, 2)
+        progress.set_checkpoint('changed', 2, progress.chunk_digest('', [pks[3], pks[1]]), [part])
+        export_search(self.cs.pk, 'user@example.org', export_id='changed')
+        self.assertFalse(artifacts.get_part_storage().exists(part))
+        self.assertEqual(progress.get_progress('changed')['rows'], 5)
+        sheet = zipfile.ZipFile(StringIO(mail.outbox[1].attachments[0][1])).read('xl/worksheets/sheet1.xml')
+        self.assertEqual(re.findall(r'Entry \d', sheet), ['Entry %s' % i for i in range(4, -1, -1)])
+
+        # Cancellation
+        progress.start('cancelled', self.cs.pk, 5)
+        self.assertTrue(cancel_export('cancelled'))
+        self.assertFalse(cancel_export('cancelled'))
+        self.assertRaises(progress.ExportCancelled, list, progress.track(range(3), 'cancelled', size=1))
+        export_search(self.cs.pk, 'user@example.org', export_id='cancelled')
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(progress.get_progress('cancelled')['state'], 'cancelled')
+
+        # Requesters coalesced onto a cancelled export are notified
+        progress.start('coalesced', self.cs.pk, 5, 'key')
+        coalesce.acquire('key', 'coalesced')
+        coalesce.add_requester('key', 'second@example.org')
+        self.assertTrue(cancel_export('coalesced'))
+        self.assertEqual(mail.outbox[-1].to, ['second@example.org'])
+        self.assertTrue(mail.outbox[-1].subject.startswith('Custom Search export cancelled'))
+        self.assertIsNone(coalesce.get_running('key'))
+
+    @override_settings(CUSTOMSEARCH_RESULT_CACHE='default')
+    def test_compute_results(self):
+        """Test that results computed in the background are stored in the result cache"""
+        entries = [Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now()) for i in range(3)]
+        self.assertIsNone(resultcache.get_cached_result_pks(self.cs, 'Entry', 1, 'desc'))
+
+        self.assertTrue(resultcache.start_computing(self.cs, 'Entry', 1, 'desc'))
+        self.assertFalse(resultcache.start_computing(self.cs, 'Entry', 1, 'desc'))
+        compute_results(self.cs.pk, 'Entry', 1, 'desc')
+        self.assertEqual(list(resultcache.get_cached_result_pks(self.cs, 'Entry', 1, 'desc')), [e.pk for e in reversed(entries)])
+        self.assertIsNone(resultcache.get_computing_error(self.cs, 'Entry', 1, 'desc'))
+        self.assertTrue(resultcache.start_computing(self.cs, 'Entry', 1, 'desc'))
+
+        with self.settings(CUSTOMSEARCH_RESULT_CACHE_MAX_ROWS=2):
+            compute_results(self.cs.pk, 'Entry')
+        self.assertIn('too many results', resultcache.get_computing_error(self.cs, 'Entry'))
+
+    def test_search_results_json(self):
+        """Test the JSON results with cursor pagination and field selection"""
+        entries = [Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now()) for i in range(3)]
+
+        data = search_results(self.cs, 'Entry', 1, 'desc', per_page=2, fields=['title'])
+        self.assertEqual(data['columns'], [{'name': self.csf.name, 'field': 'title'}])
+        self.assertEqual(data['results'], [{'pk': e.pk, 'values': [e.title]} for e in [entries[2], entries[1]]])
+        self.assertIsNone(data['previous'])
+
+        data = json.loads(json.dumps(search_results(self.cs, 'Entry', 1, 'desc', cursor=data['next'], per_page=2), cls=ResultsJSONEncoder))
+        self.assertEqual(data['results'], [{'pk': entries[0].pk, 'values': [entries[0].title]}])
+        self.assertIsNone(data['next'])
+
+        self.assertRaises(KeyError, search_results, self.cs, fields=['body'])
+
+        # Cursors which do not fit the ordering are errors, programming
+        # errors are not hidden
+        cursor = base64.urlsafe_b64encode(json.dumps(['n', 'Entry', 'x']))
+        self.assertRaises(ValueError, search_results, self.cs, 'Entry', 1, 'desc', cursor=cursor)
+
+        def paginator(queryset, per_page):
+            raise AttributeError('bug')
+        self.addCleanup(setattr, jsonapi, 'KeysetPaginator', jsonapi.KeysetPaginator)
+        jsonapi.KeysetPaginator = paginator
+        self.assertRaises(AttributeError, search_results, self.cs)
+
+    def test_data_watermarks(self):
+        """Test that saving objects shown by a search changes their watermark"""
+        csm = create_custom_search_model(name='Article', model=Article)
+        create_custom_search_field(model=csm, name='headline')
+        create_custom_search_field(model=csm, name='author', selector='__last_name')
+        self.assertEqual(csm.data_models(), [Article, Author])
+
+        author = Author.objects.create(first_name='Jane', last_name='Doe')
+        watermark = get_data_watermark(Author)
+        author.save()
+        self.assertNotEqual(watermark, get_data_watermark(Author))
+
+        # Only the data models have receivers
+        self.assertTrue(post_save.has_listeners(Author))
+
+        # Many-to-many fields of search models are tracked as well
+        csm = create_custom_search_model(name='User', model=User)
+        create_custom_search_field(model=csm, name='groups', selector='__name')
+        self.assertEqual(csm.through_models(), [User.groups.through])
+        user = User.objects.create(username='jane')
+        group = Group.objects.create(name='Group')
+        watermark = get_data_watermark(User)
+        user.groups.add(group)
+        self.assertNotEqual(watermark, get_data_watermark(User))
+        watermark = get_data_watermark(Group)
+        group.user_set.clear()
+        self.assertNotEqual(watermark, get_data_watermark(Group))
+        watermark = get_data_watermark(CustomSearchGroup)
+        create_custom_search_group(name='Other group')
+        self.assertEqual(watermark, get_data_watermark(CustomSearchGroup))
+
+    def test_cache_check(self):
+        """Test that a cache which is not shared between processes is reported"""
+        caches = {
+            'local': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'customsearch'},
+        }
+        with self.settings(CACHES=caches, CUSTOMSEARCH_CACHE='local'):
+            self.assertEqual([e.id for e in check_cache(None)], ['customsearch.W001'])
+        with self.settings(CACHES=caches, CUSTOMSEARCH_CACHE='shared'):
+            self.assertEqual(check_cache(None), [])
+
+    def test_fragment_cache(self):
+        """Test that cached rows are keyed by the search version and data"""
+        self.assertEqual(format_value(None), 'None')
+        self.assertEqual(format_value('<b>'), '&lt;b&gt;')
+        self.assertEqual(format_value(date(2000, 1, 2)), 'Jan. 2, 2000')
+
+        key = fragment_key(self.cs, 'Entry', None, None, False, 1)
+        self.assertNotEqual(key, fragment_key(self.cs, 'Entry', None, None, False, 2))
+        set_fragment(key, '<tr></tr>')
+        self.assertEqual(get_fragment(key), '<tr></tr>')
+        with self.settings(CUSTOMSEARCH_FRAGMENT_CACHE_TIMEOUT=None):
+            self.assertIsNone(get_fragment(key))
+
+        Entry.objects.create(title='Entry', body='', pub_date=datetime.now())
+        self.assertNotEqual(key, fragment_key(self.cs, 'Entry', None, None, False, 1))
+
+        # Rows of searches relative to the current time expire
+        pub_date = create_custom_search_field(model=self.csm, name='pub_date')
+        create_custom_search_condition(search=self.cs, field=pub_date, value='now()', match=17)
+        with self.settings(CUSTOMSEARCH_TIME_DEPENDENT_MAX_AGE=10 ** 10):
+            key = fragment_key(self.cs, 'Entry', None, None, False, 1)
+        with self.settings(CUSTOMSEARCH_TIME_DEPENDENT_MAX_AGE=1):
+            self.assertNotEqual(key, fragment_key(self.cs, 'Entry', None, None, False, 1))
+
+    def test_uncounted_paginator(self):
+        """Test that the uncounted paginator finds the next page without counting"""
+        entries = [Entry.objects.create(title='Entry %s' % i, body='', pub_date=datetime.now()) for i in range(5)]
+        paginator = UncountedPaginator(Entry.objects.order_by('pk'), 2)
+
+        with self.assertNumQueries(1):
+            page = paginator.page(1)
+            self.assertEqual(page.object_list, entries[:2])
+        self.assertTrue(page.has_next())
+        self.assertFalse(page.has_previous())
+
+        page = paginator.page('3')
+        self.assertEqual(page.object_list, entries[4:])
+        self.assertFalse(page.has_next())
+        self.assertEqual(page.previous_page_number(), 2)
+        self.assertEqual(paginator.page('x').number, 1)
+
+    def test_elided_page_range(self):
+        """Test that only pages near the ends and the current page are listed"""
+        paginator = Paginator(range(1000), 10)
+        self.assertEqual(elided_page_range(paginator.page(1)), [1, 2, 3, 4, None, 99, 100])
+        self.assertEqual(elided_page_range(paginator.page(50)), [1, 2, None, 47, 48, 49, 50, 51, 52, 53, None, 99, 100])
+        self.assertEqual(elided_page_range(paginator.page(98)), [1, 2, None, 95, 96, 97, 98, 99, 100])
+        self.assertEqual(elided_page_range(Paginator(range(50), 10).page(3)), [1, 2, 3, 4, 5])
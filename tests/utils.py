@@ -46,8 +46,8 @@ def create_custom_search_layout(name, model):
     return CustomSearchLayout.objects.create(model=model, name=name)
 
 
-def create_custom_search_layout_field(layout, field, position=None):
-    return CustomSearchLayoutField.objects.create(layout=layout, field=field, position=position)
+def create_custom_search_layout_field(layout, field, position=None, expand_rel=False):
+    return CustomSearchLayoutField.objects.create(layout=layout, field=field, position=position, expand_rel=expand_rel)
 
 
 def create_custom_search(model, group, layout):